@@ -1,32 +1,66 @@
 # servidor_ia.py (versão corrigida e ampliada)
 
 import os
-import json
 import uuid
-from flask import Flask, request, jsonify
-import subprocess
-import requests
+import queue
+import threading
+from flask import Flask, Response, request, jsonify
+from flask.json.provider import DefaultJSONProvider
 import time
 import faiss
 from utils.faiss_manager import FaissMemory
+from core.ollama_cliente import ClienteOllama, GeracaoCancelada
+from core.backends import PoolBackends, SemBackendDisponivel
+from core.modelos import GerenciadorModelos
+from core.catalogo import CatalogoModelos
+from core.personas import RegistroPersonas
+from core.contexto import MontadorContexto
+from core.resumo import ResumidorHistorico
+from core.cache_respostas import CacheRespostas
+from core.agendador import Agendador, FilaCheia
+from core.cancelamento import Cancelamento, RegistroCancelamentos, vigiar_desconexao
+from core.degradacao import ControleDegradacao
+from core.roteador import RoteadorModelos
+from core.lotes import GerenciadorLotes
+from core.busca_conversas import IndiceConversas
+from core.armazem_sessoes import ArmazemSessoes
+from utils.tokens import tokens_mensagem, contar_tokens, calibracao_tokens, iniciar_carregamento
+from utils.json_files import dumps, loads, linha_ndjson
+from utils.metricas import metricas, ETAPAS, TURNOS, TURNOS_TOTAL, TOKENS_ENTRADA, TOKENS_SAIDA, CACHE
+from utils.rastreamento import rastreador, novo_id, origem_rastro
+from config.config import (MODELO_PADRAO, MODELOS_PRECARREGAR, PRAZO_PADRAO_S, ROTEAMENTO_AUTOMATICO,
+                           MODELO_RASCUNHO, RASCUNHO_MAX_TOKENS, MULTI_MAX_GERACOES, BUSCA_LIMITE_PADRAO)
 #from config import OLLAMA_ENDPOINT, DEFAULT_SESSAO_CONFIG
 
 # Inicializações
 app = Flask(__name__)
 
+
+class ProvedorJSON(DefaultJSONProvider):
+    """jsonify/request.json com a serialização de utils.json_files (orjson/msgspec quando instalados)."""
+
+    def dumps(self, obj, **kwargs):
+        return dumps(obj).decode("utf-8")
+
+    def loads(self, s, **kwargs):
+        return loads(s)
+
+
+app.json = ProvedorJSON(app)
+
 # Diretórios
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 CONVERSAS_DIR = os.path.join(BASE_DIR, "..", "dados", "conversas_salvas")
 PERSONALIDADES_DIR = os.path.join(BASE_DIR, "..", "dados", "personalidades")
-
-# Endpoints
-OLLAMA_ENDPOINT = "http://localhost:11434/api/generate"
+LOTES_DIR = os.path.join(BASE_DIR, "..", "dados", "lotes")
+BUSCA_DB = os.path.join(BASE_DIR, "..", "dados", "busca_conversas.sqlite")
 
 # Sessão atual
 sessao = {
     "id": str(uuid.uuid4()),
     "modelo": None,
     "personalidade": None,
+    "roteamento": ROTEAMENTO_AUTOMATICO,
     "historico": []
 }
 
@@ -37,127 +71,636 @@ sessao_config = {
     "top_k": 50,
     "repeat_penalty": 1.1,
     "num_predict": 400,
+    "num_ctx": 4096,
     "max_historico": 10
 }
 
 # Instâncias de memória
 memoria = FaissMemory()
+pool_backends = PoolBackends()
+cliente_ollama = ClienteOllama(pool_backends)
+gerenciador_modelos = GerenciadorModelos(cliente_ollama)
+catalogo = CatalogoModelos(cliente_ollama)
+montador = MontadorContexto()
+resumidor = ResumidorHistorico(cliente_ollama)
+cache_respostas = CacheRespostas()
+agendador = Agendador()
+turnos = RegistroCancelamentos()
+degradacao = ControleDegradacao(agendador, cliente_ollama, catalogo)
+roteador = RoteadorModelos(catalogo)
+indice_conversas = IndiceConversas(BUSCA_DB)
+armazem_sessoes = ArmazemSessoes(CONVERSAS_DIR)
 modo_admin = False
 
 # Garantir diretórios
 os.makedirs(CONVERSAS_DIR, exist_ok=True)
 os.makedirs(PERSONALIDADES_DIR, exist_ok=True)
 
+# Health check dos backends Ollama
+pool_backends.iniciar_verificacao()
+
+# Personalidades compiladas (recarregadas quando os arquivos mudam)
+personas = RegistroPersonas(PERSONALIDADES_DIR, codificador=memoria.codificar_varios)
+personas.iniciar_monitoramento()
+
+# Tokenizador (pode precisar de download) carregado em segundo plano; as personas são recontadas depois
+iniciar_carregamento(ao_concluir=personas.recontar)
+
+# Sessão atual salva automaticamente quando alterada (só os eventos novos)
+armazem_sessoes.iniciar_autosave(lambda: sessao)
+
 # Funções auxiliares
 
 def carregar_modelos():
-    """Retorna uma lista de modelos locais disponíveis."""
+    """Retorna uma lista de modelos locais disponíveis (catálogo em cache)."""
+    return catalogo.nomes()
+
+def carregar_personalidade(nome):
+    """Retorna a personalidade compilada do registro. Se não existir, retorna a padrão."""
+    return personas.obter(nome)
+
+def prompt_sistema(nome):
+    """Texto de sistema da personalidade, usado como prefixo fixo do prompt."""
+    return carregar_personalidade(nome)["system"]
+
+def aquecer_inicial():
+    """Pré-carrega o modelo padrão e os modelos configurados na inicialização."""
+    if MODELO_PADRAO and not sessao["modelo"]:
+        sessao["modelo"] = MODELO_PADRAO
+    if sessao["modelo"]:
+        gerenciador_modelos.aquecer(sessao["modelo"], prompt_sistema(sessao["personalidade"]))
+    for modelo in MODELOS_PRECARREGAR:
+        if modelo != sessao["modelo"]:
+            gerenciador_modelos.aquecer(modelo)
+
+def opcoes_geracao(modelo):
+    """Opções de geração da sessão, com a janela de contexto limitada ao que o modelo suporta."""
+    contexto = (catalogo.info(modelo) or {}).get("contexto")
+    return {
+        "temperature": sessao_config["temperature"],
+        "top_p": sessao_config["top_p"],
+        "top_k": sessao_config["top_k"],
+        "repeat_penalty": sessao_config["repeat_penalty"],
+        "num_predict": sessao_config["num_predict"],
+        "num_ctx": min(sessao_config["num_ctx"], contexto or sessao_config["num_ctx"])
+    }
+
+def sessao_requisicao(data):
+    """Identifica quem fez a requisição, para repartir os slots de geração de forma justa."""
+    return data.get("sessao_id") or request.headers.get("X-Sessao") or request.remote_addr
+
+def rastro_requisicao():
+    """(trace id, span pai) do turno: continua o rastro do cabeçalho traceparent do cliente, se vier um."""
+    trace_id, pai_id = origem_rastro(request.headers.get("traceparent"))
+    return trace_id or novo_id(16), pai_id
+
+def cabecalho_rastro(trace_id):
+    return {"X-Trace-Id": trace_id} if rastreador.ativo else {}
+
+def registrar_turno(pergunta, content):
+    """Adiciona pergunta e resposta ao histórico, ao índice de busca e agenda a compactação se necessário."""
+    novas = []
+    for role, texto in (("user", pergunta), ("assistant", content)):
+        mensagem = {"role": role, "content": texto}
+        tokens_mensagem(mensagem)
+        novas.append(mensagem)
+    with resumidor.lock_historico:
+        sessao["historico"].extend(novas)
+        # Rede de segurança: sem resumo (falha ou nenhum modelo), o histórico não cresce sem limite
+        resumidor.limitar(sessao)
+
+    armazem_sessoes.acrescentar(sessao["id"], novas)
     try:
-        resultado = subprocess.run(["ollama", "list"], capture_output=True, text=True)
-        linhas = resultado.stdout.strip().split("\n")[1:]
-        modelos = [linha.split()[0] for linha in linhas if linha.strip()]
-        return modelos
+        with ETAPAS.cronometrar("persistencia"), rastreador.span("busca.indexar"):
+            indice_conversas.adicionar(sessao["id"], novas, sessao.get("modelo"), sessao.get("personalidade"))
     except Exception as e:
-        print(f"[ERRO] Listar modelos: {e}")
-        return []
+        print(f"[ERRO] Indexar turno para busca: {e}")
 
-def carregar_personalidade(nome):
-    """Carrega uma personalidade do diretório. Se não existir, carrega padrão."""
-    caminho = os.path.join(PERSONALIDADES_DIR, f"{nome}.json")
-    if os.path.exists(caminho):
-        with open(caminho, "r", encoding="utf-8") as f:
-            return json.load(f)
-    return {"system": "Você é um assistente útil."}
+    # Mensagens antigas são resumidas em segundo plano em vez de descartadas
+    resumidor.verificar(sessao, max_mensagens=sessao_config["max_historico"] * 2)
+
+def resposta_cancelada(cancelamento):
+    """Resposta de um turno abortado: 504 se o prazo venceu, 499 se foi cancelado."""
+    status = 504 if cancelamento.motivo == "prazo" else 499
+    return {"status": "cancelado", "motivo": cancelamento.motivo}, status, {}
 
 def salvar_conversa():
-    """Salva o histórico atual em arquivo JSON."""
-    caminho = os.path.join(CONVERSAS_DIR, f"{sessao['id']}.json")
-    with open(caminho, "w", encoding="utf-8") as f:
-        json.dump(sessao, f, indent=2, ensure_ascii=False)
+    """Acrescenta ao log da sessão o que mudou desde o último salvamento. Retorna o nome do arquivo."""
+    return armazem_sessoes.gravar(sessao)
 
 # Rotas principais
 
 @app.route("/conversar", methods=["POST"])
 def conversar():
     """Recebe uma pergunta e retorna resposta gerada pela IA."""
-    global modo_admin
     data = request.json
-    pergunta = data.get("mensagem", "")
-    personalidade = carregar_personalidade(sessao["personalidade"])
+    sessao_id = sessao_requisicao(data)
+    trace_id, pai_id = rastro_requisicao()
+
+    # Prazo do turno; a geração também é abortada se o cliente desconectar ou chamar /cancelar
+    cancelamento = Cancelamento(prazo_s=data.get("prazo_s") or PRAZO_PADRAO_S)
+    concluido = threading.Event()
+    vigiar_desconexao(request.environ.get("werkzeug.socket"), cancelamento, concluido)
+    if data.get("progressivo"):
+        # O turno continua dentro do gerador da resposta em streaming
+        return Response(turno_progressivo(data, sessao_id, cancelamento, concluido, trace_id, pai_id),
+                        mimetype="application/x-ndjson", headers=cabecalho_rastro(trace_id))
+    try:
+        with turnos.turno(sessao_id, cancelamento):
+            corpo, status, cabecalhos = processar_turno(data, sessao_id, cancelamento, trace_id, pai_id)
+    finally:
+        concluido.set()
+    return jsonify(corpo), status, dict(cabecalhos, **cabecalho_rastro(trace_id))
+
+def modelo_rascunho():
+    """Modelo pequeno usado para o rascunho do modo progressivo."""
+    if MODELO_RASCUNHO:
+        return MODELO_RASCUNHO
+    ordenados = roteador.modelos_por_tamanho(carregar_modelos())
+    return ordenados[0] if ordenados else None
+
+def turno_progressivo(data, sessao_id, cancelamento, concluido, trace_id=None, pai_id=None):
+    """
+    Modo progressivo do /conversar, em NDJSON: transmite pedaços de um rascunho
+    do modelo pequeno enquanto a resposta completa é gerada em paralelo.
 
-    similares = memoria.buscar_similar(pergunta, k=3)
-    memoria_injetada = "\n".join([s.get("texto", "") for s in similares])
+    Eventos: {"tipo": "rascunho", "texto"} a cada pedaço, {"tipo": "rascunho_fim"}
+    e por último {"tipo": "final", "status_http", ...corpo do /conversar}, que o
+    cliente usa para substituir o rascunho. Só a resposta final vai para o
+    histórico e a memória.
+    """
+    eventos = queue.Queue()
+    cancelamento_rascunho = Cancelamento(pai=cancelamento)
+    modelo = modelo_rascunho()
+    pergunta = data.get("mensagem", "")
 
-    #personalidade = carregar_personalidade(sessao.get("personalidade", "default"))
-    prompt = f"""{personalidade.get('system', 'Você é um assistente útil.')}
-        Contexto relevante: {memoria_injetada},
-        Usuário: {pergunta},
-        Assistente:
+    def _final():
+        try:
+            corpo, status, _ = processar_turno(data, sessao_id, cancelamento, trace_id, pai_id)
+        except Exception as e:
+            corpo, status = {"status": "erro", "mensagem": f"Falha no processamento: {str(e)}"}, 500
+        cancelamento_rascunho.cancelar("substituido")
+        eventos.put(dict(corpo, tipo="final", status_http=status))
+
+    def _rascunho(payload):
+        try:
+            with agendador.slot(modelo, sessao_id, "interativo",
+                                custo=len(payload["prompt"]) // 4 + RASCUNHO_MAX_TOKENS, espera_max=0.5,
+                                cancelamento=cancelamento_rascunho), gerenciador_modelos.uso(modelo):
+                cliente_ollama.gerar(payload, cancelamento=cancelamento_rascunho,
+                                     ao_pedaco=lambda texto: eventos.put({"tipo": "rascunho", "texto": texto}))
+        except (GeracaoCancelada, FilaCheia, SemBackendDisponivel):
+            pass
+        except Exception as e:
+            print(f"[ERRO] Rascunho: {e}")
+        eventos.put({"tipo": "rascunho_fim"})
+
+    # O prompt do rascunho é montado antes da geração final alterar o histórico; sem memórias, para sair rápido
+    payload_rascunho = None
+    if modelo and (modelo != sessao["modelo"] or sessao.get("roteamento")):
+        num_ctx = opcoes_geracao(modelo)["num_ctx"]
+        prompt, _ = montador.montar(prompt_sistema(sessao["personalidade"]), pergunta, sessao["historico"], [],
+                                    num_ctx, RASCUNHO_MAX_TOKENS, resumo=sessao.get("resumo", ""),
+                                    fator=calibracao_tokens.fator(modelo))
+        payload_rascunho = {
+            "model": modelo,
+            "prompt": prompt,
+            "options": {"temperature": sessao_config["temperature"], "num_predict": RASCUNHO_MAX_TOKENS,
+                        "num_ctx": num_ctx},
+            "keep_alive": gerenciador_modelos.keep_alive
+        }
+
+    def _eventos():
+        entregue = False
+        try:
+            with turnos.turno(sessao_id, cancelamento):
+                if payload_rascunho:
+                    threading.Thread(target=_rascunho, args=(payload_rascunho,), daemon=True).start()
+                threading.Thread(target=_final, daemon=True).start()
+                while not entregue:
+                    evento = eventos.get()
+                    entregue = evento["tipo"] == "final"
+                    yield linha_ndjson(evento)
+        finally:
+            # Stream interrompido antes da resposta final: aborta as gerações
+            if not entregue:
+                cancelamento.cancelar("desconexao")
+            concluido.set()
+
+    return _eventos()
+
+def rotulo_persona(nome):
+    """Persona como rótulo de métrica (None = personalidade padrão)."""
+    return nome or "padrao"
+
+def contar_tokens_geracao(output, modelo, persona, tokens_prompt=None):
+    """Contadores de tokens do turno e calibração da nossa contagem com o prompt_eval_count do Ollama."""
+    calibracao_tokens.registrar(modelo, tokens_prompt, output.get("prompt_eval_count"))
+    TOKENS_ENTRADA.incrementar(output.get("prompt_eval_count") or 0, modelo, rotulo_persona(persona))
+    TOKENS_SAIDA.incrementar(output.get("eval_count") or 0, modelo, rotulo_persona(persona))
+
+def processar_turno(data, sessao_id, cancelamento, trace_id=None, pai_id=None):
+    """
+    Executa o turno dentro de um rastro e registra duração e resultado nas métricas.
+    Retorna (corpo, status, cabeçalhos).
+    """
+    with rastreador.rastro("conversar", trace_id, pai_id, sessao=sessao_id,
+                           prioridade=data.get("prioridade", "interativo")) as raiz:
+        inicio = time.perf_counter()
+        corpo, status, cabecalhos = executar_turno(data, sessao_id, cancelamento)
+        modelo, persona = corpo.get("modelo") or sessao["modelo"], rotulo_persona(sessao["personalidade"])
+        TURNOS.observar(time.perf_counter() - inicio, modelo, persona)
+        TURNOS_TOTAL.incrementar(1, modelo, persona, str(status))
+        if raiz is not None:
+            raiz.definir(modelo=modelo, persona=persona, status=status, cache=corpo.get("cache"),
+                         degradacoes=",".join(corpo.get("degradacoes", [])) or None)
+    return corpo, status, cabecalhos
+
+def executar_turno(data, sessao_id, cancelamento):
+    """
+    Pipeline de um turno: cache, recuperação de memórias, montagem do prompt e geração.
+    Retorna (corpo, status, cabeçalhos) da resposta.
     """
+    global modo_admin
+    pergunta = data.get("mensagem", "")
+    inicio_turno = time.time()
+
+    opcoes = opcoes_geracao(sessao["modelo"])
+    num_ctx = opcoes["num_ctx"]
+
+    # O embedding da pergunta serve tanto ao cache semântico quanto à busca na memória
+    vetor = memoria.codificar(pergunta)
+    usar_cache = data.get("cache", True) and cache_respostas.permitido(opcoes)
+    modelo_cache = "auto" if sessao.get("roteamento") else sessao["modelo"]
+    opcoes_cache = dict(opcoes)
+    # Assinatura do contexto antes do turno (o guardar acontece depois de o histórico receber este turno)
+    contexto_cache = cache_respostas.contexto(sessao["historico"], sessao.get("resumo", "")) if usar_cache else ""
+    if usar_cache:
+        with rastreador.span("cache.buscar"):
+            content, tipo_cache = cache_respostas.buscar(modelo_cache, sessao["personalidade"],
+                                                         opcoes_cache, pergunta, vetor, contexto_cache)
+        CACHE.incrementar(1, modelo_cache, rotulo_persona(sessao["personalidade"]),
+                          "falha" if content is None else "acerto")
+        if content is not None:
+            registrar_turno(pergunta, content)
+            return {"resposta": content, "cache": tipo_cache}, 200, {}
+    if cancelamento.cancelado:
+        return resposta_cancelada(cancelamento)
+
+    # Sob carga o turno é degradado para caber no orçamento de latência
+    plano = degradacao.planejar(sessao["modelo"], sessao_config["num_predict"], 3,
+                                data.get("orcamento_latencia_s") or cancelamento.restante())
+    modelo = plano["modelo"]
+    opcoes["num_predict"] = plano["num_predict"]
+
+    memorias = []
+    if plano["k_memorias"]:
+        similares = memoria.buscar_similar(pergunta, k=plano["k_memorias"], vetor=vetor)
+        memorias = [s.get("texto", "") for s in similares if s.get("texto")]
+    if cancelamento.cancelado:
+        return resposta_cancelada(cancelamento)
+
+    # Roteamento automático: pedidos simples vão para o menor modelo (a degradação tem precedência)
+    rota = None
+    if sessao.get("roteamento") and "modelo_menor" not in plano["degradacoes"]:
+        modelo, rota, pontuacao = roteador.escolher(carregar_modelos(), pergunta,
+                                                    sum(contar_tokens(m) for m in memorias),
+                                                    carregar_personalidade(sessao["personalidade"]),
+                                                    padrao=modelo)
+        if modo_admin:
+            print(f"[DEBUG] Rota {rota} (pontuação {pontuacao}): {modelo}")
+    if modelo != sessao["modelo"]:
+        opcoes["num_ctx"] = num_ctx = opcoes_geracao(modelo)["num_ctx"]
+
+    # Exemplos de conversa da persona mais parecidos com a pergunta (reusa o embedding)
+    with ETAPAS.cronometrar("montar_prompt"), rastreador.span("contexto.montar"):
+        exemplos = personas.selecionar_exemplos(sessao["personalidade"], vetor)
+        prompt, relatorio = montador.montar(prompt_sistema(sessao["personalidade"]), pergunta,
+                                            sessao["historico"], memorias,
+                                            num_ctx, opcoes["num_predict"],
+                                            resumo=sessao.get("resumo", ""), exemplos=exemplos,
+                                            fator=calibracao_tokens.fator(modelo))
     payload = {
-        "model": sessao["modelo"],
+        "model": modelo,
         "prompt": prompt,
         "stream": False,
-        "temperature": sessao_config["temperature"],
-        "top_p": sessao_config["top_p"],
-        "top_k": sessao_config["top_k"],
-        "repeat_penalty": sessao_config["repeat_penalty"],
-        "num_predict": sessao_config["num_predict"]
+        "options": opcoes,
+        "keep_alive": gerenciador_modelos.keep_alive
     }
 
     inicio = time.time()
     try:
-        resposta = requests.post(OLLAMA_ENDPOINT, json=payload, timeout=30)
-        output = resposta.json()
-        content = output.get("response") or output.get("message", {}).get("content", "[ERRO] Resposta inesperada.")
+        with agendador.slot(modelo, sessao_id, data.get("prioridade", "interativo"),
+                            custo=relatorio["tokens_prompt"] + opcoes["num_predict"],
+                            cancelamento=cancelamento), gerenciador_modelos.uso(modelo):
+            output = cliente_ollama.gerar(payload, coalescer=data.get("coalescer"), cancelamento=cancelamento,
+                                          etapas=True)
+    except GeracaoCancelada:
+        return resposta_cancelada(cancelamento)
+    except FilaCheia as e:
+        return {"status": "erro", "mensagem": str(e), "modelo": modelo}, 429, {"Retry-After": str(e.retry_after)}
+    except SemBackendDisponivel as e:
+        return {"status": "erro", "mensagem": str(e), "modelo": modelo}, 503, {}
     except Exception as e:
-        content = f"[ERRO] Falha no processamento: {str(e)}"
+        return {"status": "erro", "mensagem": f"Falha no processamento: {str(e)}", "modelo": modelo}, 502, {}
+    content = output.get("response") or output.get("message", {}).get("content", "[ERRO] Resposta inesperada.")
+    contar_tokens_geracao(output, modelo, sessao["personalidade"], relatorio["tokens_prompt"])
 
     fim = time.time()
+    degradacao.registrar(sessao["modelo"], fim - inicio_turno)
+    if rota:
+        roteador.registrar(rota, modelo, fim - inicio_turno, output)
 
-    sessao["historico"].append({"role": "user", "content": pergunta})
-    sessao["historico"].append({"role": "assistant", "content": content})
-
-    if len(sessao["historico"]) > sessao_config["max_historico"] * 2:
-        sessao["historico"] = sessao["historico"][-(sessao_config["max_historico"] * 2):]
-
+    registrar_turno(pergunta, content)
     memoria.add_memory(f"Usuário: {pergunta} | IA: {content}")
+    # Respostas degradadas não entram no cache para não serem servidas fora da rajada
+    if usar_cache and output.get("response") and not plano["degradacoes"]:
+        cache_respostas.guardar(modelo_cache, sessao["personalidade"], opcoes_cache, pergunta, content, vetor,
+                                contexto_cache)
 
     if modo_admin:
-        print(f"[DEBUG] Tokens estimados: {len(prompt.split())}")
+        print(f"[DEBUG] Contexto: {relatorio}")
+        print(f"[DEBUG] Tokens do prompt (Ollama): {output.get('prompt_eval_count')}")
         print(f"[DEBUG] Tempo resposta: {fim - inicio:.2f}s")
+        if plano["degradacoes"]:
+            print(f"[DEBUG] Degradação nível {plano['nivel']}: {plano['degradacoes']}")
+
+    # O modelo que gerou (degradação e roteamento podem trocar o da sessão) vai no corpo e nos rótulos das métricas
+    resposta = {"resposta": content, "modelo": modelo}
+    if plano["degradacoes"]:
+        resposta["degradacoes"] = plano["degradacoes"]
+    if rota:
+        resposta["rota"] = rota
+    return resposta, 200, {}
+
+def gerar_avulsa(pergunta, persona, modelo, sessao_id, cancelamento, prioridade="interativo",
+                 historico=(), memorias=(), resumo="", vetor=None, opcoes=None):
+    """
+    Geração fora do fluxo da sessão (comparações e lotes): não altera histórico, memória nem cache.
+    Retorna {"persona", "modelo", "resposta" | "mensagem", "status_http", "tempo_s"}.
+    """
+    inicio = time.time()
+    resultado = {"persona": persona, "modelo": modelo}
+    opcoes_modelo = opcoes_geracao(modelo)
+    if opcoes:
+        opcoes_modelo.update(opcoes)
+        opcoes_modelo["num_ctx"] = min(opcoes_modelo["num_ctx"], opcoes_geracao(modelo)["num_ctx"])
+    prompt, relatorio = montador.montar(prompt_sistema(persona), pergunta, list(historico), list(memorias),
+                                        opcoes_modelo["num_ctx"], opcoes_modelo["num_predict"], resumo=resumo,
+                                        exemplos=personas.selecionar_exemplos(persona, vetor),
+                                        fator=calibracao_tokens.fator(modelo))
+    payload = {"model": modelo, "prompt": prompt, "stream": False, "options": opcoes_modelo,
+               "keep_alive": gerenciador_modelos.keep_alive}
+    try:
+        with agendador.slot(modelo, sessao_id, prioridade,
+                            custo=relatorio["tokens_prompt"] + opcoes_modelo["num_predict"],
+                            cancelamento=cancelamento), gerenciador_modelos.uso(modelo):
+            output = cliente_ollama.gerar(payload, cancelamento=cancelamento)
+        contar_tokens_geracao(output, modelo, persona, relatorio["tokens_prompt"])
+        resultado.update(resposta=output.get("response", ""), status_http=200,
+                         tokens=output.get("eval_count"))
+    except GeracaoCancelada:
+        corpo, status, _ = resposta_cancelada(cancelamento)
+        resultado.update(corpo, status_http=status)
+    except FilaCheia as e:
+        resultado.update(status="erro", mensagem=str(e), status_http=429, retry_after=e.retry_after)
+    except SemBackendDisponivel as e:
+        resultado.update(status="erro", mensagem=str(e), status_http=503)
+    except Exception as e:
+        resultado.update(status="erro", mensagem=f"Falha no processamento: {str(e)}", status_http=502)
+    resultado["tempo_s"] = round(time.time() - inicio, 3)
+    return resultado
+
+OPCOES_LOTE = ("temperature", "top_p", "top_k", "repeat_penalty", "num_predict", "num_ctx", "seed")
+
+def executar_item_lote(item, sessao_id, cancelamento):
+    """Gera um item de lote com prioridade baixa; FilaCheia volta ao gerenciador, que reenfileira."""
+    vetor = memoria.codificar(item["mensagem"])
+    memorias = []
+    if item.get("memorias"):
+        memorias = [s.get("texto", "") for s in memoria.buscar_similar(item["mensagem"], k=3, vetor=vetor)
+                    if s.get("texto")]
+    resultado = gerar_avulsa(item["mensagem"], item.get("persona"), item.get("modelo"), sessao_id,
+                             cancelamento, prioridade="lote", memorias=memorias, vetor=vetor,
+                             opcoes={k: v for k, v in (item.get("opcoes") or {}).items() if k in OPCOES_LOTE})
+    if resultado.get("status_http") == 429:
+        raise FilaCheia(resultado["mensagem"], resultado["retry_after"])
+    return resultado
+
+# Jobs em lote (retomados na inicialização por main.py)
+lotes = GerenciadorLotes(LOTES_DIR, executar_item_lote)
+
+@app.route("/conversar_multi", methods=["POST"])
+def conversar_multi():
+    """
+    Responde a mesma pergunta com várias personas e/ou modelos, sem alterar a sessão.
 
-    return jsonify({"resposta": content})
+    A busca de memórias é feita uma vez; as gerações rodam em paralelo dentro
+    dos limites do agendador e cada resultado é transmitido em NDJSON assim que
+    termina ({"persona", "modelo", "resposta" | "mensagem", "status_http", "tempo_s"}),
+    seguido de {"tipo": "fim", "total_s"}. Nada entra no histórico ou na memória.
+    """
+    data = request.json
+    sessao_id = sessao_requisicao(data)
+    pergunta = data.get("mensagem", "")
+    nomes_personas = data.get("personas") or [sessao["personalidade"]]
+    modelos = data.get("modelos") or [sessao["modelo"]]
+
+    invalidas = [p for p in nomes_personas if p and not personas.existe(p)]
+    disponiveis = carregar_modelos()
+    invalidos = [m for m in modelos if m not in disponiveis]
+    if invalidas or invalidos:
+        return jsonify({"status": "erro", "mensagem": "Personas ou modelos não encontrados.",
+                        "personas": invalidas, "modelos": invalidos}), 400
+    combinacoes = [(p, m) for p in nomes_personas for m in modelos]
+    if len(combinacoes) > MULTI_MAX_GERACOES:
+        return jsonify({"status": "erro",
+                        "mensagem": f"Máximo de {MULTI_MAX_GERACOES} combinações por requisição."}), 400
+
+    cancelamento = Cancelamento(prazo_s=data.get("prazo_s") or PRAZO_PADRAO_S)
+    concluido = threading.Event()
+    vigiar_desconexao(request.environ.get("werkzeug.socket"), cancelamento, concluido)
+
+    # Recuperação única, compartilhada por todas as gerações
+    vetor = memoria.codificar(pergunta)
+    similares = memoria.buscar_similar(pergunta, k=3, vetor=vetor)
+    memorias = [s.get("texto", "") for s in similares if s.get("texto")]
+    historico = list(sessao["historico"])
+    resumo = sessao.get("resumo", "")
+    resultados = queue.Queue()
+
+    def _gerar(persona, modelo):
+        resultados.put(gerar_avulsa(pergunta, persona, modelo, sessao_id, cancelamento,
+                                    prioridade=data.get("prioridade", "interativo"), historico=historico,
+                                    memorias=memorias, resumo=resumo, vetor=vetor))
+
+    def _eventos():
+        inicio, pendentes = time.time(), len(combinacoes)
+        try:
+            with turnos.turno(sessao_id, cancelamento):
+                for persona, modelo in combinacoes:
+                    threading.Thread(target=_gerar, args=(persona, modelo), daemon=True).start()
+                while pendentes:
+                    resultado = resultados.get()
+                    pendentes -= 1
+                    yield linha_ndjson(resultado)
+                yield linha_ndjson({"tipo": "fim", "total_s": round(time.time() - inicio, 3)})
+        finally:
+            if pendentes:
+                cancelamento.cancelar("desconexao")
+            concluido.set()
+
+    return Response(_eventos(), mimetype="application/x-ndjson")
+
+@app.route("/lotes", methods=["POST"])
+def criar_lote():
+    """
+    Cria um job em lote. Aceita JSON {"itens": [...], "persona", "modelo", "opcoes",
+    "concorrencia"} ou um corpo JSONL (um item por linha, demais campos na query string,
+    com opcoes em JSON).
+    Cada item: {"mensagem", "persona", "modelo", "opcoes", "memorias", "id"}.
+    """
+    if request.is_json:
+        data = request.json
+        itens = data.get("itens", [])
+    else:
+        data = request.args.to_dict()
+        try:
+            itens = [loads(l) for l in request.get_data().splitlines() if l.strip()]
+        except ValueError as e:
+            return jsonify({"status": "erro", "mensagem": f"JSONL inválido: {e}"}), 400
+    if not itens:
+        return jsonify({"status": "erro", "mensagem": "Nenhum item no lote."}), 400
+
+    # Persona e modelo da sessão ficam gravados no lote, para a retomada não depender da sessão
+    padrao = {"persona": data.get("persona") or sessao["personalidade"],
+              "modelo": data.get("modelo") or sessao["modelo"]}
+    opcoes = data.get("opcoes")
+    if isinstance(opcoes, str):
+        # Corpo JSONL: as opções chegam como JSON na query string
+        try:
+            opcoes = loads(opcoes)
+        except ValueError:
+            return jsonify({"status": "erro", "mensagem": "opcoes deve ser um objeto JSON."}), 400
+    if opcoes is not None and not isinstance(opcoes, dict):
+        return jsonify({"status": "erro", "mensagem": "opcoes deve ser um objeto JSON."}), 400
+    if opcoes:
+        padrao["opcoes"] = opcoes
+    concorrencia = data.get("concorrencia")
+    if concorrencia is not None:
+        try:
+            concorrencia = int(concorrencia)
+        except (TypeError, ValueError):
+            return jsonify({"status": "erro", "mensagem": "concorrencia deve ser um número inteiro."}), 400
+        if concorrencia < 1:
+            return jsonify({"status": "erro", "mensagem": "concorrencia deve ser maior que zero."}), 400
+    disponiveis = carregar_modelos()
+    invalidos = [i for i, item in enumerate(itens)
+                 if not isinstance(item, dict) or not item.get("mensagem")
+                 or not isinstance(item.get("opcoes") or {}, dict)
+                 or (item.get("persona") or padrao["persona"]) not in (None, *personas.nomes())
+                 or (item.get("modelo") or padrao["modelo"]) not in disponiveis]
+    if invalidos:
+        return jsonify({"status": "erro", "mensagem": "Itens sem mensagem, com opcoes inválidas ou com persona/modelo inexistente.",
+                        "linhas": invalidos[:50]}), 400
+
+    id_lote = lotes.criar(itens, concorrencia=concorrencia, padrao=padrao)
+    return jsonify({"status": "ok", "lote": id_lote, "total": len(itens)})
+
+@app.route("/lotes", methods=["GET"])
+def listar_lotes():
+    """Lista os lotes e o progresso de cada um."""
+    return jsonify({"lotes": lotes.estado()})
+
+@app.route("/lotes/<id_lote>", methods=["GET"])
+def estado_lote(id_lote):
+    """Progresso de um lote."""
+    estado = lotes.estado(id_lote)
+    if estado is None:
+        return jsonify({"status": "erro", "mensagem": "Lote não encontrado."}), 404
+    return jsonify(estado)
+
+@app.route("/lotes/<id_lote>/resultados", methods=["GET"])
+def resultados_lote(id_lote):
+    """Resultados em JSONL; com ?seguir=1 a resposta continua aberta até o lote terminar."""
+    if lotes.obter(id_lote) is None:
+        return jsonify({"status": "erro", "mensagem": "Lote não encontrado."}), 404
+    seguir = request.args.get("seguir") in ("1", "true")
+    return Response(lotes.resultados(id_lote, seguir=seguir), mimetype="application/x-ndjson")
+
+@app.route("/lotes/<id_lote>/cancelar", methods=["POST"])
+def cancelar_lote(id_lote):
+    """Interrompe um lote; os resultados já gravados são mantidos."""
+    if lotes.cancelar(id_lote):
+        return jsonify({"status": "ok", "mensagem": "Lote cancelado."})
+    return jsonify({"status": "erro", "mensagem": "Lote não encontrado ou já terminado."})
+
+@app.route("/buscar_conversas", methods=["GET"])
+def buscar_conversas():
+    """Busca textual nas conversas (?q=texto&limite=20&cursor=...&sessao=...), com trechos e paginação."""
+    texto = (request.args.get("q") or "").strip()
+    if not texto:
+        return jsonify({"status": "erro", "mensagem": "Informe o texto da busca em ?q=."}), 400
+    try:
+        limite = int(request.args.get("limite", BUSCA_LIMITE_PADRAO))
+    except ValueError:
+        return jsonify({"status": "erro", "mensagem": "limite deve ser um número."}), 400
+    inicio = time.time()
+    try:
+        resultado = indice_conversas.buscar(texto, limite=limite, cursor=request.args.get("cursor"),
+                                            sessao_id=request.args.get("sessao"))
+    except ValueError:
+        return jsonify({"status": "erro", "mensagem": "Cursor inválido."}), 400
+    return jsonify(dict(resultado, tempo_ms=round((time.time() - inicio) * 1000, 2)))
+
+@app.route("/cancelar", methods=["POST"])
+def cancelar():
+    """Cancela o turno em andamento da sessão (a geração no Ollama é abortada)."""
+    data = request.get_json(silent=True) or {}
+    if turnos.cancelar(sessao_requisicao(data)):
+        return jsonify({"status": "ok", "mensagem": "Geração cancelada."})
+    return jsonify({"status": "erro", "mensagem": "Nenhuma geração em andamento para esta sessão."})
 
 @app.route("/mudar_modelo", methods=["POST"])
 def mudar_modelo():
-    """Permite mudar para outro modelo já disponível localmente."""
+    """Permite mudar para outro modelo já disponível localmente, ou "auto" para roteamento por complexidade."""
     modelo = request.json.get("modelo")
     modelos = carregar_modelos()
+    if modelo == "auto":
+        if not modelos:
+            return jsonify({"status": "erro", "mensagem": "Nenhum modelo instalado para o roteamento automático."}), 400
+        # O modelo atual continua como reserva caso o catálogo não saiba o tamanho dos modelos
+        if sessao["modelo"] not in modelos:
+            sessao["modelo"] = modelos[0]
+        sessao["roteamento"] = True
+        return jsonify({"status": "ok", "modelo": "auto"})
     if modelo in modelos:
         sessao["modelo"] = modelo
+        sessao["roteamento"] = False
+        gerenciador_modelos.aquecer(modelo, prompt_sistema(sessao["personalidade"]))
         return jsonify({"status": "ok", "modelo": modelo})
+    catalogo.atualizar_em_segundo_plano()  # modelo recém-baixado aparece na próxima tentativa
     return jsonify({"status": "erro", "mensagem": "Modelo não encontrado localmente."})
 
 @app.route("/mudar_personalidade", methods=["POST"])
 def mudar_personalidade():
     """Muda para outra personalidade disponível."""
     nome = request.json.get("personalidade")
-    if os.path.exists(os.path.join(PERSONALIDADES_DIR, f"{nome}.json")):
+    if personas.existe(nome):
         sessao["personalidade"] = nome
+        gerenciador_modelos.aquecer(sessao["modelo"], prompt_sistema(nome))
         return jsonify({"status": "ok", "personalidade": nome})
     return jsonify({"status": "erro", "mensagem": "Personalidade não encontrada."})
 
 @app.route("/listar_modelos")
 def listar_modelos():
     """Lista os modelos locais disponíveis."""
-    return jsonify({"modelos": carregar_modelos()})
+    return jsonify({"modelos": carregar_modelos(), "detalhes": catalogo.todos()})
 
 @app.route("/listar_personalidades")
 def listar_personalidades():
     """Lista personalidades disponíveis."""
-    arquivos = [f[:-5] for f in os.listdir(PERSONALIDADES_DIR) if f.endswith(".json")]
-    return jsonify({"personalidades": arquivos})
+    return jsonify({"personalidades": personas.nomes()})
 
 @app.route("/ajustar_parametro", methods=["POST"])
 def ajustar_parametro():
@@ -174,7 +717,11 @@ def ajustar_parametro():
 def resetar_memoria():
     """Reseta o histórico da conversa atual."""
     sessao["historico"] = []
+    sessao.pop("resumo", None)
+    sessao.pop("resumo_mensagens", None)
+    armazem_sessoes.reiniciar(sessao["id"])
     memoria.reset()
+    cache_respostas.limpar()
     return jsonify({"status": "ok", "mensagem": "Histórico resetado."})
 
 @app.route("/status", methods=["GET"])
@@ -184,20 +731,118 @@ def status():
         "modelo": sessao.get("modelo"),
         "personalidade": sessao.get("personalidade"),
         "historico_mensagens": len(sessao.get("historico", [])),
-        "parametros": sessao_config
+        "mensagens_resumidas": sessao.get("resumo_mensagens", 0),
+        "parametros": sessao_config,
+        "modelos_carregados": gerenciador_modelos.estado(),
+        "cache_respostas": cache_respostas.estado(),
+        "coalescencia": cliente_ollama.coalescedor.estado(),
+        "backends": pool_backends.estado(),
+        "geracoes": cliente_ollama.estado(),
+        "agendador": agendador.estado(),
+        "degradacao": degradacao.estado(),
+        "roteamento": dict(roteador.estado(), ativo=sessao.get("roteamento", False)),
+        "busca": indice_conversas.estado(),
+        "calibracao_tokens": calibracao_tokens.estado()
     })
 
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    """Métricas no formato texto do Prometheus (histogramas por etapa, tokens, cache)."""
+    return Response(metricas.texto(), mimetype="text/plain; version=0.0.4")
+
+def somar_por(contador, indice_rotulo):
+    """Soma as séries de um contador agrupando por um dos rótulos (ex.: por modelo)."""
+    totais = {}
+    for rotulos, valor in contador.valores().items():
+        totais[rotulos[indice_rotulo]] = totais.get(rotulos[indice_rotulo], 0) + valor
+    return totais
+
+@app.route("/admin/estado", methods=["GET"])
+def admin_estado():
+    """Resumo ao vivo do servidor: sessão, latências por etapa (p50/p95/p99), tokens, cache e filas."""
+    cache = somar_por(CACHE, 2)
+    consultas = sum(cache.values())
+    return jsonify({
+        "sessao": {
+            "id": sessao.get("id"),
+            "modelo": sessao.get("modelo"),
+            "personalidade": sessao.get("personalidade"),
+            "mensagens": len(sessao.get("historico", []))
+        },
+        "uptime_s": round(time.time() - metricas.inicio, 1),
+        "etapas": ETAPAS.resumo(),
+        "turnos": TURNOS.resumo(),
+        "turnos_por_status": somar_por(TURNOS_TOTAL, 2),
+        "tokens": {
+            "entrada_por_modelo": somar_por(TOKENS_ENTRADA, 0),
+            "saida_por_modelo": somar_por(TOKENS_SAIDA, 0),
+            "saida_por_persona": somar_por(TOKENS_SAIDA, 1)
+        },
+        "cache": dict(cache, taxa_acerto=round(cache.get("acerto", 0) / consultas, 3) if consultas else None),
+        "agendador": agendador.estado(),
+        "degradacao": degradacao.estado(),
+        "backends": pool_backends.estado(),
+        "geracoes": cliente_ollama.estado(),
+        "conversas_salvas": len(armazem_sessoes.listar()),
+        "rastreamento": rastreador.estado()
+    })
+
+@app.route("/admin/rastros", methods=["GET"])
+def admin_rastros():
+    """Os turnos mais lentos, com os spans de cada etapa (?limite=N)."""
+    try:
+        limite = int(request.args.get("limite")) if request.args.get("limite") else None
+    except ValueError:
+        return jsonify({"status": "erro", "mensagem": "limite deve ser um número."}), 400
+    return jsonify({"rastreamento": rastreador.estado(), "rastros": rastreador.mais_lentos(limite)})
+
+@app.route("/admin/rastros/<trace_id>", methods=["GET"])
+def admin_rastro(trace_id):
+    """Um rastro recente pelo trace id devolvido no cabeçalho X-Trace-Id."""
+    rastro = rastreador.buscar(trace_id.lower())
+    if rastro is None:
+        return jsonify({"status": "erro", "mensagem": "Rastro não encontrado."}), 404
+    return jsonify(rastro)
+
 @app.route("/salvar")
 def salvar():
-    """Salva a sessão atual."""
+    """Salva a sessão atual (também salva automaticamente a cada SESSOES_AUTOSAVE_S segundos)."""
+    arquivo = salvar_conversa()
+    if arquivo is None:
+        return jsonify({"status": "erro", "mensagem": "Falha ao salvar a sessão."}), 500
+    return jsonify({"status": "salvo", "arquivo": arquivo})
+
+@app.route("/conversas")
+def conversas():
+    """Catálogo das sessões salvas (id, título, modelo, persona, tamanho, atualizado_em)."""
+    return jsonify({"conversas": armazem_sessoes.listar()})
+
+@app.route("/carregar", methods=["POST"])
+def carregar():
+    """Troca a sessão atual por uma sessão salva ({"id": ...})."""
+    sessao_id = (request.get_json(silent=True) or {}).get("id")
+    if not sessao_id or os.path.basename(sessao_id) != sessao_id:
+        return jsonify({"status": "erro", "mensagem": "Informe o id da sessão."}), 400
     salvar_conversa()
-    return jsonify({"status": "salvo", "arquivo": f"{sessao['id']}.json"})
+    dados = armazem_sessoes.carregar(sessao_id)
+    if dados is None:
+        return jsonify({"status": "erro", "mensagem": "Sessão não encontrada."}), 404
+    for chave in ("resumo", "resumo_mensagens"):
+        sessao.pop(chave, None)
+    sessao.update({chave: valor for chave, valor in dados.items() if valor is not None})
+    memoria.reset()
+    cache_respostas.limpar()
+    return jsonify({"status": "ok", "id": sessao_id, "historico_mensagens": len(sessao["historico"])})
 
 @app.route("/resumir")
 def resumir():
     """Gera um resumo da conversa atual."""
-    resumo = "\n".join([x["content"] for x in sessao["historico"] if x["role"] == "assistant"])
-    return jsonify({"resumo": resumo[:1000]})
+    try:
+        resumo = resumidor.resumir(sessao)
+    except Exception as e:
+        print(f"[ERRO] Resumir conversa: {e}")
+        resumo = None
+    return jsonify({"resumo": resumo or sessao.get("resumo", "")})
 
 @app.route("/sair")
 def sair():
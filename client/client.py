@@ -1,8 +1,11 @@
 import requests
 import json
+import uuid
 
 SERVIDOR_URL = "http://192.168.0.36:5000"
+SESSAO_ID = str(uuid.uuid4())  # identifica este cliente para o servidor (fila justa e /cancelar)
 modo_admin = False
+modo_progressivo = False  # rascunho rápido de um modelo pequeno, trocado pela resposta completa
 
 def print_menu():
     print("""Comandos:
@@ -10,32 +13,74 @@ def print_menu():
     /mudar_personalidade
     /listar_modelos
     /listar_personas
+    /comparar → Mesma pergunta para várias personas/modelos
     /salvar
     /resumir
+    /conversas → Sessões salvas
     /carregar
     /sair
     !admin → Ativar modo avançado
     !estado → Mostrar sessão
+    !progressivo → Rascunho rápido antes da resposta completa
     """)
 
 def enviar(msg):
-    global modo_admin
+    global modo_admin, modo_progressivo
     if msg.strip() == "!admin":
         modo_admin = not modo_admin
         print("🔒 Modo Admin:", "ATIVADO" if modo_admin else "DESATIVADO")
         return
+    if msg.strip() == "!progressivo":
+        modo_progressivo = not modo_progressivo
+        print("⚡ Modo progressivo:", "ATIVADO" if modo_progressivo else "DESATIVADO")
+        return
     if modo_admin and msg.startswith("!estado"):
         r = requests.get(f"{SERVIDOR_URL}/admin/estado")
         print(json.dumps(r.json(), indent=2, ensure_ascii=False))
         return
 
-    resposta = requests.post(f"{SERVIDOR_URL}/conversar", json={"mensagem": msg})
+    try:
+        if modo_progressivo:
+            enviar_progressivo(msg)
+            return
+        resposta = requests.post(f"{SERVIDOR_URL}/conversar", json={"mensagem": msg, "sessao_id": SESSAO_ID})
+    except KeyboardInterrupt:
+        # Ctrl-C durante a geração: pede ao servidor para abortar em vez de esperar a resposta
+        try:
+            requests.post(f"{SERVIDOR_URL}/cancelar", json={"sessao_id": SESSAO_ID}, timeout=5)
+        except requests.RequestException as e:
+            print("\n[ERRO Cancelar]:", str(e))
+        print("\n[IA]: (geração cancelada)")
+        return
     if resposta.status_code == 200:
         print("[IA]:", resposta.json().get("resposta", "(sem resposta)"))
     else:
         print("[ERRO]:", resposta.text)
 
 
+def enviar_progressivo(msg):
+    """Mostra o rascunho enquanto chega e depois o substitui pela resposta completa."""
+    resposta = requests.post(f"{SERVIDOR_URL}/conversar", stream=True,
+                             json={"mensagem": msg, "sessao_id": SESSAO_ID, "progressivo": True})
+    rascunho = False
+    for linha in resposta.iter_lines(chunk_size=None):
+        if not linha:
+            continue
+        evento = json.loads(linha)
+        if evento["tipo"] == "rascunho":
+            if not rascunho:
+                print("[IA rascunho]: ", end="")
+                rascunho = True
+            print(evento["texto"], end="", flush=True)
+        elif evento["tipo"] == "final":
+            if rascunho:
+                print()
+            if evento.get("status_http") == 200:
+                print("[IA]:", evento.get("resposta", "(sem resposta)"))
+            else:
+                print("[ERRO]:", evento.get("mensagem") or evento.get("motivo"))
+
+
 def ajustar_parametro(param, valor):
     """
     Função do CLIENTE.
@@ -92,10 +137,40 @@ def main():
                     r = requests.get(f"{SERVIDOR_URL}/listar_personalidades")
                     print(r.json())
 
+                elif comando == "comparar":
+                    nomes = [p.strip() for p in input("Personas (separadas por vírgula): ").split(",") if p.strip()]
+                    modelos = [m.strip() for m in input("Modelos (vazio = atual): ").split(",") if m.strip()]
+                    pergunta = input("Pergunta: ")
+                    r = requests.post(f"{SERVIDOR_URL}/conversar_multi", stream=True,
+                                      json={"mensagem": pergunta, "personas": nomes, "modelos": modelos,
+                                            "sessao_id": SESSAO_ID})
+                    for linha in r.iter_lines(chunk_size=None):
+                        if not linha:
+                            continue
+                        evento = json.loads(linha)
+                        if evento.get("tipo") == "fim":
+                            print(f"(total: {evento['total_s']}s)")
+                        elif "persona" in evento:
+                            print(f"[{evento['persona']} | {evento['modelo']} | {evento['tempo_s']}s]:",
+                                  evento.get("resposta") or evento.get("mensagem"))
+                        else:
+                            print(evento)
+
                 elif comando == "salvar":
                     r = requests.get(f"{SERVIDOR_URL}/salvar")
                     print(r.json())
 
+                elif comando == "conversas":
+                    r = requests.get(f"{SERVIDOR_URL}/conversas")
+                    for c in r.json().get("conversas", []):
+                        print(f"{c['id']} | {c.get('titulo') or '(sem título)'} | {c.get('personalidade')} | "
+                              f"{c.get('modelo')} | {c.get('mensagens')} mensagens")
+
+                elif comando == "carregar":
+                    sessao_id = input("Id da sessão: ").strip()
+                    r = requests.post(f"{SERVIDOR_URL}/carregar", json={"id": sessao_id})
+                    print(r.json())
+
                 elif comando == "resumir":
                     r = requests.get(f"{SERVIDOR_URL}/resumir")
                     print(r.json())
@@ -1,5 +1,10 @@
 # config.py
-OLLAMA_ENDPOINT = "http://localhost:11434/api/generate"
+OLLAMA_HOST = "http://localhost:11434"
+
+# Backends Ollama (vários hosts/portas dividem a carga)
+OLLAMA_BACKENDS = [OLLAMA_HOST]
+BACKENDS_INTERVALO_SAUDE = 5         # Segundos entre health checks
+BACKENDS_FALHAS_PARA_EJETAR = 3      # Falhas consecutivas até tirar o backend do rodízio
 
 DEFAULT_SESSAO_CONFIG = {
     "temperature": 0.7,
@@ -7,5 +12,98 @@ DEFAULT_SESSAO_CONFIG = {
     "top_k": 50,
     "repeat_penalty": 1.1,
     "num_predict": 400,
+    "num_ctx": 4096,
     "max_historico": 10
-}
\ No newline at end of file
+}
+
+# Residência de modelos no Ollama
+MODELO_PADRAO = None                 # Modelo carregado na inicialização (None = nenhum)
+MODELOS_PRECARREGAR = []             # Modelos extras aquecidos na inicialização
+KEEP_ALIVE_QUENTE = "30m"            # Tempo que um modelo em uso permanece carregado
+ORCAMENTO_MEMORIA_MODELOS = 12 * 1024 ** 3  # Bytes de VRAM/RAM disponíveis para modelos residentes
+MODELOS_INTERVALO_SINCRONIA = 5      # Segundos mínimos entre consultas ao /api/ps após gerações que carregaram modelo
+
+# Catálogo de modelos (/api/tags)
+CATALOGO_TTL = 60                    # Segundos até o catálogo ser considerado desatualizado
+CATALOGO_RETENTATIVA_S = 5           # Com o catálogo vazio, intervalo mínimo entre consultas síncronas ao /api/tags
+
+# Personalidades
+PERSONALIDADE_PADRAO = {"system": "Você é um assistente útil."}
+PERSONAS_INTERVALO_RECARGA = 2       # Segundos entre verificações de mudança nos arquivos
+FEWSHOT_K = 2                        # Exemplos de conversa da persona injetados por turno
+FEWSHOT_MAX_TOKENS = 256             # Tokens máximos somando os exemplos injetados
+
+# Montagem de contexto
+TOKENIZADOR = None                   # Tokenizador HuggingFace para contagem (None = estimativa)
+CALIBRACAO_TOKENS_ALFA = 0.2         # Peso de cada prompt_eval_count do Ollama na calibração por modelo
+CONTEXTO_MARGEM_TOKENS = 64          # Folga para o template do modelo e separadores
+CONTEXTO_FRACAO_MEMORIAS = 0.25      # Fração máxima do orçamento ocupada por memórias recuperadas
+CONTEXTO_MENSAGENS_RECENTES = 2      # Mensagens mais recentes com prioridade sobre as memórias
+
+# Resumo incremental do histórico
+MODELO_RESUMO = None                 # Modelo barato para resumir (None = modelo da sessão)
+RESUMO_LIMIAR_TOKENS = 1500          # Tokens de histórico que disparam a compactação
+RESUMO_MANTER_TOKENS = 600           # Tokens das mensagens mais recentes mantidas sem resumo
+RESUMO_MAX_TOKENS = 300              # Tamanho máximo do resumo gerado
+HISTORICO_MAX_MENSAGENS = 100        # Limite duro do histórico se a compactação falhar (pares mais antigos saem)
+
+# Cache de respostas do /conversar
+CACHE_MAX_ITENS = 1000               # Entradas mantidas (LRU)
+CACHE_TTL = 3600                     # Segundos de validade de uma resposta em cache
+CACHE_SEMANTICO = True               # Reutiliza respostas de perguntas quase idênticas
+CACHE_LIMIAR_SIMILARIDADE = 0.95     # Similaridade de cosseno mínima para o acerto semântico
+CACHE_TEMPERATURA_MAX = 0.8          # Acima disso a geração é criativa demais para reaproveitar
+CACHE_JANELA_CONTEXTO = 20           # Últimas mensagens que entram na assinatura de contexto da chave
+CACHE_RAZAO_TAMANHO = 0.8            # Acerto semântico exige perguntas de tamanho parecido (menor/maior)
+
+# Hedging e disjuntor (circuit breaker) das gerações
+HEDGE_ATIVO = True                   # Dispara cópia da geração em outro backend quando a primeira demora
+HEDGE_PERCENTIL = 0.95               # Percentil de latência usado como atraso do hedge
+HEDGE_MIN_AMOSTRAS = 20              # Amostras de latência necessárias antes de fazer hedge
+HEDGE_ATRASO_MIN = 0.5               # Atraso mínimo (s) antes do hedge
+DISJUNTOR_FALHAS = 5                 # Falhas consecutivas que abrem o circuito de um backend
+DISJUNTOR_TEMPO_ABERTO = 30          # Segundos com o circuito aberto antes de uma tentativa de teste
+
+# Prazo padrão de um turno do /conversar (segundos); o cliente pode enviar prazo_s
+PRAZO_PADRAO_S = 120
+
+# Agendador de gerações (controle de admissão)
+AGENDADOR_SLOTS_POR_MODELO = 4       # Gerações simultâneas por modelo (soma do OLLAMA_NUM_PARALLEL dos backends)
+AGENDADOR_FILA_MAX = 32              # Requisições aguardando por modelo antes de responder 429
+AGENDADOR_ESPERA_MAX = 60            # Segundos máximos na fila
+AGENDADOR_QUANTUM = 1024             # Tokens creditados por rodada a cada sessão (deficit round robin)
+
+# Degradação sob carga (SLO de latência)
+DEGRADACAO_ATIVA = True
+SLO_LATENCIA_P99_S = 20              # Meta de p99 da latência de um turno
+DEGRADACAO_LIMIARES_FILA = (0.5, 1.0, 2.0)  # Requisições na fila por slot para os níveis 1, 2 e 3
+MODELO_DEGRADADO = None              # Modelo usado no nível 3 (None = menor modelo do catálogo)
+
+# Roteamento automático de modelos por complexidade
+ROTEAMENTO_AUTOMATICO = False        # Ativado também com /mudar_modelo {"modelo": "auto"}
+ROTEAMENTO_LIMIARES = (0.2, 0.45)    # Pontuação que leva às rotas "media" e "complexa"
+
+# Respostas progressivas (rascunho rápido + resposta completa)
+MODELO_RASCUNHO = None               # Modelo do rascunho (None = menor modelo do catálogo)
+RASCUNHO_MAX_TOKENS = 150            # Limite de tokens do rascunho
+
+# Comparação de personas/modelos (/conversar_multi)
+MULTI_MAX_GERACOES = 8               # Máximo de combinações persona x modelo por requisição
+
+# Jobs em lote (/lotes)
+LOTES_CONCORRENCIA = 2               # Itens gerados em paralelo por lote (padrão)
+LOTES_MAX_CONCORRENCIA = 8           # Limite da concorrência pedida pelo cliente
+
+# Busca nas conversas salvas (/buscar_conversas)
+BUSCA_LIMITE_PADRAO = 20             # Resultados por página
+BUSCA_LIMITE_MAX = 100               # Limite pedido pelo cliente
+
+# Persistência das sessões (logs só de acréscimos em dados/conversas_salvas)
+SESSOES_COMPRESSAO = None            # "zstd" para comprimir os logs (requer o pacote zstandard)
+SESSOES_AUTOSAVE_S = 5               # Intervalo do salvamento automático de sessões alteradas
+
+# Rastreamento dos turnos (cabeçalho X-Trace-Id e /admin/rastros)
+RASTREAMENTO_ATIVO = True
+RASTREAMENTO_LENTOS = 20             # Rastros mais lentos mantidos em memória
+RASTREAMENTO_RECENTES = 200          # Rastros recentes consultáveis pelo trace id
+RASTREAMENTO_EXPORTAR = None         # Arquivo para anexar cada rastro em JSON OTLP (None = não exporta)
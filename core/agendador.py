@@ -0,0 +1,196 @@
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+
+from config.config import (AGENDADOR_SLOTS_POR_MODELO, AGENDADOR_FILA_MAX,
+                           AGENDADOR_ESPERA_MAX, AGENDADOR_QUANTUM)
+from core.backends import JanelaLatencias
+from core.cancelamento import GeracaoCancelada
+from utils.metricas import ETAPAS
+from utils.rastreamento import rastreador
+
+PRIORIDADES = ("interativo", "lote")
+
+
+class FilaCheia(Exception):
+    """A fila do modelo está cheia (ou a espera expirou); o cliente deve tentar depois."""
+
+    def __init__(self, mensagem, retry_after):
+        super().__init__(mensagem)
+        self.retry_after = retry_after
+
+
+class _Ticket:
+    def __init__(self, sessao, prioridade, custo):
+        self.sessao = sessao
+        self.prioridade = prioridade
+        self.custo = custo
+        self.evento = threading.Event()
+        self.concedido = False
+        self.criado_em = time.time()
+
+
+class _EstadoModelo:
+    def __init__(self, slots):
+        self.slots = slots
+        self.ativos = 0
+        self.filas = {p: OrderedDict() for p in PRIORIDADES}  # prioridade -> sessao -> deque de tickets
+        self.deficits = {}
+        self.duracoes = deque(maxlen=50)
+
+    def aguardando(self):
+        return sum(len(d) for fila in self.filas.values() for d in fila.values())
+
+
+class Agendador:
+    def __init__(self, slots_por_modelo=AGENDADOR_SLOTS_POR_MODELO, fila_max=AGENDADOR_FILA_MAX,
+                 espera_max=AGENDADOR_ESPERA_MAX, quantum=AGENDADOR_QUANTUM):
+        """
+        Controle de admissão das gerações: cada modelo tem um número limitado
+        de slots e uma fila limitada. Os slots livres vão primeiro para a
+        prioridade interativa e, dentro de cada prioridade, são repartidos
+        entre sessões por deficit round robin ponderado pelo custo em tokens.
+
+        :param slots_por_modelo: Gerações simultâneas por modelo.
+        :param fila_max: Máximo de requisições aguardando por modelo.
+        :param espera_max: Segundos máximos de espera na fila.
+        :param quantum: Tokens creditados a uma sessão a cada rodada.
+        """
+        self.slots_por_modelo = slots_por_modelo
+        self.fila_max = fila_max
+        self.espera_max = espera_max
+        self.quantum = quantum
+        self.modelos = {}
+        self.esperas = JanelaLatencias()
+        self.estatisticas = {"admitidas": 0, "rejeitadas": 0, "expiradas": 0, "canceladas": 0}
+        self._lock = threading.Lock()
+
+    def _modelo(self, modelo):
+        if modelo not in self.modelos:
+            self.modelos[modelo] = _EstadoModelo(self.slots_por_modelo)
+        return self.modelos[modelo]
+
+    @contextmanager
+    def slot(self, modelo, sessao, prioridade="interativo", custo=1, espera_max=None, cancelamento=None):
+        """Ocupa um slot de geração do modelo durante o bloco (espera na fila se necessário)."""
+        ticket = self.adquirir(modelo, sessao, prioridade, custo, espera_max, cancelamento)
+        inicio = time.time()
+        try:
+            yield ticket
+        finally:
+            self.liberar(modelo, time.time() - inicio)
+
+    def adquirir(self, modelo, sessao, prioridade="interativo", custo=1, espera_max=None, cancelamento=None,
+                 intervalo=0.1):
+        """
+        Espera um slot do modelo. A espera nunca passa de self.espera_max, nem de
+        espera_max ou do prazo do cancelamento, se vierem.
+
+        :param cancelamento: Cancelamento da requisição; se disparar durante a espera o
+            ticket sai da fila e levanta GeracaoCancelada (verificado a cada intervalo).
+        :raises FilaCheia: Fila cheia ou espera esgotada.
+        """
+        if prioridade not in PRIORIDADES:
+            prioridade = PRIORIDADES[0]
+        ticket = _Ticket(sessao, prioridade, max(1, int(custo)))
+        with self._lock:
+            estado = self._modelo(modelo)
+            if estado.ativos < estado.slots and not estado.aguardando():
+                estado.ativos += 1
+                ticket.concedido = True
+            elif estado.aguardando() >= self.fila_max:
+                self.estatisticas["rejeitadas"] += 1
+                raise FilaCheia("Fila de geração cheia.", self._retry_after(estado))
+            else:
+                estado.filas[prioridade].setdefault(sessao, deque()).append(ticket)
+
+        if not ticket.concedido:
+            limites = [self.espera_max, espera_max, cancelamento.restante() if cancelamento else None]
+            fim = time.time() + min(l for l in limites if l is not None)
+            while not ticket.evento.is_set():
+                restante = fim - time.time()
+                if restante <= 0 or (cancelamento is not None and cancelamento.cancelado):
+                    break
+                ticket.evento.wait(min(restante, intervalo) if cancelamento is not None else restante)
+            with self._lock:
+                if not ticket.concedido:
+                    self._remover(estado, ticket)
+                    # Prazo da requisição vencido na fila também é cancelamento (504, não 429)
+                    if cancelamento is not None and cancelamento.cancelado:
+                        self.estatisticas["canceladas"] += 1
+                        raise GeracaoCancelada(f"Geração cancelada na fila ({cancelamento.motivo}).")
+                    self.estatisticas["expiradas"] += 1
+                    raise FilaCheia("Tempo de espera na fila esgotado.", self._retry_after(estado))
+
+        with self._lock:
+            self.estatisticas["admitidas"] += 1
+        espera = time.time() - ticket.criado_em
+        self.esperas.registrar(prioridade, espera)
+        ETAPAS.observar(espera, "fila")
+        rastreador.registrar("agendador.fila", espera, modelo=modelo, prioridade=prioridade)
+        return ticket
+
+    def liberar(self, modelo, duracao=None):
+        with self._lock:
+            estado = self._modelo(modelo)
+            estado.ativos -= 1
+            if duracao is not None:
+                estado.duracoes.append(duracao)
+            self._despachar(estado)
+
+    def _despachar(self, estado):
+        while estado.ativos < estado.slots:
+            ticket = self._proximo(estado)
+            if ticket is None:
+                return
+            estado.ativos += 1
+            ticket.concedido = True
+            ticket.evento.set()
+
+    def _proximo(self, estado):
+        """Deficit round robin entre as sessões da prioridade mais alta com fila."""
+        for prioridade in PRIORIDADES:
+            fila = estado.filas[prioridade]
+            while fila:
+                sessao, tickets = next(iter(fila.items()))
+                ticket = tickets[0]
+                if estado.deficits.get(sessao, 0) >= ticket.custo:
+                    estado.deficits[sessao] -= ticket.custo
+                    tickets.popleft()
+                    if not tickets:
+                        del fila[sessao]
+                        estado.deficits.pop(sessao, None)
+                    return ticket
+                estado.deficits[sessao] = estado.deficits.get(sessao, 0) + self.quantum
+                fila.move_to_end(sessao)
+        return None
+
+    def _remover(self, estado, ticket):
+        fila = estado.filas[ticket.prioridade]
+        tickets = fila.get(ticket.sessao)
+        if tickets and ticket in tickets:
+            tickets.remove(ticket)
+            if not tickets:
+                del fila[ticket.sessao]
+                estado.deficits.pop(ticket.sessao, None)
+
+    def _retry_after(self, estado):
+        """Estimativa (s) de quando haverá vaga: fila / slots x duração média."""
+        media = sum(estado.duracoes) / len(estado.duracoes) if estado.duracoes else 5
+        return max(1, int(media * (estado.aguardando() + 1) / estado.slots))
+
+    def carga(self, modelo):
+        """Ocupação atual do modelo: (ativos, aguardando, slots)."""
+        with self._lock:
+            estado = self._modelo(modelo)
+            return estado.ativos, estado.aguardando(), estado.slots
+
+    def estado(self):
+        with self._lock:
+            modelos = {m: {"ativos": e.ativos, "slots": e.slots, "aguardando": e.aguardando()}
+                       for m, e in self.modelos.items()}
+            estatisticas = dict(self.estatisticas)
+        esperas = {p: {"p50": self.esperas.percentil(p, 0.5), "p95": self.esperas.percentil(p, 0.95)}
+                   for p in PRIORIDADES}
+        return {**estatisticas, "modelos": modelos, "espera_fila_s": esperas}
@@ -0,0 +1,350 @@
+import os
+import threading
+import time
+
+from config.config import SESSOES_COMPRESSAO, SESSOES_AUTOSAVE_S
+from utils.json_files import EscritorNDJSON, carregar_json, linha_ndjson, loads
+from utils.metricas import ETAPAS
+from utils.rastreamento import rastreador
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+CAMPOS_META = ("modelo", "personalidade", "resumo", "resumo_mensagens")
+MAGICO_ZSTD = b"\x28\xb5\x2f\xfd"
+
+
+def frames_zstd(dados, bloco=64 * 1024):
+    """
+    Frames zstd completos de um log, como (fim, conteúdo). Um frame inválido
+    (gravação interrompida) é pulado até o próximo número mágico; um frame
+    final incompleto é ignorado.
+
+    Cada frame é alimentado em blocos de uma memoryview: passar o resto do log
+    inteiro a cada frame copiaria os dados de novo por frame (O(n²)).
+    """
+    visao = memoryview(dados)
+    posicao = 0
+    while posicao < len(dados):
+        descompressor = zstandard.ZstdDecompressor().decompressobj()
+        partes, lido = [], posicao
+        try:
+            while not descompressor.eof and lido < len(dados):
+                partes.append(descompressor.decompress(visao[lido:lido + bloco]))
+                lido = min(lido + bloco, len(dados))
+        except zstandard.ZstdError:
+            pass
+        if descompressor.eof:
+            posicao = lido - len(descompressor.unused_data)
+            yield posicao, b"".join(partes)
+            continue
+        proximo = dados.find(MAGICO_ZSTD, posicao + 1)
+        if proximo < 0:
+            return
+        posicao = proximo
+
+
+class ArmazemSessoes:
+    def __init__(self, diretorio, compressao=SESSOES_COMPRESSAO, intervalo=SESSOES_AUTOSAVE_S):
+        """
+        Persistência incremental das sessões.
+
+        Cada sessão é um log só de acréscimos (<id>.log, ou <id>.log.zst com
+        compressão): uma linha JSON por evento ("inicio", "mensagens",
+        "reinicio", "meta"). Salvar grava apenas os eventos novos desde o último
+        salvamento, em vez de reescrever a conversa inteira. O log guarda todas
+        as mensagens; as que o resumidor compactou são descartadas do histórico
+        ao carregar, conforme "resumo_mensagens".
+
+        catalogo.jsonl indexa as sessões (id, título, modelo, persona, tamanho,
+        atualizado_em): também é só de acréscimos (a última linha de cada id
+        vale), fica em memória e é compactado quando acumula linhas repetidas.
+
+        :param diretorio: Pasta das conversas salvas (a mesma dos JSON antigos, que continuam legíveis).
+        :param compressao: None ou "zstd" (requer o pacote zstandard).
+        :param intervalo: Segundos entre salvamentos automáticos de sessões alteradas.
+        """
+        if compressao == "zstd" and zstandard is None:
+            print("[ERRO] Compressão zstd indisponível (pip install zstandard), salvando sem compressão")
+            compressao = None
+        self.diretorio = diretorio
+        self.compressao = compressao
+        self.intervalo = intervalo
+        self._pendentes = {}       # sessao_id -> eventos ainda não gravados
+        self._meta = {}            # sessao_id -> último bloco "meta" gravado
+        self._titulos = {}         # sessao_id -> primeira pergunta (título no catálogo)
+        self._importadas = set()   # sessões vindas de JSON antigo, ainda não convertidas para log
+        self._verificados = set()  # logs cuja cauda já foi conferida neste processo
+        self._lock = threading.Lock()
+        self._lock_catalogo = threading.Lock()
+        os.makedirs(diretorio, exist_ok=True)
+        self.catalogo = {}
+        self._linhas_catalogo = 0
+        self._carregar_catalogo()
+
+    def acrescentar(self, sessao_id, mensagens):
+        """Marca mensagens novas da sessão para o próximo salvamento."""
+        mensagens = [{"role": m["role"], "content": m["content"]} for m in mensagens]
+        with self._lock:
+            self._pendentes.setdefault(sessao_id, []).append({"tipo": "mensagens", "mensagens": mensagens})
+            if sessao_id not in self._titulos and not self.catalogo.get(sessao_id, {}).get("titulo"):
+                primeira = next((m["content"] for m in mensagens if m["role"] == "user"), None)
+                if primeira:
+                    self._titulos[sessao_id] = primeira[:60]
+
+    def reiniciar(self, sessao_id):
+        """Histórico da sessão foi apagado (/resetar_memoria)."""
+        with self._lock:
+            self._pendentes.setdefault(sessao_id, []).append({"tipo": "reinicio", "em": time.time()})
+
+    def alterada(self, sessao):
+        meta = {c: sessao.get(c) for c in CAMPOS_META}
+        with self._lock:
+            return bool(self._pendentes.get(sessao["id"])) or meta != self._meta.get(sessao["id"])
+
+    def gravar(self, sessao):
+        """
+        Acrescenta ao log os eventos pendentes e, se mudou, o bloco de metadados.
+        Não faz nada se a sessão não foi alterada. Retorna o nome do arquivo do log.
+        """
+        sessao_id = sessao["id"]
+        caminho = self._caminho_log(sessao_id)
+        meta = {c: sessao.get(c) for c in CAMPOS_META}
+        with self._lock:
+            eventos = self._pendentes.pop(sessao_id, [])
+            if meta != self._meta.get(sessao_id):
+                eventos.append(dict(meta, tipo="meta"))
+            if not eventos:
+                return os.path.basename(caminho)
+            if not os.path.exists(caminho):
+                # Um JSON antigo só tem as mensagens que o resumidor ainda não compactou
+                descartadas = (sessao.get("resumo_mensagens") or 0) if sessao_id in self._importadas else 0
+                eventos.insert(0, {"tipo": "inicio", "id": sessao_id, "criado_em": time.time(),
+                                   "descartadas": descartadas})
+                self._importadas.discard(sessao_id)
+            try:
+                with ETAPAS.cronometrar("persistencia"), rastreador.span("sessao.gravar", eventos=len(eventos)):
+                    self._acrescentar_log(caminho, eventos)
+            except OSError as e:
+                # Devolve os eventos para a próxima tentativa
+                self._pendentes[sessao_id] = eventos + self._pendentes.get(sessao_id, [])
+                print(f"[ERRO] Salvar sessão {sessao_id}: {e}")
+                return None
+            self._meta[sessao_id] = meta
+
+        anterior = self.catalogo.get(sessao_id, {})
+        mensagens = 0 if eventos[0]["tipo"] == "inicio" else anterior.get("mensagens", 0)
+        for evento in eventos:
+            if evento["tipo"] == "reinicio":
+                mensagens = 0
+            elif evento["tipo"] == "mensagens":
+                mensagens += len(evento["mensagens"])
+        self._atualizar_catalogo({
+            "id": sessao_id,
+            "titulo": anterior.get("titulo") or self._titulos.get(sessao_id),
+            "modelo": meta["modelo"],
+            "personalidade": meta["personalidade"],
+            "mensagens": mensagens,
+            "tamanho": os.path.getsize(caminho),
+            "arquivo": os.path.basename(caminho),
+            "atualizado_em": time.time(),
+        })
+        return os.path.basename(caminho)
+
+    def _acrescentar_log(self, caminho, eventos):
+        if caminho not in self._verificados:
+            self._reparar_cauda(caminho)
+            self._verificados.add(caminho)
+        dados = b"".join(linha_ndjson(e) for e in eventos)
+        if self.compressao == "zstd":
+            # Cada salvamento é um frame zstd independente; frames concatenados formam um stream válido
+            dados = zstandard.ZstdCompressor(level=3).compress(dados)
+        with open(caminho, "ab") as f:
+            f.write(dados)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _reparar_cauda(self, caminho):
+        """
+        Corta uma linha ou frame final incompleto (queda no meio de um salvamento)
+        antes do primeiro acréscimo: sem isso, os eventos novos se colariam na cauda
+        quebrada e seriam perdidos na leitura.
+        """
+        if not os.path.exists(caminho):
+            return
+        with open(caminho, "rb") as f:
+            dados = f.read()
+        if caminho.endswith(".zst"):
+            fim = 0
+            for fim, _ in frames_zstd(dados):
+                pass
+        else:
+            fim = dados.rfind(b"\n") + 1
+        if fim < len(dados):
+            print(f"[ERRO] Log {os.path.basename(caminho)} com final incompleto: "
+                  f"{len(dados) - fim} bytes descartados")
+            with open(caminho, "r+b") as f:
+                f.truncate(fim)
+                f.flush()
+                os.fsync(f.fileno())
+
+    def iniciar_autosave(self, obter_sessao):
+        """
+        Thread que salva a sessão atual a cada `intervalo` segundos, se houve alteração.
+
+        :param obter_sessao: Função sem argumentos que retorna o dict da sessão atual.
+        """
+        def _laco():
+            while True:
+                time.sleep(self.intervalo)
+                try:
+                    sessao = obter_sessao()
+                    if self.alterada(sessao):
+                        self.gravar(sessao)
+                except Exception as e:
+                    print(f"[ERRO] Salvamento automático: {e}")
+
+        threading.Thread(target=_laco, daemon=True).start()
+
+    def carregar(self, sessao_id):
+        """
+        Reconstrói a sessão a partir do log (ou do JSON antigo). Retorna None se não existir.
+        """
+        caminho = self._caminho_log(sessao_id, existente=True)
+        if caminho is None:
+            return self._carregar_json(sessao_id)
+
+        mensagens, meta, descartadas = [], {}, 0
+        for evento in self._ler_log(caminho):
+            tipo = evento.get("tipo")
+            if tipo == "inicio":
+                descartadas = evento.get("descartadas", 0)
+            elif tipo == "mensagens":
+                mensagens.extend(evento["mensagens"])
+            elif tipo == "reinicio":
+                mensagens, descartadas = [], 0
+            elif tipo == "meta":
+                meta = {c: evento.get(c) for c in CAMPOS_META}
+
+        resumidas = max(0, (meta.get("resumo_mensagens") or 0) - descartadas)
+        sessao = {"id": sessao_id, "modelo": meta.get("modelo"), "personalidade": meta.get("personalidade"),
+                  "historico": mensagens[resumidas:]}
+        if meta.get("resumo"):
+            sessao["resumo"] = meta["resumo"]
+        if meta.get("resumo_mensagens"):
+            sessao["resumo_mensagens"] = meta["resumo_mensagens"]
+        with self._lock:
+            self._meta[sessao_id] = {c: sessao.get(c) for c in CAMPOS_META}
+        return sessao
+
+    def _carregar_json(self, sessao_id):
+        caminho = os.path.join(self.diretorio, f"{sessao_id}.json")
+        if not os.path.exists(caminho):
+            return None
+        dados = carregar_json(caminho)
+        sessao = {c: dados.get(c) for c in ("id", "modelo", "personalidade", "historico")}
+        sessao["id"] = sessao_id
+        sessao["historico"] = sessao["historico"] or []
+        if dados.get("resumo"):
+            sessao["resumo"] = dados["resumo"]
+            sessao["resumo_mensagens"] = dados.get("resumo_mensagens", 0)
+        # O primeiro salvamento converte a sessão para log, com o histórico inteiro pendente
+        with self._lock:
+            self._importadas.add(sessao_id)
+        self.acrescentar(sessao_id, sessao["historico"])
+        return sessao
+
+    def _ler_log(self, caminho):
+        """Eventos do log; linhas ou frames truncados por queda são ignorados."""
+        with open(caminho, "rb") as f:
+            if caminho.endswith(".zst"):
+                linhas = (linha for _, conteudo in frames_zstd(f.read()) for linha in conteudo.splitlines())
+            else:
+                linhas = f
+            for linha in linhas:
+                try:
+                    yield loads(linha)
+                except ValueError:
+                    continue
+
+    def _caminho_log(self, sessao_id, existente=False):
+        """Log da sessão; com existente=True procura os dois formatos e retorna None se não houver."""
+        if existente:
+            for extensao in (".log.zst", ".log"):
+                caminho = os.path.join(self.diretorio, sessao_id + extensao)
+                if os.path.exists(caminho):
+                    return caminho
+            return None
+        return self._caminho_log(sessao_id, existente=True) or os.path.join(
+            self.diretorio, sessao_id + (".log.zst" if self.compressao == "zstd" else ".log"))
+
+    def listar(self):
+        """Sessões salvas, das atualizadas mais recentemente para as mais antigas."""
+        with self._lock_catalogo:
+            return sorted(self.catalogo.values(), key=lambda e: e.get("atualizado_em", 0), reverse=True)
+
+    def _atualizar_catalogo(self, entrada):
+        caminho = os.path.join(self.diretorio, "catalogo.jsonl")
+        with self._lock_catalogo:
+            self.catalogo[entrada["id"]] = entrada
+            with open(caminho, "ab") as f:
+                f.write(linha_ndjson(entrada))
+            self._linhas_catalogo += 1
+            if self._linhas_catalogo > 2 * len(self.catalogo) + 100:
+                self._compactar_catalogo()
+
+    def _compactar_catalogo(self):
+        """Reescreve o catálogo com uma linha por sessão (arquivo temporário + rename)."""
+        with EscritorNDJSON(os.path.join(self.diretorio, "catalogo.jsonl")) as saida:
+            for entrada in self.catalogo.values():
+                saida.escrever(entrada)
+        self._linhas_catalogo = len(self.catalogo)
+
+    def _carregar_catalogo(self):
+        caminho = os.path.join(self.diretorio, "catalogo.jsonl")
+        if not os.path.exists(caminho):
+            self._reconstruir_catalogo()
+            return
+        with open(caminho, "rb") as f:
+            for linha in f:
+                try:
+                    entrada = loads(linha)
+                except ValueError:
+                    continue
+                self.catalogo[entrada["id"]] = entrada
+                self._linhas_catalogo += 1
+
+    def _reconstruir_catalogo(self):
+        """Primeira execução: cataloga os logs e os JSON antigos já existentes no diretório."""
+        for nome in os.listdir(self.diretorio):
+            caminho = os.path.join(self.diretorio, nome)
+            if nome.endswith(".json"):
+                sessao_id = nome[:-len(".json")]
+                if self._caminho_log(sessao_id, existente=True):
+                    continue  # já convertida: o log é a versão atual
+                try:
+                    dados = carregar_json(caminho)
+                except (OSError, ValueError) as e:
+                    print(f"[ERRO] Catalogar conversa {nome}: {e}")
+                    continue
+            elif nome.endswith((".log", ".log.zst")):
+                sessao_id = nome.split(".log")[0]
+                dados = self.carregar(sessao_id)
+            else:
+                continue
+            historico = dados.get("historico") or []
+            primeira = next((m["content"] for m in historico if m.get("role") == "user"), None)
+            self.catalogo[sessao_id] = {
+                "id": sessao_id,
+                "titulo": primeira[:60] if primeira else None,
+                "modelo": dados.get("modelo"),
+                "personalidade": dados.get("personalidade"),
+                "mensagens": len(historico),
+                "tamanho": os.path.getsize(caminho),
+                "arquivo": nome,
+                "atualizado_em": os.path.getmtime(caminho),
+            }
+        with self._lock_catalogo:
+            self._compactar_catalogo()
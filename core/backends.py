@@ -0,0 +1,204 @@
+import itertools
+import threading
+import time
+from collections import defaultdict, deque
+from contextlib import contextmanager
+
+import requests
+
+from config.config import (OLLAMA_BACKENDS, BACKENDS_INTERVALO_SAUDE, BACKENDS_FALHAS_PARA_EJETAR,
+                           DISJUNTOR_FALHAS, DISJUNTOR_TEMPO_ABERTO)
+
+
+class SemBackendDisponivel(Exception):
+    """Nenhum backend Ollama saudável para atender a requisição."""
+
+
+class DisjuntorCircuito:
+    FECHADO, ABERTO, MEIO_ABERTO = "fechado", "aberto", "meio_aberto"
+
+    def __init__(self, limite_falhas=DISJUNTOR_FALHAS, tempo_aberto=DISJUNTOR_TEMPO_ABERTO):
+        """
+        Circuit breaker de um backend: após limite_falhas falhas seguidas o
+        circuito abre e o backend é evitado por tempo_aberto segundos; depois
+        disso uma única requisição de teste decide se ele volta. Um teste que
+        termina sem veredito (cancelado) só libera a vaga para o próximo.
+        """
+        self.limite_falhas = limite_falhas
+        self.tempo_aberto = tempo_aberto
+        self.estado = self.FECHADO
+        self.falhas = 0
+        self.aberto_em = None
+        self._testando = False
+
+    def disponivel(self):
+        if self.estado == self.ABERTO and time.time() - self.aberto_em >= self.tempo_aberto:
+            self.estado = self.MEIO_ABERTO
+            self._testando = False
+        if self.estado == self.MEIO_ABERTO:
+            return not self._testando
+        return self.estado == self.FECHADO
+
+    def iniciar_tentativa(self):
+        """Retorna True se esta requisição é o teste do circuito meio aberto."""
+        if self.estado == self.MEIO_ABERTO:
+            self._testando = True
+            return True
+        return False
+
+    def liberar(self):
+        """Fim de um teste sem veredito: o circuito continua meio aberto e aceita outro teste."""
+        if self.estado == self.MEIO_ABERTO:
+            self._testando = False
+
+    def sucesso(self):
+        self.estado = self.FECHADO
+        self.falhas = 0
+        self._testando = False
+
+    def falha(self):
+        self.falhas += 1
+        if self.estado == self.MEIO_ABERTO or self.falhas >= self.limite_falhas:
+            self.estado = self.ABERTO
+            self.aberto_em = time.time()
+            self._testando = False
+
+
+class JanelaLatencias:
+    def __init__(self, tamanho=200):
+        """Últimas latências por chave (ex.: modelo), para cálculo de percentis."""
+        self._amostras = defaultdict(lambda: deque(maxlen=tamanho))
+        self._lock = threading.Lock()
+
+    def registrar(self, chave, segundos):
+        with self._lock:
+            self._amostras[chave].append(segundos)
+
+    def percentil(self, chave, p, min_amostras=1):
+        with self._lock:
+            amostras = sorted(self._amostras.get(chave, ()))
+        if len(amostras) < min_amostras or not amostras:
+            return None
+        return amostras[min(len(amostras) - 1, int(p * len(amostras)))]
+
+
+class Backend:
+    def __init__(self, host):
+        self.host = host.rstrip("/")
+        self.em_andamento = 0
+        self.saudavel = True
+        self.falhas_saude = 0
+        self.disjuntor = DisjuntorCircuito()
+        self.modelos_carregados = set()
+        self.ultima_verificacao = None
+        self.total = 0
+
+    def url(self, caminho):
+        return f"{self.host}{caminho}"
+
+
+class PoolBackends:
+    def __init__(self, hosts=OLLAMA_BACKENDS, intervalo_saude=BACKENDS_INTERVALO_SAUDE,
+                 falhas_para_ejetar=BACKENDS_FALHAS_PARA_EJETAR):
+        """
+        Conjunto de servidores Ollama com roteamento por menor número de
+        requisições em andamento, preferindo backends com o modelo já carregado.
+
+        Backends que falham no health check são ejetados; os que falham nas
+        requisições têm o circuito aberto e deixam de receber tráfego por um tempo.
+
+        :param hosts: URLs base dos servidores Ollama.
+        :param intervalo_saude: Segundos entre verificações de saúde (/api/ps).
+        :param falhas_para_ejetar: Health checks falhos seguidos até o backend sair do rodízio.
+        """
+        self.backends = [Backend(h) for h in hosts]
+        self.intervalo_saude = intervalo_saude
+        self.falhas_para_ejetar = falhas_para_ejetar
+        self._desempate = itertools.count()
+        self._lock = threading.Lock()
+
+    def iniciar_verificacao(self):
+        """Inicia a thread de health check periódico."""
+        threading.Thread(target=self._laco, daemon=True).start()
+
+    def _laco(self):
+        while True:
+            self.verificar_saude()
+            time.sleep(self.intervalo_saude)
+
+    def verificar_saude(self):
+        """Consulta /api/ps de cada backend: atualiza saúde e modelos carregados."""
+        for backend in self.backends:
+            try:
+                resposta = requests.get(backend.url("/api/ps"), timeout=3)
+                resposta.raise_for_status()
+                modelos = {m.get("name") or m.get("model") for m in resposta.json().get("models", [])}
+            except (requests.RequestException, ValueError):
+                with self._lock:
+                    backend.falhas_saude += 1
+                    if backend.falhas_saude >= self.falhas_para_ejetar:
+                        backend.saudavel = False
+            else:
+                with self._lock:
+                    backend.modelos_carregados = modelos
+                    backend.falhas_saude = 0
+                    backend.saudavel = True
+            backend.ultima_verificacao = time.time()
+
+    def escolher(self, modelo=None, excluir=()):
+        """
+        Seleciona o backend para uma requisição.
+
+        Entre os saudáveis e com circuito fechado, prefere os que já têm o
+        modelo carregado e, entre esses, o de menor número de requisições em andamento.
+        """
+        with self._lock:
+            candidatos = [b for b in self.backends
+                          if b.saudavel and b not in excluir and b.disjuntor.disponivel()]
+            if not candidatos:
+                raise SemBackendDisponivel("Nenhum backend Ollama disponível.")
+            rodada = next(self._desempate)
+            return min(candidatos, key=lambda b: (modelo not in b.modelos_carregados, b.em_andamento,
+                                                  (self.backends.index(b) - rodada) % len(self.backends)))
+
+    @contextmanager
+    def reservar(self, backend):
+        """Conta a requisição como em andamento no backend enquanto o bloco executa."""
+        with self._lock:
+            backend.em_andamento += 1
+            backend.total += 1
+            teste = backend.disjuntor.iniciar_tentativa()
+        try:
+            yield backend
+        finally:
+            with self._lock:
+                backend.em_andamento -= 1
+                # Sem sucesso() nem falha() (ex.: cancelada) o teste não pode prender o circuito
+                if teste:
+                    backend.disjuntor.liberar()
+
+    def registrar_sucesso(self, backend, modelo=None):
+        with self._lock:
+            backend.disjuntor.sucesso()
+            if modelo:
+                backend.modelos_carregados.add(modelo)
+
+    def registrar_falha(self, backend):
+        with self._lock:
+            backend.disjuntor.falha()
+
+    def registrar_descarga(self, backend, modelo):
+        with self._lock:
+            backend.modelos_carregados.discard(modelo)
+
+    def estado(self):
+        with self._lock:
+            return [{
+                "host": b.host,
+                "saudavel": b.saudavel,
+                "circuito": b.disjuntor.estado,
+                "em_andamento": b.em_andamento,
+                "total": b.total,
+                "falhas_consecutivas": b.disjuntor.falhas,
+                "modelos_carregados": sorted(b.modelos_carregados),
+            } for b in self.backends]
@@ -0,0 +1,215 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+from config.config import BUSCA_LIMITE_PADRAO, BUSCA_LIMITE_MAX
+
+ESQUEMA = """
+CREATE TABLE IF NOT EXISTS sessoes (
+    id TEXT PRIMARY KEY,
+    modelo TEXT,
+    personalidade TEXT,
+    atualizado_em REAL
+);
+CREATE TABLE IF NOT EXISTS mensagens (
+    id INTEGER PRIMARY KEY,
+    sessao_id TEXT NOT NULL,
+    papel TEXT NOT NULL,
+    conteudo TEXT NOT NULL,
+    criado_em REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_mensagens_sessao ON mensagens (sessao_id, id);
+-- Índice FTS5 sem cópia do texto (external content): só guarda os termos
+CREATE VIRTUAL TABLE IF NOT EXISTS mensagens_fts USING fts5(
+    conteudo, content='mensagens', content_rowid='id', tokenize='unicode61 remove_diacritics 2'
+);
+CREATE TRIGGER IF NOT EXISTS mensagens_ai AFTER INSERT ON mensagens BEGIN
+    INSERT INTO mensagens_fts (rowid, conteudo) VALUES (new.id, new.conteudo);
+END;
+CREATE TRIGGER IF NOT EXISTS mensagens_ad AFTER DELETE ON mensagens BEGIN
+    INSERT INTO mensagens_fts (mensagens_fts, rowid, conteudo) VALUES ('delete', old.id, old.conteudo);
+END;
+"""
+
+
+def consulta_fts(texto):
+    """
+    Converte o texto digitado numa consulta FTS5 segura: cada palavra vira um
+    termo entre aspas (operadores e pontuação não quebram a sintaxe) e um "*"
+    no fim da palavra mantém a busca por prefixo.
+    """
+    termos = []
+    for palavra in texto.split():
+        prefixo = palavra.endswith("*")
+        palavra = palavra.rstrip("*").replace('"', '""')
+        if palavra:
+            termos.append(f'"{palavra}"' + ("*" if prefixo else ""))
+    return " ".join(termos)
+
+
+class IndiceConversas:
+    def __init__(self, caminho):
+        """
+        Índice de busca textual das conversas (SQLite FTS5).
+
+        Cada mensagem é inserida uma vez e o gatilho mantém o índice FTS em dia,
+        então indexar um turno custa só o INSERT das duas mensagens. A busca
+        ordena por BM25 e pagina sobre um retrato do índice (ver buscar).
+
+        :param caminho: Arquivo SQLite do índice.
+        """
+        self.caminho = caminho
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(caminho)), exist_ok=True)
+        self._db = sqlite3.connect(caminho, check_same_thread=False)
+        self._db.row_factory = sqlite3.Row
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("PRAGMA busy_timeout=5000")
+        self._db.executescript(ESQUEMA)
+
+    @contextmanager
+    def _conexao(self):
+        """
+        Conexão única do índice, uma thread por vez. O werkzeug abre uma thread
+        por requisição, então conexões por thread nunca seriam reaproveitadas.
+        """
+        with self._lock:
+            yield self._db
+
+    def adicionar(self, sessao_id, mensagens, modelo=None, personalidade=None):
+        """
+        Indexa mensagens novas de uma sessão.
+
+        :param mensagens: Lista de dicts {"role", "content"} (mesmo formato do histórico).
+        """
+        agora = time.time()
+        linhas = [(sessao_id, m["role"], m["content"], agora)
+                  for m in mensagens if m.get("role") in ("user", "assistant") and m.get("content")]
+        if not linhas:
+            return 0
+        with self._conexao() as conexao, conexao:
+            conexao.execute("""
+                INSERT INTO sessoes (id, modelo, personalidade, atualizado_em) VALUES (?, ?, ?, ?)
+                ON CONFLICT(id) DO UPDATE SET atualizado_em = excluded.atualizado_em,
+                    modelo = COALESCE(excluded.modelo, modelo),
+                    personalidade = COALESCE(excluded.personalidade, personalidade)
+            """, (sessao_id, modelo, personalidade, agora))
+            conexao.executemany(
+                "INSERT INTO mensagens (sessao_id, papel, conteudo, criado_em) VALUES (?, ?, ?, ?)", linhas)
+        return len(linhas)
+
+    def indexada(self, sessao_id):
+        with self._conexao() as conexao:
+            return conexao.execute("SELECT 1 FROM sessoes WHERE id = ?", (sessao_id,)).fetchone() is not None
+
+    def importar_sessao(self, dados, atualizado_em=None):
+        """
+        Indexa uma sessão salva em JSON (backfill). Sessões já presentes no índice são puladas.
+        Retorna o número de mensagens indexadas.
+        """
+        if not dados.get("id") or self.indexada(dados["id"]):
+            return 0
+        total = self.adicionar(dados["id"], dados.get("historico", []),
+                               dados.get("modelo"), dados.get("personalidade"))
+        if atualizado_em and total:
+            with self._conexao() as conexao, conexao:
+                conexao.execute("UPDATE sessoes SET atualizado_em = ? WHERE id = ?", (atualizado_em, dados["id"]))
+                conexao.execute("UPDATE mensagens SET criado_em = ? WHERE sessao_id = ?", (atualizado_em, dados["id"]))
+        return total
+
+    def buscar(self, texto, limite=BUSCA_LIMITE_PADRAO, cursor=None, sessao_id=None):
+        """
+        Mensagens que casam com o texto, das mais relevantes para as menos.
+
+        O cursor leva o maior id indexado quando a primeira página foi pedida e
+        a posição na lista, então mensagens indexadas depois não entram nas
+        páginas seguintes. Um keyset pela pontuação não serviria: o BM25 depende
+        das estatísticas do índice inteiro e toda pontuação muda a cada turno
+        indexado. Mudanças assim raramente trocam a ordem relativa das
+        mensagens antigas, mas quando trocam, uma linha pode se repetir ou
+        faltar na costura entre páginas. O BM25 já pontua todas as ocorrências
+        a cada página, então pular as anteriores custa pouco.
+
+        :param limite: Resultados por página (até BUSCA_LIMITE_MAX).
+        :param cursor: Valor "proximo" da página anterior.
+        :param sessao_id: Restringe a busca a uma sessão.
+        :return: {"resultados": [...], "proximo": cursor da próxima página ou None}
+        """
+        consulta = consulta_fts(texto)
+        if not consulta:
+            return {"resultados": [], "proximo": None}
+        limite = max(1, min(int(limite), BUSCA_LIMITE_MAX))
+
+        with self._conexao() as conexao:
+            return self._buscar(conexao, consulta, limite, cursor, sessao_id)
+
+    def _buscar(self, conexao, consulta, limite, cursor, sessao_id):
+        if cursor:
+            teto, inicio = (int(parte) for parte in cursor.split(":"))
+            if inicio < 0:
+                raise ValueError(f"Cursor inválido: {cursor}")
+        else:
+            teto = conexao.execute("SELECT MAX(id) FROM mensagens").fetchone()[0] or 0
+            inicio = 0
+        filtros, parametros = ["id <= ?"], [consulta, teto]
+        if sessao_id:
+            filtros.append("sessao_id = ?")
+            parametros.append(sessao_id)
+        onde = "WHERE " + " AND ".join(filtros)
+
+        linhas = conexao.execute(f"""
+            SELECT * FROM (
+                SELECT m.id, m.sessao_id, m.papel, m.criado_em, bm25(mensagens_fts) AS pontuacao
+                FROM mensagens_fts JOIN mensagens m ON m.id = mensagens_fts.rowid
+                WHERE mensagens_fts MATCH ?
+            ) {onde}
+            ORDER BY pontuacao, id
+            LIMIT ? OFFSET ?
+        """, parametros + [limite + 1, inicio]).fetchall()
+
+        resultados = [dict(l) for l in linhas[:limite]]
+        proximo = None
+        if len(linhas) > limite:
+            proximo = f"{teto}:{inicio + limite}"
+
+        # Trechos só das mensagens da página (snippet em todas as ocorrências custaria caro)
+        ids = [r["id"] for r in resultados]
+        trechos = dict(conexao.execute(f"""
+            SELECT rowid, snippet(mensagens_fts, 0, '[', ']', '…', 16) FROM mensagens_fts
+            WHERE mensagens_fts MATCH ? AND rowid IN ({",".join("?" * len(ids))})
+        """, [consulta] + ids).fetchall()) if ids else {}
+        for r in resultados:
+            r["trecho"] = trechos.get(r["id"], "")
+            # bm25 do SQLite é negativo (menor = melhor); exposto como relevância positiva
+            r["relevancia"] = round(-r.pop("pontuacao"), 4)
+        return {"resultados": resultados, "proximo": proximo}
+
+    def importar_diretorio(self, diretorio):
+        """Backfill: indexa todos os *.json de conversas_salvas que ainda não estão no índice."""
+        sessoes = mensagens = 0
+        for nome in sorted(os.listdir(diretorio)):
+            if not nome.endswith(".json"):
+                continue
+            caminho = os.path.join(diretorio, nome)
+            try:
+                with open(caminho, "r", encoding="utf-8") as f:
+                    dados = json.load(f)
+            except (OSError, ValueError) as e:
+                print(f"[ERRO] Ler conversa {nome}: {e}")
+                continue
+            total = self.importar_sessao(dados, atualizado_em=os.path.getmtime(caminho))
+            if total:
+                sessoes += 1
+                mensagens += total
+        return {"sessoes": sessoes, "mensagens": mensagens}
+
+    def estado(self):
+        with self._conexao() as conexao:
+            return {
+                "sessoes": conexao.execute("SELECT COUNT(*) FROM sessoes").fetchone()[0],
+                "mensagens": conexao.execute("SELECT MAX(id) FROM mensagens").fetchone()[0] or 0,
+            }
@@ -0,0 +1,167 @@
+import hashlib
+import re
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+from config.config import (CACHE_MAX_ITENS, CACHE_TTL, CACHE_SEMANTICO, CACHE_LIMIAR_SIMILARIDADE,
+                           CACHE_TEMPERATURA_MAX, CACHE_JANELA_CONTEXTO, CACHE_RAZAO_TAMANHO)
+
+PARAMETROS_CHAVE = ("temperature", "top_p", "top_k", "repeat_penalty", "num_predict", "num_ctx", "seed")
+
+
+class CacheRespostas:
+    def __init__(self, max_itens=CACHE_MAX_ITENS, ttl=CACHE_TTL, semantico=CACHE_SEMANTICO,
+                 limiar_similaridade=CACHE_LIMIAR_SIMILARIDADE, temperatura_max=CACHE_TEMPERATURA_MAX):
+        """
+        Cache de respostas em dois níveis: exato (pergunta normalizada) e
+        semântico (embedding da pergunta), sempre dentro do mesmo grupo
+        modelo/persona/parâmetros de amostragem/contexto da conversa.
+
+        O contexto (assinatura do histórico recente e do resumo) faz parte da
+        chave: "e o segundo?" só reaproveita a resposta dada na mesma conversa.
+
+        :param max_itens: Número máximo de entradas (despejo LRU).
+        :param ttl: Segundos de validade de cada entrada.
+        :param semantico: Ativa o nível semântico.
+        :param limiar_similaridade: Cosseno mínimo para considerar perguntas equivalentes.
+        :param temperatura_max: Temperaturas acima disso não usam o cache.
+        """
+        self.max_itens = max_itens
+        self.ttl = ttl
+        self.semantico = semantico
+        self.limiar_similaridade = limiar_similaridade
+        self.temperatura_max = temperatura_max
+        self.itens = OrderedDict()  # (grupo, pergunta normalizada) -> entrada
+        self.estatisticas = {"exatos": 0, "semanticos": 0, "falhas": 0, "ignorados": 0}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def normalizar(texto):
+        """Minúsculas, sem pontuação e com espaços colapsados."""
+        return " ".join(re.findall(r"\w+", texto.lower()))
+
+    @staticmethod
+    def contexto(historico, resumo="", janela=CACHE_JANELA_CONTEXTO):
+        """
+        Assinatura do contexto que a geração vê: as últimas mensagens e o resumo.
+        Conversa nova (sem histórico nem resumo) tem assinatura vazia, compartilhada entre sessões.
+        """
+        recentes = historico[-janela:] if janela else historico
+        if not recentes and not resumo:
+            return ""
+        digest = hashlib.blake2b(digest_size=16)
+        for mensagem in recentes:
+            digest.update(f"{mensagem.get('role')}\x00{mensagem.get('content')}\x01".encode("utf-8"))
+        digest.update((resumo or "").encode("utf-8"))
+        return digest.hexdigest()
+
+    @staticmethod
+    def grupo(modelo, persona, parametros, contexto=""):
+        return (modelo, persona, contexto) + tuple(parametros.get(p) for p in PARAMETROS_CHAVE)
+
+    @staticmethod
+    def entidades(texto):
+        """Números e palavras com inicial maiúscula fora do começo: o que muda o sentido de perguntas parecidas."""
+        palavras = re.findall(r"\w+", texto)
+        return frozenset([p.lower() for p in palavras if any(c.isdigit() for c in p)]
+                         + [p.lower() for p in palavras[1:] if p[:1].isupper()])
+
+    def _equivalentes(self, normalizada, entidades, entrada):
+        """Confirmação do acerto semântico: mesmas entidades e tamanho parecido."""
+        if entidades != entrada["entidades"]:
+            return False
+        menor, maior = sorted((len(normalizada), len(entrada["normalizada"])))
+        return maior == 0 or menor / maior >= CACHE_RAZAO_TAMANHO
+
+    def permitido(self, parametros):
+        """Gerações muito aleatórias não devem ser reaproveitadas."""
+        permitido = (parametros.get("temperature") or 0) <= self.temperatura_max
+        if not permitido:
+            with self._lock:
+                self.estatisticas["ignorados"] += 1
+        return permitido
+
+    def buscar(self, modelo, persona, parametros, pergunta, vetor=None, contexto=""):
+        """
+        Retorna (resposta, tipo) onde tipo é "exato" ou "semantico"; (None, None) se não houver.
+
+        :param contexto: Assinatura de contexto() calculada antes do turno.
+        """
+        grupo = self.grupo(modelo, persona, parametros, contexto)
+        normalizada = self.normalizar(pergunta)
+        chave = (grupo, normalizada)
+        agora = time.time()
+        with self._lock:
+            self._expirar(agora)
+            entrada = self.itens.get(chave)
+            if entrada and agora - entrada["criado_em"] > self.ttl:
+                del self.itens[chave]
+                entrada = None
+            if entrada:
+                self.itens.move_to_end(chave)
+                self.estatisticas["exatos"] += 1
+                return entrada["resposta"], "exato"
+
+            if self.semantico and vetor is not None:
+                candidatos = [(c, e) for c, e in self.itens.items() if c[0] == grupo and e["vetor"] is not None
+                              and agora - e["criado_em"] <= self.ttl]
+                if candidatos:
+                    matriz = np.stack([e["vetor"] for _, e in candidatos])
+                    similaridades = matriz @ self._unitario(vetor)
+                    melhor = int(np.argmax(similaridades))
+                    if (similaridades[melhor] >= self.limiar_similaridade
+                            and self._equivalentes(normalizada, self.entidades(pergunta), candidatos[melhor][1])):
+                        chave_similar, entrada = candidatos[melhor]
+                        self.itens.move_to_end(chave_similar)
+                        self.estatisticas["semanticos"] += 1
+                        return entrada["resposta"], "semantico"
+
+            self.estatisticas["falhas"] += 1
+            return None, None
+
+    def guardar(self, modelo, persona, parametros, pergunta, resposta, vetor=None, contexto=""):
+        """:param contexto: A mesma assinatura usada no buscar (do contexto antes do turno)."""
+        normalizada = self.normalizar(pergunta)
+        chave = (self.grupo(modelo, persona, parametros, contexto), normalizada)
+        with self._lock:
+            self.itens[chave] = {
+                "resposta": resposta,
+                "normalizada": normalizada,
+                "entidades": self.entidades(pergunta),
+                "vetor": self._unitario(vetor) if vetor is not None else None,
+                "criado_em": time.time(),
+            }
+            self.itens.move_to_end(chave)
+            while len(self.itens) > self.max_itens:
+                self.itens.popitem(last=False)
+
+    def limpar(self):
+        with self._lock:
+            self.itens.clear()
+
+    def _expirar(self, agora):
+        # Limpeza barata pelo início da fila; entradas promovidas por uso são checadas na consulta
+        while self.itens:
+            chave, entrada = next(iter(self.itens.items()))
+            if agora - entrada["criado_em"] <= self.ttl:
+                break
+            del self.itens[chave]
+
+    @staticmethod
+    def _unitario(vetor):
+        vetor = np.asarray(vetor, dtype=np.float32)
+        norma = np.linalg.norm(vetor)
+        return vetor / norma if norma else vetor
+
+    def estado(self):
+        with self._lock:
+            consultas = self.estatisticas["exatos"] + self.estatisticas["semanticos"] + self.estatisticas["falhas"]
+            acertos = self.estatisticas["exatos"] + self.estatisticas["semanticos"]
+            return {
+                **self.estatisticas,
+                "itens": len(self.itens),
+                "taxa_acerto": round(acertos / consultas, 3) if consultas else 0.0,
+            }
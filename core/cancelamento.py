@@ -0,0 +1,191 @@
+import contextvars
+import select
+import socket
+import threading
+import time
+from contextlib import contextmanager
+
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+_abortador_atual = contextvars.ContextVar("abortador_atual", default=None)
+
+
+class GeracaoCancelada(Exception):
+    """A geração foi abortada antes de terminar (cancelada pelo usuário, prazo ou desconexão)."""
+
+
+class Cancelamento:
+    def __init__(self, prazo_s=None, pai=None):
+        """
+        Sinal de cancelamento cooperativo com prazo opcional.
+
+        A thread que lê o stream do Ollama verifica o sinal a cada pedaço e
+        fecha a conexão, o que faz o Ollama interromper a geração. Antes do
+        primeiro pedaço (carga do modelo e prefill) a leitura fica bloqueada;
+        ali quem derruba a conexão é abortar_ao_cancelar.
+
+        :param prazo_s: Segundos a partir de agora até o prazo vencer (None = sem prazo).
+        :param pai: Cancelamento do qual este herda o cancelamento (ex.: tentativa de hedge).
+        """
+        self.evento = threading.Event()
+        self.limite = time.time() + prazo_s if prazo_s else None
+        self.pai = pai
+        self.motivo = None
+
+    def cancelar(self, motivo="cancelado"):
+        if not self.evento.is_set():
+            self.motivo = motivo
+            self.evento.set()
+
+    @property
+    def cancelado(self):
+        if self.evento.is_set():
+            return True
+        if self.limite and time.time() >= self.limite:
+            self.cancelar("prazo")
+            return True
+        if self.pai is not None and self.pai.cancelado:
+            self.cancelar(self.pai.motivo)
+            return True
+        return False
+
+    def restante(self):
+        """Segundos até o prazo (o menor entre este e o pai), ou None se não houver prazo."""
+        limites = [c.limite for c in (self, self.pai) if c is not None and c.limite]
+        return max(0.0, min(limites) - time.time()) if limites else None
+
+
+class _Abortador:
+    def __init__(self):
+        self.conexao = None
+        self.ativo = True
+        self._lock = threading.Lock()
+
+    def abortar(self):
+        # Depois do bloco a conexão volta ao pool e pode servir outra requisição: não mexe mais nela
+        with self._lock:
+            sock = getattr(self.conexao, "sock", None) if self.ativo else None
+            if sock is not None:
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+
+    def encerrar(self):
+        with self._lock:
+            self.ativo = False
+
+
+class _ConexaoAbortavel:
+    def request(self, *args, **kwargs):
+        # Chamado a cada requisição, inclusive nas conexões reaproveitadas do pool
+        abortador = _abortador_atual.get()
+        if abortador is not None:
+            abortador.conexao = self
+        return super().request(*args, **kwargs)
+
+
+class _ConexaoHTTP(_ConexaoAbortavel, HTTPConnection):
+    pass
+
+
+class _ConexaoHTTPS(_ConexaoAbortavel, HTTPSConnection):
+    pass
+
+
+class _PoolHTTP(HTTPConnectionPool):
+    ConnectionCls = _ConexaoHTTP
+
+
+class _PoolHTTPS(HTTPSConnectionPool):
+    ConnectionCls = _ConexaoHTTPS
+
+
+class AdaptadorAbortavel(HTTPAdapter):
+    """Adaptador do requests cujas conexões abortar_ao_cancelar consegue derrubar."""
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {"http": _PoolHTTP, "https": _PoolHTTPS}
+
+
+@contextmanager
+def abortar_ao_cancelar(cancelamento, intervalo=0.1):
+    """
+    Derruba (shutdown do socket) a requisição HTTP feita dentro do bloco assim que o
+    cancelamento acontecer, mesmo com a thread bloqueada esperando a resposta. O Ollama
+    só manda os cabeçalhos com o primeiro token, então sem isto um cancelamento durante
+    a carga do modelo ou o prefill só teria efeito quando a geração começasse.
+
+    A sessão do requests precisa usar AdaptadorAbortavel; a leitura interrompida levanta
+    uma exceção de conexão, que quem chama trata como cancelamento.
+    """
+    abortador = _Abortador()
+    token = _abortador_atual.set(abortador)
+    concluido = threading.Event()
+
+    def _laco():
+        while not concluido.wait(intervalo):
+            if cancelamento.cancelado:
+                abortador.abortar()
+                return
+
+    threading.Thread(target=_laco, daemon=True).start()
+    try:
+        yield
+    finally:
+        abortador.encerrar()
+        concluido.set()
+        _abortador_atual.reset(token)
+
+
+def vigiar_desconexao(sock, cancelamento, concluido, intervalo=0.25):
+    """
+    Cancela a geração se o cliente HTTP fechar a conexão antes da resposta.
+
+    :param sock: Socket da conexão do cliente (werkzeug.socket no environ).
+    :param cancelamento: Cancelamento a sinalizar.
+    :param concluido: threading.Event marcado quando a requisição termina.
+    """
+    def _laco():
+        while not concluido.wait(intervalo):
+            try:
+                legivel, _, _ = select.select([sock], [], [], 0)
+                # Legível sem dados = o cliente encerrou a conexão
+                if legivel and not sock.recv(1, socket.MSG_PEEK):
+                    cancelamento.cancelar("desconexao")
+                    return
+            except (OSError, ValueError):
+                cancelamento.cancelar("desconexao")
+                return
+    if sock is not None:
+        threading.Thread(target=_laco, daemon=True).start()
+
+
+class RegistroCancelamentos:
+    def __init__(self):
+        """Turnos em andamento por sessão, para o endpoint /cancelar."""
+        self._turnos = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def turno(self, sessao, cancelamento):
+        with self._lock:
+            self._turnos[sessao] = cancelamento
+        try:
+            yield cancelamento
+        finally:
+            with self._lock:
+                if self._turnos.get(sessao) is cancelamento:
+                    del self._turnos[sessao]
+
+    def cancelar(self, sessao, motivo="usuario"):
+        """Cancela o turno em andamento da sessão. Retorna False se não houver nenhum."""
+        with self._lock:
+            cancelamento = self._turnos.get(sessao)
+        if cancelamento is None:
+            return False
+        cancelamento.cancelar(motivo)
+        return True
@@ -0,0 +1,131 @@
+import threading
+import time
+
+from config.config import CATALOGO_TTL, CATALOGO_RETENTATIVA_S
+
+
+class CatalogoModelos:
+    def __init__(self, cliente, ttl=CATALOGO_TTL):
+        """
+        Catálogo em memória dos modelos instalados no Ollama.
+
+        As consultas devolvem o último snapshot e, se ele estiver vencido,
+        disparam uma atualização em segundo plano. Só com o catálogo vazio (app
+        servido sem passar por iniciar(), ou Ollama fora do ar na partida) a
+        consulta espera o /api/tags, para não responder "nenhum modelo".
+
+        :param cliente: Instância de ClienteOllama.
+        :param ttl: Segundos até o snapshot ser considerado desatualizado.
+        """
+        self.cliente = cliente
+        self.ttl = ttl
+        self.modelos = {}        # nome -> metadados
+        self.atualizado_em = 0
+        self._detalhes = {}      # digest -> metadados de /api/show (não mudam para o mesmo digest)
+        self._atualizando = False
+        self._lock = threading.Lock()
+        self._lock_carga = threading.Lock()
+        self._tentativa_em = 0
+
+    def iniciar(self):
+        """Carrega o catálogo de forma síncrona e inicia a atualização periódica."""
+        self.atualizar()
+        threading.Thread(target=self._laco, daemon=True).start()
+
+    def _laco(self):
+        while True:
+            time.sleep(self.ttl)
+            self.atualizar()
+
+    def atualizar(self):
+        """Consulta /api/tags (e /api/show para modelos novos) e troca o snapshot."""
+        try:
+            tags = self.cliente.listar_tags()
+        except Exception as e:
+            print(f"[ERRO] Listar modelos: {e}")
+            with self._lock:
+                self._atualizando = False
+            return
+
+        modelos = {}
+        for tag in tags:
+            nome = tag.get("name") or tag.get("model")
+            digest = tag.get("digest")
+            if digest not in self._detalhes:
+                self._detalhes[digest] = self._extrair_detalhes(nome)
+            detalhes = tag.get("details", {})
+            modelos[nome] = {
+                "nome": nome,
+                "tamanho": tag.get("size", 0),
+                "familia": detalhes.get("family"),
+                "parametros": detalhes.get("parameter_size"),
+                "parametros_b": self._parametros_em_bilhoes(detalhes.get("parameter_size")),
+                "quantizacao": detalhes.get("quantization_level"),
+                "modificado_em": tag.get("modified_at"),
+                **self._detalhes[digest],
+            }
+
+        with self._lock:
+            self.modelos = modelos
+            self.atualizado_em = time.time()
+            self._atualizando = False
+
+    def atualizar_em_segundo_plano(self):
+        """Dispara uma atualização assíncrona, se nenhuma estiver em andamento."""
+        with self._lock:
+            if self._atualizando:
+                return
+            self._atualizando = True
+        threading.Thread(target=self.atualizar, daemon=True).start()
+
+    def _extrair_detalhes(self, nome):
+        """Lê o comprimento de contexto do modelo via /api/show."""
+        try:
+            info = self.cliente.mostrar(nome).get("model_info", {})
+        except Exception as e:
+            print(f"[ERRO] Detalhes do modelo {nome}: {e}")
+            return {"contexto": None}
+        contexto = next((v for k, v in info.items() if k.endswith(".context_length")), None)
+        return {"contexto": contexto}
+
+    @staticmethod
+    def _parametros_em_bilhoes(texto):
+        """Converte '7.6B' / '500M' em bilhões de parâmetros (float)."""
+        if not texto:
+            return None
+        try:
+            valor, unidade = float(texto[:-1]), texto[-1].upper()
+        except ValueError:
+            return None
+        return {"B": valor, "M": valor / 1000, "K": valor / 1e6}.get(unidade)
+
+    def _snapshot(self):
+        with self._lock:
+            vazio = not self.modelos
+        if vazio:
+            self._carregar_vazio()
+        elif time.time() - self.atualizado_em > self.ttl:
+            self.atualizar_em_segundo_plano()
+        with self._lock:
+            return self.modelos
+
+    def _carregar_vazio(self):
+        """Carga síncrona do catálogo vazio; consultas simultâneas esperam a mesma carga."""
+        with self._lock_carga:
+            with self._lock:
+                if self.modelos or time.time() - self._tentativa_em < CATALOGO_RETENTATIVA_S:
+                    return
+                self._tentativa_em = time.time()
+            self.atualizar()
+
+    def nomes(self):
+        """Nomes dos modelos disponíveis localmente."""
+        return list(self._snapshot())
+
+    def info(self, modelo):
+        """Metadados de um modelo (tamanho, quantização, contexto...) ou None."""
+        return self._snapshot().get(modelo)
+
+    def todos(self):
+        """Lista de metadados de todos os modelos."""
+        return list(self._snapshot().values())
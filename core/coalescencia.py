@@ -0,0 +1,96 @@
+import contextvars
+import hashlib
+import json
+import threading
+
+from core.cancelamento import Cancelamento, GeracaoCancelada
+
+
+class _Voo:
+    def __init__(self):
+        self.evento = threading.Event()
+        self.resultado = None
+        self.erro = None
+        self.participantes = 1
+        self.desistentes = 0
+        self.cancelamento = Cancelamento()  # da execução compartilhada: só dispara quando todos desistem
+
+
+class Coalescedor:
+    def __init__(self, intervalo=0.1):
+        """
+        Deduplicação "single-flight": chamadas concorrentes com a mesma chave
+        esperam a execução em andamento e recebem o mesmo resultado.
+
+        Só o resultado final é compartilhado, então gerações em streaming (o
+        rascunho do modo progressivo) não passam por aqui: quem espera não
+        receberia os pedaços à medida que chegam.
+
+        :param intervalo: Segundos entre verificações do cancelamento de quem espera.
+        """
+        self.intervalo = intervalo
+        self._voos = {}
+        self._lock = threading.Lock()
+        self.estatisticas = {"execucoes": 0, "coalescidas": 0, "desistencias": 0}
+
+    @staticmethod
+    def chave(payload):
+        """Chave estável de um payload JSON."""
+        return hashlib.sha256(json.dumps(payload, sort_keys=True, ensure_ascii=False).encode()).hexdigest()
+
+    def executar(self, chave, funcao, cancelamento=None):
+        """
+        Executa funcao(cancelamento) uma única vez por chave em andamento e compartilha
+        o resultado (o mesmo objeto para todos: quem for alterá-lo deve copiar).
+
+        A execução roda numa thread própria e cada participante espera respeitando o
+        próprio cancelamento (prazo, /cancelar, desconexão): quem desiste levanta
+        GeracaoCancelada na hora. O cancelamento passado a funcao só dispara quando
+        todos os participantes desistiram.
+        """
+        with self._lock:
+            voo = self._voos.get(chave)
+            if voo is None:
+                voo = self._voos[chave] = _Voo()
+                self.estatisticas["execucoes"] += 1
+                # Cópia do contexto do primeiro participante: os spans entram no rastro dele
+                threading.Thread(target=contextvars.copy_context().run, args=(self._voar, chave, voo, funcao),
+                                 daemon=True).start()
+            else:
+                voo.participantes += 1
+                self.estatisticas["coalescidas"] += 1
+
+        cancelamento = cancelamento or Cancelamento()
+        while not voo.evento.wait(self.intervalo):
+            if cancelamento.cancelado:
+                self._desistir(chave, voo, cancelamento.motivo)
+                raise GeracaoCancelada(f"Geração cancelada ({cancelamento.motivo}).")
+        if voo.erro:
+            raise voo.erro
+        return voo.resultado
+
+    def _voar(self, chave, voo, funcao):
+        try:
+            voo.resultado = funcao(voo.cancelamento)
+        except Exception as e:
+            voo.erro = e
+        finally:
+            with self._lock:
+                if self._voos.get(chave) is voo:
+                    del self._voos[chave]
+            voo.evento.set()
+
+    def _desistir(self, chave, voo, motivo):
+        with self._lock:
+            self.estatisticas["desistencias"] += 1
+            voo.desistentes += 1
+            if voo.desistentes < voo.participantes:
+                return
+            # Ninguém mais espera: chamadas novas com a mesma chave começam outra execução
+            if self._voos.get(chave) is voo:
+                del self._voos[chave]
+        voo.cancelamento.cancelar(motivo)
+
+    def estado(self):
+        with self._lock:
+            return {**self.estatisticas, "em_andamento": len(self._voos)}
@@ -0,0 +1,134 @@
+import re
+
+from config.config import CONTEXTO_MARGEM_TOKENS, CONTEXTO_FRACAO_MEMORIAS, CONTEXTO_MENSAGENS_RECENTES
+from utils.tokens import contar_tokens, tokens_mensagem
+
+ROTULOS = {"user": "Usuário", "assistant": "Assistente"}
+TOKENS_POR_LINHA = 3  # rótulo "Usuário:"/"Assistente:" e quebra de linha
+
+
+def _normalizar(texto):
+    return " ".join(re.findall(r"\w+", texto.lower()))
+
+
+class MontadorContexto:
+    def __init__(self, margem=CONTEXTO_MARGEM_TOKENS, fracao_memorias=CONTEXTO_FRACAO_MEMORIAS,
+                 mensagens_recentes=CONTEXTO_MENSAGENS_RECENTES):
+        """
+        Monta o prompt dentro do orçamento de tokens do contexto (num_ctx).
+
+        Prioridades: persona, resumo e pergunta (sempre), mensagens mais recentes,
+        exemplos de conversa da persona, memórias recuperadas (até uma fração do
+        orçamento) e, por fim, o restante do histórico, do mais novo para o mais antigo.
+
+        :param margem: Tokens reservados para o template do modelo.
+        :param fracao_memorias: Fração máxima do orçamento para memórias.
+        :param mensagens_recentes: Mensagens recentes que têm prioridade sobre as memórias.
+        """
+        self.margem = margem
+        self.fracao_memorias = fracao_memorias
+        self.mensagens_recentes = mensagens_recentes
+
+    def montar(self, system, pergunta, historico, memorias, num_ctx, num_predict, resumo="", exemplos=None,
+               fator=1.0):
+        """
+        Retorna (prompt, relatorio).
+
+        :param system: Texto de sistema da persona (prefixo fixo do prompt).
+        :param pergunta: Mensagem atual do usuário.
+        :param historico: Lista de mensagens {"role", "content"} em ordem cronológica.
+        :param memorias: Textos recuperados da memória, do mais ao menos relevante.
+        :param num_ctx: Tamanho da janela de contexto do modelo.
+        :param num_predict: Tokens reservados para a resposta.
+        :param resumo: Resumo das mensagens antigas já compactadas (opcional).
+        :param exemplos: Exemplos de conversa da persona escolhidos para a pergunta (opcional).
+        :param fator: Tokens do modelo por token contado aqui (CalibracaoTokens.fator).
+        """
+        orcamento = int((num_ctx - num_predict - self.margem) / fator)
+        usado = contar_tokens(system) + contar_tokens(pergunta) + 2 * TOKENS_POR_LINHA
+        if resumo:
+            usado += contar_tokens(resumo) + TOKENS_POR_LINHA
+        recentes = list(reversed(historico))
+
+        # Histórico que caberia sem memórias: memórias repetindo essas mensagens são descartadas
+        cabiveis, total = [], usado
+        for mensagem in recentes:
+            total += tokens_mensagem(mensagem) + TOKENS_POR_LINHA
+            if total > orcamento:
+                break
+            cabiveis.append(_normalizar(mensagem["content"]))
+        duplicadas = [m for m in memorias if self._duplicada(m, cabiveis)]
+
+        incluidas_hist = 0
+        for mensagem in recentes[:self.mensagens_recentes]:
+            custo = tokens_mensagem(mensagem) + TOKENS_POR_LINHA
+            if usado + custo > orcamento:
+                break
+            usado += custo
+            incluidas_hist += 1
+
+        incluidos_ex = []
+        for exemplo in exemplos or []:
+            custo = contar_tokens(exemplo) + TOKENS_POR_LINHA
+            if usado + custo > orcamento:
+                continue
+            usado += custo
+            incluidos_ex.append(exemplo)
+        if incluidos_ex:
+            usado += TOKENS_POR_LINHA
+
+        incluidas_mem, limite_mem = [], usado + int(orcamento * self.fracao_memorias)
+        for memoria in memorias:
+            if memoria in duplicadas:
+                continue
+            custo = contar_tokens(memoria) + TOKENS_POR_LINHA
+            if usado + custo > min(limite_mem, orcamento):
+                continue
+            usado += custo
+            incluidas_mem.append(memoria)
+
+        if incluidas_hist == min(self.mensagens_recentes, len(recentes)):
+            for mensagem in recentes[incluidas_hist:]:
+                custo = tokens_mensagem(mensagem) + TOKENS_POR_LINHA
+                if usado + custo > orcamento:
+                    break
+                usado += custo
+                incluidas_hist += 1
+
+        partes = [system, ""]
+        if incluidos_ex:
+            partes.append("Exemplos de conversa:")
+            partes.extend(f"{e}\n" for e in incluidos_ex)
+        if resumo:
+            partes.append(f"Resumo da conversa até aqui:\n{resumo}\n")
+        for mensagem in historico[len(historico) - incluidas_hist:]:
+            partes.append(f"{ROTULOS.get(mensagem['role'], mensagem['role'])}: {mensagem['content']}")
+        if incluidas_mem:
+            partes.append("Contexto relevante:")
+            partes.extend(f"- {m}" for m in incluidas_mem)
+        partes.append(f"Usuário: {pergunta}")
+        partes.append("Assistente:")
+
+        relatorio = {
+            "tokens_prompt": usado,
+            "orcamento": orcamento,
+            "fator_tokens": round(fator, 3),
+            "historico_incluido": incluidas_hist,
+            "historico_total": len(historico),
+            "exemplos_incluidos": len(incluidos_ex),
+            "memorias_incluidas": len(incluidas_mem),
+            "memorias_duplicadas": len(duplicadas),
+            "memorias_descartadas": len(memorias) - len(incluidas_mem) - len(duplicadas),
+        }
+        return "\n".join(partes), relatorio
+
+    @staticmethod
+    def _duplicada(memoria, mensagens_normalizadas):
+        """Memória que repete uma mensagem do histórico (ou é repetida por ela)."""
+        texto = _normalizar(memoria)
+        for mensagem in mensagens_normalizadas:
+            if len(mensagem) >= 20 and mensagem in texto:
+                return True
+            if len(texto) >= 20 and texto in mensagem:
+                return True
+        return False
@@ -0,0 +1,114 @@
+import threading
+from collections import Counter
+
+from config.config import (DEGRADACAO_ATIVA, SLO_LATENCIA_P99_S, DEGRADACAO_LIMIARES_FILA,
+                           MODELO_DEGRADADO)
+from core.backends import JanelaLatencias
+
+# O que cada nível corta do turno (cumulativo)
+NIVEIS = (
+    {},
+    {"k_memorias": 1, "fator_num_predict": 0.75},
+    {"k_memorias": 0, "fator_num_predict": 0.5},
+    {"k_memorias": 0, "fator_num_predict": 0.5, "modelo_menor": True},
+)
+
+
+class ControleDegradacao:
+    def __init__(self, agendador, cliente, catalogo, slo_s=SLO_LATENCIA_P99_S,
+                 limiares_fila=DEGRADACAO_LIMIARES_FILA, modelo_degradado=MODELO_DEGRADADO,
+                 ativo=DEGRADACAO_ATIVA):
+        """
+        Degrada o turno quando a carga ameaça o SLO de latência, em vez de
+        deixar o p99 explodir em rajadas.
+
+        O nível (0 a 3) vem do pior de três sinais: fila do modelo por slot,
+        latência estimada (p95 da geração + p95 da espera na fila) em relação
+        ao orçamento da requisição e p99 recente dos turnos acima da meta.
+
+        :param agendador: Agendador (fila e slots por modelo).
+        :param cliente: ClienteOllama (janela de latências das gerações).
+        :param catalogo: CatalogoModelos, para escolher um modelo menor.
+        :param slo_s: Meta de p99 (s) da latência de um turno.
+        :param limiares_fila: Requisições aguardando por slot que ativam os níveis 1, 2 e 3.
+        :param modelo_degradado: Modelo do nível 3 (None = menor modelo do catálogo).
+        :param ativo: Desliga a degradação quando False.
+        """
+        self.agendador = agendador
+        self.cliente = cliente
+        self.catalogo = catalogo
+        self.slo_s = slo_s
+        self.limiares_fila = limiares_fila
+        self.modelo_degradado = modelo_degradado
+        self.ativo = ativo
+        self.turnos = JanelaLatencias()
+        self.contagem = Counter()
+        self._lock = threading.Lock()
+
+    def nivel(self, modelo, orcamento_s=None):
+        """Nível de degradação para um turno do modelo com o orçamento (s) dado."""
+        if not self.ativo:
+            return 0
+        _, aguardando, slots = self.agendador.carga(modelo)
+        nivel_fila = sum(aguardando / slots >= limiar for limiar in self.limiares_fila)
+
+        orcamento = min(orcamento_s, self.slo_s) if orcamento_s else self.slo_s
+        estimada = ((self.cliente.latencias.percentil(modelo, 0.95) or 0)
+                    + (self.agendador.esperas.percentil("interativo", 0.95) or 0))
+        razao = estimada / max(orcamento, 0.1)
+        nivel_orcamento = 0 if razao < 0.8 else 1 if razao < 1.2 else 2 if razao < 2 else 3
+
+        p99 = self.turnos.percentil(modelo, 0.99, min_amostras=20)
+        nivel_slo = 1 if p99 is not None and p99 > self.slo_s else 0
+        return min(max(nivel_fila, nivel_orcamento, nivel_slo), len(NIVEIS) - 1)
+
+    def planejar(self, modelo, num_predict, k_memorias, orcamento_s=None):
+        """
+        Plano do turno: modelo, k da busca de memórias e num_predict já
+        degradados, mais a lista de degradações aplicadas.
+        """
+        nivel = self.nivel(modelo, orcamento_s)
+        regras = NIVEIS[nivel]
+        plano = {"nivel": nivel, "modelo": modelo, "k_memorias": k_memorias,
+                 "num_predict": num_predict, "degradacoes": []}
+
+        k = regras.get("k_memorias")
+        if k is not None and k < k_memorias:
+            plano["k_memorias"] = k
+            plano["degradacoes"].append("sem_memorias" if k == 0 else "memorias_reduzidas")
+        if regras.get("fator_num_predict"):
+            plano["num_predict"] = max(32, int(num_predict * regras["fator_num_predict"]))
+            if plano["num_predict"] < num_predict:
+                plano["degradacoes"].append("num_predict_reduzido")
+        if regras.get("modelo_menor"):
+            menor = self._modelo_menor(modelo)
+            if menor:
+                plano["modelo"] = menor
+                plano["degradacoes"].append("modelo_menor")
+
+        if plano["degradacoes"]:
+            with self._lock:
+                self.contagem.update(plano["degradacoes"])
+        return plano
+
+    def _modelo_menor(self, modelo):
+        """Modelo configurado para degradação, ou o menor do catálogo (se for menor que o atual)."""
+        if self.modelo_degradado:
+            return self.modelo_degradado if self.modelo_degradado != modelo else None
+        modelos = [m for m in self.catalogo.todos() if m.get("parametros_b")]
+        if not modelos:
+            return None
+        menor = min(modelos, key=lambda m: m["parametros_b"])
+        atual = (self.catalogo.info(modelo) or {}).get("parametros_b")
+        if menor["nome"] == modelo or (atual is not None and menor["parametros_b"] >= atual):
+            return None
+        return menor["nome"]
+
+    def registrar(self, modelo, duracao):
+        """Latência total de um turno do modelo (alimenta o sinal de p99)."""
+        self.turnos.registrar(modelo, duracao)
+
+    def estado(self):
+        with self._lock:
+            contagem = dict(self.contagem)
+        return {"ativo": self.ativo, "slo_p99_s": self.slo_s, "degradacoes": contagem}
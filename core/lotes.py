@@ -0,0 +1,243 @@
+import os
+import queue
+import threading
+import time
+import uuid
+
+from config.config import LOTES_CONCORRENCIA, LOTES_MAX_CONCORRENCIA
+from core.agendador import FilaCheia
+from core.cancelamento import Cancelamento
+from utils.json_files import EscritorNDJSON, carregar_json, linha_ndjson, loads, salvar_json
+
+ESTADOS_ATIVOS = ("pendente", "executando")
+
+
+class Lote:
+    def __init__(self, diretorio, estado):
+        self.diretorio = diretorio
+        self.estado = estado          # conteúdo de estado.json
+        self.cancelamento = Cancelamento()
+        self.lock = threading.Lock()
+
+    @property
+    def id(self):
+        return self.estado["id"]
+
+    def caminho(self, nome):
+        return os.path.join(self.diretorio, nome)
+
+
+class GerenciadorLotes:
+    def __init__(self, diretorio, executar, concorrencia=LOTES_CONCORRENCIA):
+        """
+        Jobs de geração em lote, persistidos em disco e retomáveis.
+
+        Cada lote vive em <diretorio>/<id>/: entrada.jsonl (um item por linha),
+        saida.jsonl (um resultado por linha, na ordem em que terminam) e
+        estado.json. O checkpoint é a própria saída: ao retomar, os índices já
+        presentes em saida.jsonl são pulados.
+
+        :param diretorio: Pasta raiz dos lotes.
+        :param executar: Função (item, sessao_id, cancelamento) -> dict de resultado.
+            Deve levantar FilaCheia quando o agendador recusar, para o item ser reenfileirado.
+        :param concorrencia: Itens processados em paralelo por lote (padrão).
+        """
+        self.diretorio = diretorio
+        self.executar = executar
+        self.concorrencia = concorrencia
+        self.lotes = {}
+        self._lock = threading.Lock()
+        os.makedirs(diretorio, exist_ok=True)
+
+    def criar(self, itens, concorrencia=None, padrao=None):
+        """
+        Grava um novo lote e inicia a execução. Retorna o id.
+
+        :param itens: Lista de dicts {"mensagem", "persona", "modelo", "opcoes", "id"}.
+        :param concorrencia: Itens em paralelo (limitado a LOTES_MAX_CONCORRENCIA).
+        :param padrao: Valores aplicados aos itens que não os definem (persona, modelo, opcoes).
+        """
+        id_lote = uuid.uuid4().hex[:12]
+        diretorio = os.path.join(self.diretorio, id_lote)
+        os.makedirs(diretorio)
+        with EscritorNDJSON(os.path.join(diretorio, "entrada.jsonl")) as entrada:
+            for item in itens:
+                entrada.escrever(dict(padrao or {}, **item))
+        lote = Lote(diretorio, {
+            "id": id_lote,
+            "status": "pendente",
+            "total": len(itens),
+            "concluidos": 0,
+            "falhas": 0,
+            "concorrencia": max(1, min(int(concorrencia or self.concorrencia), LOTES_MAX_CONCORRENCIA)),
+            "criado_em": time.time(),
+            "atualizado_em": time.time(),
+        })
+        self._gravar_estado(lote)
+        with self._lock:
+            self.lotes[id_lote] = lote
+        self._iniciar(lote)
+        return id_lote
+
+    def retomar(self):
+        """Recarrega os lotes do disco e retoma os que não terminaram (chamado na inicialização)."""
+        for nome in sorted(os.listdir(self.diretorio)):
+            diretorio = os.path.join(self.diretorio, nome)
+            try:
+                lote = Lote(diretorio, carregar_json(os.path.join(diretorio, "estado.json")))
+            except (OSError, ValueError) as e:
+                print(f"[ERRO] Carregar lote {nome}: {e}")
+                continue
+            with self._lock:
+                self.lotes[lote.id] = lote
+            if lote.estado["status"] in ESTADOS_ATIVOS:
+                self._iniciar(lote)
+
+    def _iniciar(self, lote):
+        threading.Thread(target=self._executar_lote, args=(lote,), daemon=True).start()
+
+    def _executar_lote(self, lote):
+        self._reparar_saida(lote)
+        feitos = self._indices_concluidos(lote)
+        pendentes = queue.Queue()
+        with open(lote.caminho("entrada.jsonl"), "r", encoding="utf-8") as f:
+            for indice, linha in enumerate(f):
+                if indice not in feitos and linha.strip():
+                    pendentes.put((indice, loads(linha)))
+        with lote.lock:
+            lote.estado["status"] = "executando"
+            lote.estado["concluidos"] = len(feitos)
+        self._gravar_estado(lote)
+
+        trabalhadores = [threading.Thread(target=self._trabalhar, args=(lote, pendentes), daemon=True)
+                         for _ in range(lote.estado["concorrencia"])]
+        for t in trabalhadores:
+            t.start()
+        for t in trabalhadores:
+            t.join()
+
+        with lote.lock:
+            lote.estado["status"] = "cancelado" if lote.cancelamento.cancelado else "concluido"
+        self._gravar_estado(lote)
+
+    def _trabalhar(self, lote, pendentes):
+        while not lote.cancelamento.cancelado:
+            try:
+                indice, item = pendentes.get_nowait()
+            except queue.Empty:
+                return
+            inicio = time.time()
+            while True:
+                try:
+                    resultado = self.executar(item, f"lote:{lote.id}", Cancelamento(pai=lote.cancelamento))
+                    break
+                except FilaCheia as e:
+                    # Lote não compete com o tráfego interativo: espera e tenta de novo
+                    if lote.cancelamento.evento.wait(e.retry_after):
+                        return
+                except Exception as e:
+                    resultado = {"status": "erro", "mensagem": str(e)}
+                    break
+            if lote.cancelamento.cancelado and resultado.get("status") == "cancelado":
+                return
+            resultado = dict(resultado, indice=indice, id=item.get("id"), tempo_s=round(time.time() - inicio, 3))
+            self._registrar(lote, resultado)
+
+    def _registrar(self, lote, resultado):
+        with lote.lock:
+            with open(lote.caminho("saida.jsonl"), "ab") as f:
+                f.write(linha_ndjson(resultado))
+                f.flush()
+                os.fsync(f.fileno())
+            lote.estado["concluidos"] += 1
+            if resultado.get("status") == "erro":
+                lote.estado["falhas"] += 1
+        self._gravar_estado(lote)
+
+    def _reparar_saida(self, lote, bloco=64 * 1024):
+        """
+        Corta uma linha final incompleta de saida.jsonl (queda no meio de um
+        acréscimo) antes de retomar: sem isso, o primeiro resultado novo se
+        colaria na cauda quebrada e os dois seriam perdidos.
+        """
+        caminho = lote.caminho("saida.jsonl")
+        if not os.path.exists(caminho):
+            return
+        with open(caminho, "r+b") as f:
+            tamanho = fim = f.seek(0, os.SEEK_END)
+            # Procura a última quebra de linha lendo só o final do arquivo
+            while fim > 0:
+                inicio = max(0, fim - bloco)
+                f.seek(inicio)
+                posicao = f.read(fim - inicio).rfind(b"\n")
+                if posicao >= 0:
+                    fim = inicio + posicao + 1
+                    break
+                fim = inicio
+            if fim < tamanho:
+                print(f"[ERRO] Lote {lote.id}: saida.jsonl com final incompleto, "
+                      f"{tamanho - fim} bytes descartados")
+                f.truncate(fim)
+                f.flush()
+                os.fsync(f.fileno())
+
+    def _indices_concluidos(self, lote):
+        """Índices já gravados em saida.jsonl (linhas ilegíveis são ignoradas)."""
+        feitos = set()
+        try:
+            with open(lote.caminho("saida.jsonl"), "r", encoding="utf-8") as f:
+                for linha in f:
+                    try:
+                        feitos.add(loads(linha)["indice"])
+                    except (ValueError, KeyError):
+                        continue
+        except FileNotFoundError:
+            pass
+        return feitos
+
+    def _gravar_estado(self, lote):
+        """Grava estado.json de forma atômica (arquivo temporário + rename)."""
+        with lote.lock:
+            lote.estado["atualizado_em"] = time.time()
+            salvar_json(lote.caminho("estado.json"), lote.estado, indent=False)
+
+    def cancelar(self, id_lote):
+        lote = self.obter(id_lote)
+        if lote is None or lote.estado["status"] not in ESTADOS_ATIVOS:
+            return False
+        lote.cancelamento.cancelar("usuario")
+        return True
+
+    def obter(self, id_lote):
+        with self._lock:
+            return self.lotes.get(id_lote)
+
+    def estado(self, id_lote=None):
+        """Estado de um lote, ou a lista de todos."""
+        if id_lote is not None:
+            lote = self.obter(id_lote)
+            return dict(lote.estado) if lote else None
+        with self._lock:
+            lotes = list(self.lotes.values())
+        return [dict(l.estado) for l in lotes]
+
+    def resultados(self, id_lote, seguir=False, intervalo=0.5):
+        """
+        Linhas de saida.jsonl; com seguir=True continua lendo até o lote terminar.
+        """
+        lote = self.obter(id_lote)
+        if lote is None:
+            return
+        while not os.path.exists(lote.caminho("saida.jsonl")):
+            if not seguir or lote.estado["status"] not in ESTADOS_ATIVOS:
+                return
+            time.sleep(intervalo)
+        with open(lote.caminho("saida.jsonl"), "r", encoding="utf-8") as f:
+            while True:
+                linha = f.readline()
+                if linha.endswith("\n"):
+                    yield linha
+                    continue
+                if not seguir or lote.estado["status"] not in ESTADOS_ATIVOS:
+                    return
+                time.sleep(intervalo)
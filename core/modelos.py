@@ -0,0 +1,170 @@
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from config.config import KEEP_ALIVE_QUENTE, ORCAMENTO_MEMORIA_MODELOS, MODELOS_INTERVALO_SINCRONIA
+
+
+class GerenciadorModelos:
+    def __init__(self, cliente, keep_alive=KEEP_ALIVE_QUENTE, orcamento=ORCAMENTO_MEMORIA_MODELOS,
+                 intervalo_sincronia=MODELOS_INTERVALO_SINCRONIA):
+        """
+        Mantém os modelos quentes residentes no Ollama e descarrega os frios.
+
+        :param cliente: Instância de ClienteOllama.
+        :param keep_alive: Tempo de permanência enviado ao Ollama para modelos em uso.
+        :param orcamento: Memória máxima (bytes) ocupada pelos modelos residentes.
+        :param intervalo_sincronia: Segundos mínimos entre sincronizações disparadas por uso().
+        """
+        self.cliente = cliente
+        self.keep_alive = keep_alive
+        self.orcamento = orcamento
+        self.intervalo_sincronia = intervalo_sincronia
+        self.residentes = OrderedDict()  # modelo -> info; o último é o usado mais recentemente
+        self._aquecendo = set()
+        self._sincronizando = False
+        self._sincronizado_em = 0
+        self._lock = threading.Lock()
+
+    def aquecer(self, modelo, prompt_sistema=None, bloquear=False):
+        """
+        Pré-carrega o modelo e, se informado, o prompt de sistema da persona,
+        deixando o prefixo no cache do Ollama antes da primeira pergunta.
+        """
+        if not modelo:
+            return
+        chave = (modelo, prompt_sistema)
+        with self._lock:
+            if chave in self._aquecendo:
+                return
+            self._aquecendo.add(chave)
+            info = self.residentes.setdefault(modelo, {"estado": "carregando", "tamanho": 0})
+            if info["estado"] != "pronto":
+                info["estado"] = "carregando"
+            self.residentes.move_to_end(modelo)
+
+        if bloquear:
+            self._aquecer(modelo, prompt_sistema)
+        else:
+            threading.Thread(target=self._aquecer, args=(modelo, prompt_sistema), daemon=True).start()
+
+    def _aquecer(self, modelo, prompt_sistema):
+        inicio = time.time()
+        try:
+            self.cliente.carregar(modelo, self.keep_alive, prompt=prompt_sistema)
+            with self._lock:
+                info = self.residentes.setdefault(modelo, {"tamanho": 0})
+                info.update({"estado": "pronto", "tempo_carga": round(time.time() - inicio, 2),
+                             "ultimo_uso": time.time(), "erro": None})
+        except Exception as e:
+            print(f"[ERRO] Aquecer modelo {modelo}: {e}")
+            with self._lock:
+                self.residentes.setdefault(modelo, {"tamanho": 0}).update({"estado": "erro", "erro": str(e)})
+        finally:
+            with self._lock:
+                self._aquecendo.discard((modelo, prompt_sistema))
+
+        self.sincronizar()
+        self._aplicar_orcamento(protegido=modelo)
+
+    def usar(self, modelo):
+        """
+        Marca o modelo como usado agora (topo da fila LRU). Retorna True se ele não
+        estava residente com tamanho conhecido (a geração vai carregá-lo).
+        """
+        if not modelo:
+            return False
+        with self._lock:
+            info = self.residentes.setdefault(modelo, {"estado": "pronto", "tamanho": 0})
+            carregar = info["estado"] != "pronto" or not info["tamanho"]
+            if info["estado"] != "carregando":
+                info["estado"] = "pronto"  # a própria geração recarrega o modelo se necessário
+            info["ultimo_uso"] = time.time()
+            self.residentes.move_to_end(modelo)
+        return carregar
+
+    @contextmanager
+    def uso(self, modelo):
+        """
+        Marca o modelo como usado durante uma geração. Se ela carregou o modelo,
+        ao final o tamanho dele é lido do /api/ps e o orçamento reaplicado (em
+        segundo plano e no máximo a cada intervalo_sincronia segundos).
+        """
+        carregar = self.usar(modelo)
+        try:
+            yield
+        finally:
+            if carregar:
+                self._agendar_sincronia(modelo)
+
+    def _agendar_sincronia(self, modelo):
+        with self._lock:
+            # Sincronia adiada: o tamanho continua 0 e o próximo uso() tenta de novo
+            if self._sincronizando or time.time() - self._sincronizado_em < self.intervalo_sincronia:
+                return
+            self._sincronizando = True
+            self._sincronizado_em = time.time()
+        threading.Thread(target=self._sincronizar_orcamento, args=(modelo,), daemon=True).start()
+
+    def _sincronizar_orcamento(self, modelo):
+        try:
+            self.sincronizar()
+            self._aplicar_orcamento(protegido=modelo)
+        finally:
+            with self._lock:
+                self._sincronizando = False
+
+    def sincronizar(self):
+        """Atualiza tamanhos e estado a partir de /api/ps."""
+        try:
+            carregados = {m.get("name") or m.get("model"): m for m in self.cliente.em_execucao()}
+        except Exception as e:
+            print(f"[ERRO] Consultar modelos carregados: {e}")
+            return
+        with self._lock:
+            for modelo, info in self.residentes.items():
+                ps = carregados.get(modelo)
+                if ps:
+                    info["tamanho"] = ps.get("size_vram") or ps.get("size", 0)
+                    info["expira_em"] = ps.get("expires_at")
+                    if info["estado"] != "carregando":
+                        info["estado"] = "pronto"
+                elif info["estado"] == "pronto":
+                    info["estado"] = "descarregado"
+                    info["tamanho"] = 0
+
+    def _aplicar_orcamento(self, protegido=None):
+        """Descarrega modelos menos usados até caber no orçamento de memória."""
+        with self._lock:
+            total = sum(i["tamanho"] for i in self.residentes.values() if i["estado"] == "pronto")
+            vitimas = []
+            for modelo, info in self.residentes.items():
+                if total <= self.orcamento:
+                    break
+                if modelo == protegido or info["estado"] != "pronto":
+                    continue
+                vitimas.append(modelo)
+                total -= info["tamanho"]
+
+        for modelo in vitimas:
+            try:
+                self.cliente.descarregar(modelo)
+                with self._lock:
+                    self.residentes[modelo].update({"estado": "descarregado", "tamanho": 0})
+            except Exception as e:
+                print(f"[ERRO] Descarregar modelo {modelo}: {e}")
+
+    def estado(self):
+        """Resumo do estado de carga de cada modelo conhecido, do mais recente ao mais antigo."""
+        agora = time.time()
+        with self._lock:
+            return [{
+                "modelo": modelo,
+                "estado": info["estado"],
+                "tamanho_mb": round(info.get("tamanho", 0) / 1024 ** 2, 1),
+                "ocioso_s": round(agora - info["ultimo_uso"], 1) if info.get("ultimo_uso") else None,
+                "tempo_carga": info.get("tempo_carga"),
+                "expira_em": info.get("expira_em"),
+                "erro": info.get("erro"),
+            } for modelo, info in reversed(self.residentes.items())]
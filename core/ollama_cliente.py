@@ -0,0 +1,294 @@
+import contextvars
+import json
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import requests
+
+from config.config import HEDGE_ATIVO, HEDGE_PERCENTIL, HEDGE_MIN_AMOSTRAS, HEDGE_ATRASO_MIN
+from core.backends import PoolBackends, JanelaLatencias, SemBackendDisponivel
+from core.cancelamento import Cancelamento, GeracaoCancelada, AdaptadorAbortavel, abortar_ao_cancelar
+from core.coalescencia import Coalescedor
+from utils.metricas import ETAPAS
+from utils.rastreamento import rastreador
+
+
+def deterministico(payload):
+    """Gerações com temperature 0 ou seed fixa produzem sempre a mesma saída."""
+    opcoes = payload.get("options", {})
+    return opcoes.get("temperature") == 0 or opcoes.get("seed") is not None
+
+
+def falha_do_backend(erro):
+    """
+    Erros que contam para o circuit breaker: conexão, timeout, stream interrompido e HTTP 5xx.
+    Erros da própria requisição (HTTP 4xx, "error" do Ollama como modelo inexistente ou
+    opção inválida) não dizem nada sobre a saúde do backend.
+    """
+    if isinstance(erro, requests.HTTPError):
+        return erro.response is None or erro.response.status_code >= 500
+    return isinstance(erro, requests.RequestException)
+
+
+class ClienteOllama:
+    def __init__(self, pool=None, timeout=30):
+        """
+        Cliente HTTP mínimo para a API do Ollama, distribuído entre os backends do pool.
+
+        :param pool: Instância de PoolBackends (padrão: backends de config.OLLAMA_BACKENDS).
+        :param timeout: Timeout padrão (segundos) das chamadas de geração.
+        """
+        self.pool = pool or PoolBackends()
+        self.timeout = timeout
+        self.http = requests.Session()
+        self.http.mount("http://", AdaptadorAbortavel())
+        self.http.mount("https://", AdaptadorAbortavel())
+        self.coalescedor = Coalescedor()
+        self.latencias = JanelaLatencias()
+        self.estatisticas = {"hedges": 0, "hedges_vencedores": 0, "tokens_economizados": 0,
+                             "canceladas": Counter()}
+        self._lock_estatisticas = threading.Lock()  # atualizadas também pelas threads do hedge
+        self._executor = ThreadPoolExecutor(max_workers=32, thread_name_prefix="ollama")
+
+    def _post(self, caminho, payload, timeout, modelo=None, backend=None):
+        """POST num backend escolhido pelo pool, registrando sucesso/falha."""
+        backend = backend or self.pool.escolher(modelo)
+        with self.pool.reservar(backend):
+            try:
+                resposta = self.http.post(backend.url(caminho), json=payload, timeout=timeout)
+                resposta.raise_for_status()
+                dados = resposta.json()
+            except (requests.RequestException, ValueError) as e:
+                self._registrar_erro(backend, e)
+                raise
+        self.pool.registrar_sucesso(backend, modelo)
+        return dados
+
+    def _registrar_erro(self, backend, erro):
+        """Falha do backend abre o circuito; erro da requisição (4xx, "error" do Ollama) prova que ele responde."""
+        if falha_do_backend(erro):
+            self.pool.registrar_falha(backend)
+        else:
+            self.pool.registrar_sucesso(backend)
+
+    def _contar(self, chave):
+        with self._lock_estatisticas:
+            self.estatisticas[chave] += 1
+
+    def estado(self):
+        """Cópia das estatísticas de geração (o dict vivo muda durante a serialização)."""
+        with self._lock_estatisticas:
+            return dict(self.estatisticas, canceladas=dict(self.estatisticas["canceladas"]))
+
+    def gerar(self, payload, timeout=None, coalescer=None, cancelamento=None, ao_pedaco=None, etapas=False):
+        """
+        Executa uma geração não-streaming em /api/generate e retorna o JSON.
+
+        :param coalescer: True junta chamadas idênticas simultâneas numa única geração;
+            None (padrão) faz isso apenas quando a geração é determinística.
+        :param cancelamento: Cancelamento da requisição (usuário, prazo ou desconexão).
+            Com coalescência, quem é cancelado para de esperar na hora, mas a geração
+            compartilhada só é abortada quando todos os participantes desistiram.
+        :param ao_pedaco: Função chamada com cada pedaço de texto assim que chega.
+            Desativa coalescência e hedging, que não têm um único fluxo de pedaços:
+            rascunhos idênticos simultâneos geram cada um o seu (a resposta final
+            do modo progressivo não usa ao_pedaco e continua coalescida).
+        :param etapas: Registra primeiro token e geração nos histogramas de etapas do turno.
+            Só a geração da resposta do turno passa True (resumos, rascunhos e lotes não),
+            e com hedging contam apenas os tempos da tentativa vencedora.
+        """
+        if ao_pedaco:
+            output, tempos = self._gerar(payload, timeout, cancelamento, ao_pedaco)
+        else:
+            if coalescer is None:
+                coalescer = deterministico(payload)
+            if coalescer:
+                output, tempos = self.coalescedor.executar(
+                    Coalescedor.chave(payload), lambda compartilhado: self._gerar(payload, timeout, compartilhado),
+                    cancelamento)
+                output = dict(output)  # cada participante recebe a sua cópia
+            else:
+                output, tempos = self._gerar(payload, timeout, cancelamento)
+        if etapas:
+            for etapa, segundos in tempos.items():
+                ETAPAS.observar(segundos, etapa)
+        return output
+
+    def _gerar(self, payload, timeout=None, cancelamento=None, ao_pedaco=None):
+        """
+        Geração com hedging: se a primeira tentativa passar do p95 de latência
+        do modelo, dispara uma cópia em outro backend e cancela a perdedora.
+        Retorna (output, tempos da tentativa vencedora).
+        """
+        modelo = payload.get("model")
+        timeout = timeout or self.timeout
+        primario = self.pool.escolher(modelo)
+        atraso = None if ao_pedaco else self._atraso_hedge(modelo)
+        if atraso is None:
+            return self._gerar_em(primario, payload, timeout, Cancelamento(pai=cancelamento),
+                                  ao_pedaco=ao_pedaco)
+
+        tentativas = {}
+        tentativa_cancelamento = Cancelamento(pai=cancelamento)
+        # Cada tentativa roda com uma cópia do contexto, para os spans entrarem no rastro do turno
+        primeira = self._executor.submit(contextvars.copy_context().run, self._gerar_em, primario, payload,
+                                         timeout, tentativa_cancelamento)
+        tentativas[primeira] = tentativa_cancelamento
+        feitas, _ = wait(tentativas, timeout=atraso)
+        if not feitas:
+            try:
+                secundario = self.pool.escolher(modelo, excluir=(primario,))
+            except SemBackendDisponivel:
+                secundario = None
+            if secundario:
+                tentativa_cancelamento = Cancelamento(pai=cancelamento)
+                tentativa = self._executor.submit(contextvars.copy_context().run, self._gerar_em, secundario,
+                                                  payload, timeout, tentativa_cancelamento)
+                tentativas[tentativa] = tentativa_cancelamento
+                self._contar("hedges")
+
+        erro, pendentes = None, set(tentativas)
+        while pendentes:
+            feitas, pendentes = wait(pendentes, return_when=FIRST_COMPLETED)
+            for tentativa in feitas:
+                if tentativa.exception() is None:
+                    for outra in pendentes:
+                        tentativas[outra].cancelar("hedge")
+                    if tentativa is not primeira:
+                        self._contar("hedges_vencedores")
+                    return tentativa.result()
+                erro = tentativa.exception()
+        raise erro
+
+    def _atraso_hedge(self, modelo):
+        """Atraso até o hedge, ou None se não houver outro backend ou amostras suficientes."""
+        if not HEDGE_ATIVO or sum(b.saudavel for b in self.pool.backends) < 2:
+            return None
+        p95 = self.latencias.percentil(modelo, HEDGE_PERCENTIL, HEDGE_MIN_AMOSTRAS)
+        return max(p95, HEDGE_ATRASO_MIN) if p95 is not None else None
+
+    def _gerar_em(self, backend, payload, timeout, cancelamento, medir=True, ao_pedaco=None):
+        """
+        Geração em streaming num backend específico, agregada num único JSON
+        (como a resposta não-streaming). Aborta a conexão se for cancelada.
+        """
+        with rastreador.span("ollama.gerar", backend=backend.host, modelo=payload.get("model")) as span:
+            output, tempos = self._transmitir(backend, payload, timeout, cancelamento, medir, ao_pedaco)
+            if span is not None:
+                span.definir(tokens_entrada=output.get("prompt_eval_count"), tokens_saida=output.get("eval_count"))
+            return output, tempos
+
+    def _transmitir(self, backend, payload, timeout, cancelamento, medir, ao_pedaco):
+        """
+        Lê o stream NDJSON do /api/generate de um backend e agrega os pedaços.
+        Retorna (output, {"primeiro_token": s, "geracao": s}).
+        """
+        inicio = time.time()
+        partes, final, tempos = [], {}, {}
+        restante = cancelamento.restante()
+        if restante is not None:
+            timeout = min(timeout, max(restante, 0.1))
+        with self.pool.reservar(backend):
+            try:
+                if cancelamento.cancelado:
+                    raise GeracaoCancelada("Geração cancelada antes de começar.")
+                with abortar_ao_cancelar(cancelamento), \
+                        self.http.post(backend.url("/api/generate"), json=dict(payload, stream=True),
+                                       stream=True, timeout=timeout) as resposta:
+                    resposta.raise_for_status()
+                    for linha in resposta.iter_lines(chunk_size=None):
+                        if cancelamento.cancelado:
+                            break
+                        if not linha:
+                            continue
+                        pedaco = json.loads(linha)
+                        if pedaco.get("error"):
+                            raise ValueError(pedaco["error"])
+                        if not partes:
+                            tempos["primeiro_token"] = time.time() - inicio
+                            rastreador.evento("primeiro_token")
+                        partes.append(pedaco.get("response", ""))
+                        if ao_pedaco and pedaco.get("response"):
+                            ao_pedaco(pedaco["response"])
+                        if pedaco.get("done"):
+                            final = pedaco
+                            break
+            except Exception as e:
+                if not cancelamento.cancelado:
+                    self._registrar_erro(backend, e)
+                    raise
+            if cancelamento.cancelado:
+                # Tokens que o backend deixou de gerar (limite superior: num_predict)
+                num_predict = payload.get("options", {}).get("num_predict") or 0
+                with self._lock_estatisticas:
+                    self.estatisticas["tokens_economizados"] += max(0, num_predict - len(partes))
+                    self.estatisticas["canceladas"][cancelamento.motivo] += 1
+                raise GeracaoCancelada(f"Geração cancelada ({cancelamento.motivo}).")
+        self.pool.registrar_sucesso(backend, payload.get("model"))
+        tempos["geracao"] = time.time() - inicio
+        if medir:
+            self.latencias.registrar(payload.get("model"), tempos["geracao"])
+        return dict(final, response="".join(partes)), tempos
+
+    def carregar(self, modelo, keep_alive, prompt=None, timeout=300):
+        """
+        Carrega o modelo na memória do Ollama.
+
+        Sem prompt, o Ollama apenas carrega os pesos. Com prompt, gera um único
+        token para que o prefixo fique no cache KV do modelo.
+        """
+        payload = {"model": modelo, "keep_alive": keep_alive, "stream": False}
+        if prompt:
+            payload["prompt"] = prompt
+            payload["options"] = {"num_predict": 1}
+        # Carga não entra no hedge nem na janela de latências das gerações
+        output, _ = self._gerar_em(self.pool.escolher(modelo), payload, timeout, Cancelamento(), medir=False)
+        return output
+
+    def descarregar(self, modelo):
+        """Remove o modelo da memória imediatamente (keep_alive=0) em todos os backends que o têm."""
+        for backend in self.pool.backends:
+            if modelo in backend.modelos_carregados:
+                self._post("/api/generate", {"model": modelo, "keep_alive": 0, "stream": False},
+                           self.timeout, backend=backend)
+                self.pool.registrar_descarga(backend, modelo)
+
+    def listar_tags(self):
+        """Lista os modelos instalados (/api/tags), unindo todos os backends saudáveis."""
+        modelos, respondeu = {}, False
+        for backend in self.pool.backends:
+            if not backend.saudavel:
+                continue
+            try:
+                resposta = self.http.get(backend.url("/api/tags"), timeout=5)
+                resposta.raise_for_status()
+            except requests.RequestException as e:
+                if falha_do_backend(e):
+                    self.pool.registrar_falha(backend)
+                continue
+            respondeu = True
+            for modelo in resposta.json().get("models", []):
+                modelos.setdefault(modelo.get("name") or modelo.get("model"), modelo)
+        if not respondeu:
+            raise requests.ConnectionError("Nenhum backend Ollama respondeu a /api/tags.")
+        return list(modelos.values())
+
+    def mostrar(self, modelo):
+        """Retorna detalhes de um modelo (/api/show), incluindo model_info."""
+        return self._post("/api/show", {"model": modelo}, 10)
+
+    def em_execucao(self):
+        """Lista os modelos carregados (/api/ps) em todos os backends saudáveis."""
+        modelos = []
+        for backend in self.pool.backends:
+            if not backend.saudavel:
+                continue
+            try:
+                resposta = self.http.get(backend.url("/api/ps"), timeout=5)
+                resposta.raise_for_status()
+            except requests.RequestException:
+                continue
+            modelos.extend(dict(m, backend=backend.host) for m in resposta.json().get("models", []))
+        return modelos
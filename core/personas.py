@@ -0,0 +1,166 @@
+import os
+import threading
+import time
+
+import numpy as np
+
+from config.config import PERSONALIDADE_PADRAO, PERSONAS_INTERVALO_RECARGA, FEWSHOT_K, FEWSHOT_MAX_TOKENS
+from core.contexto import ROTULOS
+from utils.json_files import carregar_json
+from utils.tokens import contar_tokens
+
+
+class RegistroPersonas:
+    def __init__(self, diretorio, intervalo=PERSONAS_INTERVALO_RECARGA, codificador=None):
+        """
+        Registro em memória das personalidades, compiladas uma única vez.
+
+        Os arquivos são relidos apenas quando o mtime muda, por uma thread de
+        monitoramento; as consultas no caminho da requisição não fazem I/O.
+
+        :param diretorio: Pasta com os arquivos <nome>.json.
+        :param intervalo: Segundos entre verificações de mudança.
+        :param codificador: Função lista de textos -> matriz de embeddings, usada para
+            indexar os exemplos de conversa na carga (None = sem seleção por similaridade).
+        """
+        self.diretorio = diretorio
+        self.intervalo = intervalo
+        self.codificador = codificador
+        self.personas = {}   # nome -> persona compilada
+        self._mtimes = {}    # nome -> mtime do arquivo carregado
+        self._lock = threading.Lock()
+        self.padrao = self.compilar("padrao", PERSONALIDADE_PADRAO)
+        self.recarregar()
+
+    def recontar(self):
+        """Recompila todas as personas (contagens de tokens feitas antes de o tokenizador carregar)."""
+        self.padrao = self.compilar("padrao", PERSONALIDADE_PADRAO)
+        with self._lock:
+            self._mtimes.clear()
+        self.recarregar()
+
+    def iniciar_monitoramento(self):
+        """Inicia a thread que recarrega personas alteradas em disco."""
+        threading.Thread(target=self._laco, daemon=True).start()
+
+    def _laco(self):
+        while True:
+            time.sleep(self.intervalo)
+            self.recarregar()
+
+    def recarregar(self):
+        """Recompila apenas os arquivos novos ou alterados e remove os apagados."""
+        try:
+            arquivos = {f[:-5]: os.path.join(self.diretorio, f)
+                        for f in os.listdir(self.diretorio) if f.endswith(".json")}
+        except OSError as e:
+            print(f"[ERRO] Listar personalidades: {e}")
+            return
+
+        novas = {}
+        for nome, caminho in arquivos.items():
+            try:
+                mtime = os.path.getmtime(caminho)
+            except OSError:
+                continue
+            if self._mtimes.get(nome) == mtime:
+                continue
+            try:
+                persona = self.compilar(nome, carregar_json(caminho))
+                self._indexar_exemplos(persona)
+                novas[nome] = (mtime, persona)
+            except (OSError, ValueError) as e:
+                print(f"[ERRO] Carregar personalidade {nome}: {e}")
+                self._mtimes[nome] = mtime  # não tenta de novo até o arquivo mudar
+
+        with self._lock:
+            for nome, (mtime, persona) in novas.items():
+                self.personas[nome] = persona
+                self._mtimes[nome] = mtime
+            for nome in set(self.personas) - set(arquivos):
+                del self.personas[nome]
+                self._mtimes.pop(nome, None)
+
+    @staticmethod
+    def compilar(nome, dados):
+        """
+        Converte o JSON da persona num template pronto para o prompt.
+
+        Aceita o formato atual (instrucao + simulacao_conversas) e o legado (system).
+        """
+        system = dados.get("instrucao") or dados.get("system") or PERSONALIDADE_PADRAO["system"]
+        exemplos = []
+        for conversa in dados.get("simulacao_conversas", []):
+            usuario = conversa.get("usuario")
+            resposta = next((v for k, v in conversa.items() if k != "usuario"), None)
+            if usuario and resposta:
+                texto = f"{ROTULOS['user']}: {usuario}\n{ROTULOS['assistant']}: {resposta}"
+                exemplos.append({"usuario": usuario, "resposta": resposta,
+                                 "texto": texto, "tokens": contar_tokens(texto)})
+        return {
+            "nome": nome,
+            "titulo": dados.get("nome", nome),
+            "descricao": dados.get("descricao", ""),
+            "system": system,
+            "tokens_system": contar_tokens(system),
+            "exemplos": exemplos,
+            "vetores": None,  # embeddings normalizados das perguntas dos exemplos
+            "complexidade": dados.get("complexidade"),  # 0 a 1, opcional: puxa o roteador para modelos maiores
+        }
+
+    def _indexar_exemplos(self, persona):
+        """Calcula uma única vez os embeddings das perguntas de exemplo da persona."""
+        if not self.codificador or not persona["exemplos"]:
+            return
+        try:
+            vetores = np.asarray(self.codificador([e["usuario"] for e in persona["exemplos"]]), dtype=np.float32)
+        except Exception as e:
+            print(f"[ERRO] Indexar exemplos da persona {persona['nome']}: {e}")
+            return
+        normas = np.linalg.norm(vetores, axis=1, keepdims=True)
+        persona["vetores"] = vetores / np.maximum(normas, 1e-9)
+
+    def selecionar_exemplos(self, nome, vetor=None, k=FEWSHOT_K, max_tokens=FEWSHOT_MAX_TOKENS):
+        """
+        Exemplos de conversa da persona mais parecidos com a pergunta, dentro do orçamento.
+
+        :param nome: Nome da persona.
+        :param vetor: Embedding da pergunta (o mesmo usado na busca de memórias).
+        :param k: Máximo de exemplos.
+        :param max_tokens: Tokens máximos somando os exemplos escolhidos.
+        :return: Textos dos exemplos, do mais ao menos parecido.
+        """
+        persona = self.obter(nome)
+        exemplos = persona["exemplos"]
+        if not exemplos or k <= 0:
+            return []
+        if persona["vetores"] is not None and vetor is not None:
+            consulta = np.asarray(vetor, dtype=np.float32)
+            similaridades = persona["vetores"] @ (consulta / max(np.linalg.norm(consulta), 1e-9))
+            ordem = np.argsort(-similaridades)
+        else:
+            ordem = range(len(exemplos))
+
+        escolhidos, usados = [], 0
+        for i in ordem:
+            exemplo = exemplos[i]
+            if usados + exemplo["tokens"] > max_tokens:
+                continue
+            escolhidos.append(exemplo["texto"])
+            usados += exemplo["tokens"]
+            if len(escolhidos) == k:
+                break
+        return escolhidos
+
+    def obter(self, nome):
+        """Persona compilada pelo nome; a padrão se não existir."""
+        with self._lock:
+            return self.personas.get(nome, self.padrao)
+
+    def existe(self, nome):
+        with self._lock:
+            return nome in self.personas
+
+    def nomes(self):
+        with self._lock:
+            return sorted(self.personas)
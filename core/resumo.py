@@ -0,0 +1,122 @@
+import threading
+
+from config.config import (MODELO_RESUMO, RESUMO_LIMIAR_TOKENS, RESUMO_MANTER_TOKENS, RESUMO_MAX_TOKENS,
+                           HISTORICO_MAX_MENSAGENS)
+from core.contexto import ROTULOS
+from utils.tokens import tokens_mensagem
+
+INSTRUCAO_RESUMO = (
+    "Você mantém o resumo de uma conversa entre um usuário e um assistente. "
+    "Atualize o resumo atual incorporando as novas mensagens. Preserve fatos, "
+    "nomes, decisões, preferências do usuário e perguntas em aberto. "
+    "Responda apenas com o novo resumo, em português, de forma concisa."
+)
+
+
+class ResumidorHistorico:
+    def __init__(self, cliente, modelo=MODELO_RESUMO, limiar_tokens=RESUMO_LIMIAR_TOKENS,
+                 manter_tokens=RESUMO_MANTER_TOKENS, max_tokens=RESUMO_MAX_TOKENS):
+        """
+        Compacta o histórico antigo num resumo incremental, em segundo plano.
+
+        :param cliente: Instância de ClienteOllama.
+        :param modelo: Modelo usado para resumir (None = modelo da sessão).
+        :param limiar_tokens: Tokens de histórico a partir dos quais a compactação é disparada.
+        :param manter_tokens: Tokens das mensagens mais recentes que ficam fora do resumo.
+        :param max_tokens: Limite de tokens do resumo gerado.
+
+        Quem altera sessao["historico"] deve segurar lock_historico: a compactação
+        remove mensagens do início da lista em outra thread.
+        """
+        self.cliente = cliente
+        self.modelo = modelo
+        self.limiar_tokens = limiar_tokens
+        self.manter_tokens = manter_tokens
+        self.max_tokens = max_tokens
+        self._em_andamento = False
+        self._lock = threading.Lock()
+        self.lock_historico = threading.RLock()
+
+    def limitar(self, sessao, max_mensagens=HISTORICO_MAX_MENSAGENS):
+        """
+        Limite duro do histórico, para quando a compactação falha ou não há modelo
+        para resumir: descarta os pares mais antigos sem resumo. As descartadas
+        contam em resumo_mensagens (o log da sessão usa esse total ao recarregar).
+        Retorna quantas mensagens saíram.
+        """
+        with self.lock_historico:
+            historico = sessao["historico"]
+            excedente = len(historico) - max_mensagens
+            if excedente <= 0:
+                return 0
+            excedente += excedente % 2  # não separa pergunta de resposta
+            del historico[:excedente]
+            sessao["resumo_mensagens"] = sessao.get("resumo_mensagens", 0) + excedente
+            return excedente
+
+    def verificar(self, sessao, max_mensagens=None):
+        """Dispara a compactação se o histórico passou do limiar de tokens ou de mensagens."""
+        historico = sessao["historico"]
+        total = sum(tokens_mensagem(m) for m in historico)
+        if total <= self.limiar_tokens and (not max_mensagens or len(historico) <= max_mensagens):
+            return
+        with self._lock:
+            if self._em_andamento:
+                return
+            self._em_andamento = True
+        threading.Thread(target=self._compactar, args=(sessao, max_mensagens), daemon=True).start()
+
+    def _compactar(self, sessao, max_mensagens=None):
+        try:
+            with self.lock_historico:
+                historico = sessao["historico"]
+                antigas = self._selecionar_antigas(historico, max_mensagens)
+            if not antigas:
+                return
+            novo = self._gerar_resumo(sessao.get("modelo"), sessao.get("resumo", ""), antigas)
+            if not novo:
+                return
+            # Só remove se as mensagens resumidas ainda estão no início (a sessão pode ter sido resetada)
+            with self.lock_historico:
+                if sessao["historico"] is historico and all(a is b for a, b in zip(historico, antigas)):
+                    del historico[:len(antigas)]
+                    sessao["resumo"] = novo
+                    sessao["resumo_mensagens"] = sessao.get("resumo_mensagens", 0) + len(antigas)
+        except Exception as e:
+            print(f"[ERRO] Resumir histórico: {e}")
+        finally:
+            with self._lock:
+                self._em_andamento = False
+
+    def _selecionar_antigas(self, historico, max_mensagens=None):
+        """Mensagens mais antigas, em pares, fora da janela recente de manter_tokens."""
+        recentes, total = 0, 0
+        for mensagem in reversed(historico):
+            total += tokens_mensagem(mensagem)
+            if total > self.manter_tokens:
+                break
+            recentes += 1
+        if max_mensagens:
+            recentes = min(recentes, max_mensagens // 2)
+        quantidade = len(historico) - max(recentes, 2)
+        quantidade -= quantidade % 2  # não separa pergunta de resposta
+        return list(historico[:quantidade]) if quantidade > 0 else []
+
+    def _gerar_resumo(self, modelo_sessao, resumo_atual, mensagens):
+        modelo = self.modelo or modelo_sessao
+        if not modelo:
+            return None
+        linhas = "\n".join(f"{ROTULOS.get(m['role'], m['role'])}: {m['content']}" for m in mensagens)
+        prompt = (f"{INSTRUCAO_RESUMO}\n\nResumo atual:\n{resumo_atual or '(vazio)'}\n\n"
+                  f"Novas mensagens:\n{linhas}\n\nNovo resumo:")
+        output = self.cliente.gerar({
+            "model": modelo,
+            "prompt": prompt,
+            "stream": False,
+            "options": {"temperature": 0.2, "num_predict": self.max_tokens},
+        }, timeout=120)
+        return output.get("response", "").strip()
+
+    def resumir(self, sessao):
+        """Resumo síncrono da conversa inteira (resumo acumulado + histórico), sem alterar a sessão."""
+        return self._gerar_resumo(sessao.get("modelo"), sessao.get("resumo", ""), sessao["historico"])
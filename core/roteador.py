@@ -0,0 +1,103 @@
+import re
+import threading
+from collections import Counter, defaultdict
+
+from config.config import ROTEAMENTO_LIMIARES
+from core.backends import JanelaLatencias
+from utils.tokens import contar_tokens
+
+ROTAS = ("simples", "media", "complexa")
+
+# Classificador mínimo: padrões que indicam pedidos que exigem raciocínio ou código
+PADROES_COMPLEXOS = [
+    (re.compile(r"```|\bdef |\bclass |\bfunction\b|\bSELECT\b|[{};]\s*$", re.M), 0.5),
+    (re.compile(r"\b(implemente|programe|codigo|código|debug|erro no|stack ?trace)\b", re.I), 0.4),
+    (re.compile(r"\b(explique|compare|analise|análise|demonstre|justifique|passo a passo|por que|porque)\b", re.I), 0.35),
+    (re.compile(r"\b(calcule|equa[cç][aã]o|integral|deriva|probabilidade|prove)\b|\d+\s*[-+*/^]\s*\d+", re.I), 0.35),
+    (re.compile(r"\b(resuma|traduza|reescreva|liste)\b", re.I), 0.15),
+]
+PADROES_SIMPLES = re.compile(r"^\s*(oi|ol[aá]|bom dia|boa tarde|boa noite|obrigad[oa]|valeu|tchau|ok|sim|n[aã]o)\b", re.I)
+
+
+class RoteadorModelos:
+    def __init__(self, catalogo, limiares=ROTEAMENTO_LIMIARES):
+        """
+        Escolhe o modelo de cada turno pela complexidade do pedido.
+
+        A pontuação (0 a 1) combina tamanho da pergunta, tamanho do contexto
+        recuperado, a complexidade declarada da persona e um classificador de
+        padrões. Pontuação baixa vai para o menor modelo instalado; só pedidos
+        complexos sobem para os maiores.
+
+        :param catalogo: CatalogoModelos (modelos disponíveis e tamanho em parâmetros).
+        :param limiares: Pontuações a partir das quais a rota é "media" e "complexa".
+        """
+        self.catalogo = catalogo
+        self.limiares = limiares
+        self.latencias = JanelaLatencias()
+        self.estatisticas = defaultdict(lambda: {"turnos": 0, "tokens": 0, "segundos_geracao": 0.0,
+                                                 "modelos": Counter()})
+        self._lock = threading.Lock()
+
+    def classificar(self, pergunta):
+        """Probabilidade grosseira (0 a 1) de o pedido exigir um modelo maior."""
+        if PADROES_SIMPLES.match(pergunta) and len(pergunta) < 40:
+            return 0.0
+        pontos = sum(peso for padrao, peso in PADROES_COMPLEXOS if padrao.search(pergunta))
+        pontos += 0.1 * max(0, pergunta.count("?") - 1)
+        return min(1.0, pontos)
+
+    def pontuar(self, pergunta, tokens_contexto=0, persona=None):
+        tokens_pergunta = contar_tokens(pergunta)
+        pontuacao = (0.25 * min(1.0, tokens_pergunta / 300)
+                     + 0.15 * min(1.0, tokens_contexto / 1500)
+                     + 0.6 * self.classificar(pergunta))
+        if persona and persona.get("complexidade") is not None:
+            pontuacao = max(pontuacao, float(persona["complexidade"]))
+        return round(min(1.0, pontuacao), 3)
+
+    def modelos_por_tamanho(self, modelos):
+        """Modelos disponíveis com tamanho conhecido, do menor para o maior."""
+        infos = [self.catalogo.info(m) or {} for m in modelos]
+        return [i["nome"] for i in sorted((i for i in infos if i.get("parametros_b")),
+                                          key=lambda i: i["parametros_b"])]
+
+    def escolher(self, modelos, pergunta, tokens_contexto=0, persona=None, padrao=None):
+        """
+        Retorna (modelo, rota, pontuacao) para o turno.
+
+        :param modelos: Nomes dos modelos disponíveis (carregar_modelos()).
+        :param padrao: Modelo usado se nenhum tiver tamanho conhecido no catálogo.
+        """
+        pontuacao = self.pontuar(pergunta, tokens_contexto, persona)
+        rota = ROTAS[sum(pontuacao >= limiar for limiar in self.limiares)]
+        ordenados = self.modelos_por_tamanho(modelos)
+        if not ordenados:
+            return padrao, rota, pontuacao
+        # simples -> menor, complexa -> maior, media -> intermediário
+        indice = {"simples": 0, "media": (len(ordenados) - 1) // 2, "complexa": len(ordenados) - 1}[rota]
+        return ordenados[indice], rota, pontuacao
+
+    def registrar(self, rota, modelo, duracao, output):
+        """Latência do turno e tokens/s da geração (eval_count / eval_duration do Ollama)."""
+        self.latencias.registrar(rota, duracao)
+        with self._lock:
+            estatisticas = self.estatisticas[rota]
+            estatisticas["turnos"] += 1
+            estatisticas["modelos"][modelo] += 1
+            if output.get("eval_count") and output.get("eval_duration"):
+                estatisticas["tokens"] += output["eval_count"]
+                estatisticas["segundos_geracao"] += output["eval_duration"] / 1e9
+
+    def estado(self):
+        with self._lock:
+            rotas = {}
+            for rota, e in self.estatisticas.items():
+                rotas[rota] = {
+                    "turnos": e["turnos"],
+                    "modelos": dict(e["modelos"]),
+                    "tokens_por_s": round(e["tokens"] / e["segundos_geracao"], 1) if e["segundos_geracao"] else None,
+                    "latencia_p50": self.latencias.percentil(rota, 0.5),
+                    "latencia_p95": self.latencias.percentil(rota, 0.95),
+                }
+        return {"limiares": self.limiares, "rotas": rotas}
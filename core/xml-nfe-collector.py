@@ -1,10 +1,13 @@
 import os
 import sqlite3
 import xml.etree.ElementTree as ET
-import json
-from collections import defaultdict
+import sys
 from datetime import datetime
 
+# Executado direto (python core/xml-nfe-collector.py): a raiz do projeto precisa estar no path
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from utils.json_files import EscritorNDJSON, salvar_json
+
 def criar_banco():
     conn = sqlite3.connect('nfe.db')
     c = conn.cursor()
@@ -134,7 +137,27 @@ def processar_pasta(caminho_pasta: str) -> None:
         caminho_arquivo = os.path.join(caminho_pasta, arquivo)
         processar_arquivo(caminho_arquivo)
 
+def _notas_com_itens(cursor):
+    """Agrupa as linhas do JOIN (ordenadas por nota) em notas com a lista de itens, uma nota por vez."""
+    nota_atual, nota = None, None
+    for nota_id, chave_emitente, nome_loja, data_emissao, valor_total, nome_item, valor_item in cursor:
+        if nota_id != nota_atual:
+            if nota is not None:
+                yield nota
+            nota_atual = nota_id
+            nota = {"chave_emitente": chave_emitente, "nome_loja": nome_loja,
+                    "data_emissao": data_emissao, "valor_total": valor_total, "itens": []}
+        if nome_item:
+            nota['itens'].append({"nome_item": nome_item, "valor_item": valor_item})
+    if nota is not None:
+        yield nota
+
 def exportar_para_json(caminho_saida: str = 'exportacao_nfe.json') -> None:
+    """
+    Exporta as notas com seus itens. Com extensão .ndjson/.jsonl grava em streaming
+    (uma nota por linha, sem carregar tudo na memória); senão, um único JSON indentado.
+    A gravação é atômica nos dois casos.
+    """
     conn = sqlite3.connect('nfe.db')
     c = conn.cursor()
 
@@ -142,29 +165,21 @@ def exportar_para_json(caminho_saida: str = 'exportacao_nfe.json') -> None:
         SELECT n.id, n.chave_emitente, n.nome_loja, n.data_emissao, n.valor_total, i.nome_item, i.valor_item
         FROM notas_fiscais n
         LEFT JOIN itens_nota i ON n.id = i.nota_id
+        ORDER BY n.id, i.id
     ''')
 
-    rows = c.fetchall()
-
-    notas = defaultdict(lambda: {"itens": []})
-
-    for row in rows:
-        nota_id, chave_emitente, nome_loja, data_emissao, valor_total, nome_item, valor_item = row
-
-        nota = notas[nota_id]
-        nota['chave_emitente'] = chave_emitente
-        nota['nome_loja'] = nome_loja
-        nota['data_emissao'] = data_emissao
-        nota['valor_total'] = valor_total
-
-        if nome_item:
-            nota['itens'].append({"nome_item": nome_item, "valor_item": valor_item})
-
-    with open(caminho_saida, 'w', encoding='utf-8') as f:
-        json.dump(list(notas.values()), f, indent=4, ensure_ascii=False)
+    if caminho_saida.endswith(('.ndjson', '.jsonl')):
+        with EscritorNDJSON(caminho_saida) as saida:
+            for nota in _notas_com_itens(c):
+                saida.escrever(nota)
+        total = saida.registros
+    else:
+        notas = list(_notas_com_itens(c))
+        salvar_json(caminho_saida, notas)
+        total = len(notas)
 
     conn.close()
-    print(f"Exportação concluída para {caminho_saida}")
+    print(f"Exportação concluída para {caminho_saida} ({total} notas)")
 
 def consultar_por_cnpj(cnpj: str) -> None:
     conn = sqlite3.connect('nfe.db')
@@ -227,7 +242,8 @@ def menu_interativo() -> None:
             consultar_por_cnpj(cnpj)
 
         elif escolha == '4':
-            exportar_para_json()
+            caminho = input("Arquivo de saída (.json ou .ndjson) [exportacao_nfe.json]: ").strip()
+            exportar_para_json(caminho or 'exportacao_nfe.json')
 
         elif escolha == '5':
             print("Saindo do programa. Obrigado!")
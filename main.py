@@ -1,12 +1,15 @@
-from api.servidor import app, carregar_modelos
+from api.servidor import app, carregar_modelos, aquecer_inicial, catalogo, lotes
 
 if __name__ == '__main__':
+    catalogo.iniciar()
     print("""🔧 FusionIA Server Inicializando...
 ================================
 Modelos encontrados:
 """)
     for m in carregar_modelos():
         print(f" - {m}")
+    aquecer_inicial()
+    lotes.retomar()  # lotes interrompidos continuam de onde pararam
     print("""
 Aguardando conexões em http://localhost:5000
 ================================
@@ -0,0 +1,78 @@
+"""
+Compara a serialização de utils.json_files com o json da biblioteca padrão
+(como era usado antes: indent=2, ensure_ascii=False) numa sessão sintética.
+
+Uso (na raiz do projeto):
+    python testes/benchmark_serializacao.py [mensagens]
+"""
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from utils import json_files
+
+
+def sessao_sintetica(mensagens):
+    historico = [{"role": "user" if i % 2 == 0 else "assistant",
+                  "content": f"Mensagem {i}: explique como configurar o servidor com acentuação çãé " * 4,
+                  "tokens": 40 + i % 17}
+                 for i in range(mensagens)]
+    return {"id": "benchmark", "modelo": "llama3", "personalidade": "axel", "historico": historico}
+
+
+def cronometrar(nome, funcao, repeticoes):
+    inicio = time.perf_counter()
+    for _ in range(repeticoes):
+        resultado = funcao()
+    ms = (time.perf_counter() - inicio) / repeticoes * 1000
+    tamanho = len(resultado) if isinstance(resultado, (bytes, str)) else None
+    print(f"{nome:<42} {ms:9.3f} ms" + (f"  {tamanho:>10} bytes" if tamanho else ""))
+    return ms
+
+
+def main():
+    mensagens = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    repeticoes = 20
+    dados = sessao_sintetica(mensagens)
+    print(f"Sessão com {mensagens} mensagens, biblioteca JSON: {json_files.BIBLIOTECA_JSON}, "
+          f"msgpack: {'sim' if json_files.msgpack or json_files.msgspec else 'não'}\n")
+
+    texto_padrao = json.dumps(dados, indent=2, ensure_ascii=False)
+    binario = json_files.dumps(dados)
+    base = cronometrar("json padrão dumps (indent=2)", lambda: json.dumps(dados, indent=2, ensure_ascii=False), repeticoes)
+    rapido = cronometrar("json_files.dumps (compacto)", lambda: json_files.dumps(dados), repeticoes)
+    cronometrar("json_files.dumps (indent)", lambda: json_files.dumps(dados, indent=True), repeticoes)
+    base_leitura = cronometrar("json padrão loads", lambda: json.loads(texto_padrao), repeticoes)
+    leitura = cronometrar("json_files.loads", lambda: json_files.loads(binario), repeticoes)
+
+    with tempfile.TemporaryDirectory() as diretorio:
+        caminho = os.path.join(diretorio, "sessao")
+
+        def gravar_padrao():
+            with open(caminho + ".json", "w", encoding="utf-8") as f:
+                json.dump(dados, f, indent=2, ensure_ascii=False)
+
+        cronometrar("gravar: json.dump indent=2 (não atômico)", gravar_padrao, repeticoes)
+        cronometrar("gravar: salvar_json compacto (atômico)",
+                    lambda: json_files.salvar_json(caminho + ".json", dados, indent=False), repeticoes)
+        cronometrar("gravar: salvar_estado msgpack (atômico)",
+                    lambda: json_files.salvar_estado(caminho + ".msgpack", dados), repeticoes)
+
+        def gravar_ndjson():
+            with json_files.EscritorNDJSON(caminho + ".ndjson") as saida:
+                for mensagem in dados["historico"]:
+                    saida.escrever(mensagem)
+
+        cronometrar("gravar: EscritorNDJSON (streaming)", gravar_ndjson, repeticoes)
+        print(f"\ntamanhos: json indent=2 {len(texto_padrao.encode('utf-8'))} bytes, "
+              f"json compacto {len(binario)} bytes, "
+              f"msgpack {os.path.getsize(caminho + '.msgpack')} bytes")
+
+    print(f"aceleração: dumps {base / rapido:.1f}x, loads {base_leitura / leitura:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
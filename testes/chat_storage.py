@@ -0,0 +1,247 @@
+"""
+Camada de armazenamento v2 do ChatbotDatabase (server5.py e melhor-ia-contexto.py).
+
+- Um pool pequeno e limitado de conexões de leitura, reaproveitadas entre
+  requisições (o werkzeug cria uma thread por requisição, então conexões por
+  thread nunca seriam reusadas), em modo WAL (leitores não bloqueiam o escritor).
+- Uma única thread escritora: as escritas entram numa fila e as que chegam
+  juntas são gravadas numa só transação (group commit), cada uma isolada por
+  SAVEPOINT para que a falha de uma não desfaça as outras.
+- Mensagens com chave inteira (rowid) e índice (conversation_id, timestamp),
+  que resolve o filtro e a ordenação do histórico (as colunas restantes vêm da
+  tabela, só para as linhas do LIMIT); conversas novas com id ULID.
+- Migrações numeradas, aplicadas conforme o PRAGMA user_version.
+"""
+import os
+import queue
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List
+
+CROCKFORD = "0123456789ABCDEFGHJKMNPQRSTVWXYZ"
+
+
+def new_ulid() -> str:
+    """ULID: 48 bits de timestamp em ms + 80 bits aleatórios, em base32 de Crockford (26 caracteres)"""
+    value = (int(time.time() * 1000) << 80) | int.from_bytes(os.urandom(10), "big")
+    return "".join(CROCKFORD[(value >> shift) & 31] for shift in range(125, -1, -5))
+
+
+def _columns(conn: sqlite3.Connection, table: str) -> List[str]:
+    return [row[1] for row in conn.execute(f"PRAGMA table_info({table})")]
+
+
+def _migration_1(conn: sqlite3.Connection):
+    """Esquema original (união das versões do server5 e do melhor-ia-contexto)"""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS conversations (
+            id TEXT PRIMARY KEY,
+            title TEXT,
+            created_at REAL
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS messages (
+            id TEXT PRIMARY KEY,
+            conversation_id TEXT,
+            role TEXT,
+            content TEXT,
+            timestamp REAL
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS embeddings (
+            id TEXT PRIMARY KEY,
+            text TEXT,
+            embedding BLOB,
+            metadata TEXT
+        )
+    """)
+    # Bancos criados pelo server5 não têm estas colunas
+    for table, column, kind in (("conversations", "updated_at", "REAL"),
+                                ("conversations", "system_prompt", "TEXT"),
+                                ("messages", "embedding_id", "TEXT")):
+        if column not in _columns(conn, table):
+            conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {kind}")
+
+
+def _migration_2(conn: sqlite3.Connection):
+    """Mensagens com chave inteira e índices para histórico e listagem de conversas"""
+    conn.execute("""
+        CREATE TABLE messages_v2 (
+            id INTEGER PRIMARY KEY,
+            conversation_id TEXT NOT NULL,
+            role TEXT NOT NULL,
+            content TEXT NOT NULL,
+            timestamp REAL NOT NULL,
+            embedding_id TEXT,
+            legacy_id TEXT
+        )
+    """)
+    conn.execute("""
+        INSERT INTO messages_v2 (conversation_id, role, content, timestamp, embedding_id, legacy_id)
+        SELECT conversation_id, role, content, timestamp, embedding_id, id
+        FROM messages ORDER BY timestamp
+    """)
+    # Embeddings eram indexados pelo id sha256 da mensagem; passam a usar o id inteiro
+    conn.execute("""
+        UPDATE embeddings SET id = (SELECT CAST(m.id AS TEXT) FROM messages_v2 m WHERE m.legacy_id = embeddings.id)
+        WHERE id IN (SELECT legacy_id FROM messages_v2)
+    """)
+    conn.execute("""
+        UPDATE messages_v2 SET embedding_id = CAST(id AS TEXT) WHERE embedding_id IS NOT NULL
+    """)
+    conn.execute("DROP TABLE messages")
+    conn.execute("ALTER TABLE messages_v2 RENAME TO messages")
+    conn.execute("CREATE INDEX idx_messages_conversation_ts ON messages (conversation_id, timestamp)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_conversations_updated ON conversations (updated_at)")
+
+
+MIGRATIONS = [_migration_1, _migration_2]
+
+
+class _WriteTask:
+    def __init__(self, fn: Callable):
+        self.fn = fn
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class ChatStorage:
+    def __init__(self, db_path: str, migrations: List[Callable] = MIGRATIONS, batch_max: int = 256,
+                 read_pool_size: int = 4):
+        self.db_path = db_path
+        self.migrations = migrations
+        self.batch_max = batch_max
+        self.read_pool_size = read_pool_size
+        self.stats = {"writes": 0, "commits": 0, "read_connections": 0}
+        self._readers = queue.LifoQueue()  # conexões de leitura livres
+        self._readers_lock = threading.Lock()
+        self._queue = queue.Queue()
+
+        self._writer = self._connect(autocommit=True)
+        self._writer.execute("PRAGMA journal_mode=WAL")
+        self._migrate()
+        threading.Thread(target=self._write_loop, daemon=True).start()
+
+    def _connect(self, autocommit: bool = False) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.db_path, isolation_level=None if autocommit else "DEFERRED",
+                               check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA busy_timeout=5000")
+        conn.execute("PRAGMA synchronous=NORMAL")  # seguro em WAL; perde no máximo o último commit numa queda de energia
+        conn.execute("PRAGMA temp_store=MEMORY")
+        return conn
+
+    def _migrate(self):
+        """Aplica as migrações pendentes, cada uma na sua transação"""
+        version = self._writer.execute("PRAGMA user_version").fetchone()[0]
+        for number, migration in enumerate(self.migrations, 1):
+            if number <= version:
+                continue
+            self._writer.execute("BEGIN IMMEDIATE")
+            try:
+                migration(self._writer)
+                self._writer.execute(f"PRAGMA user_version={number}")
+                self._writer.execute("COMMIT")
+            except Exception:
+                self._writer.execute("ROLLBACK")
+                raise
+            print(f"[chat_storage] Migração {number} aplicada em {self.db_path}")
+
+    @contextmanager
+    def connection(self) -> Iterator[sqlite3.Connection]:
+        """
+        Empresta uma conexão de leitura do pool durante o bloco. Cria até
+        read_pool_size conexões; com todas em uso, espera uma ser devolvida.
+        """
+        try:
+            conn = self._readers.get_nowait()
+        except queue.Empty:
+            conn = None
+            with self._readers_lock:
+                if self.stats["read_connections"] < self.read_pool_size:
+                    self.stats["read_connections"] += 1
+                    conn = self._connect()
+            if conn is None:
+                conn = self._readers.get()
+        try:
+            yield conn
+        finally:
+            if conn.in_transaction:
+                conn.rollback()
+            self._readers.put(conn)
+
+    def read(self, sql: str, params=()) -> List[Dict]:
+        with self.connection() as conn:
+            return [dict(row) for row in conn.execute(sql, params).fetchall()]
+
+    def close(self):
+        """Grava o que estiver na fila e fecha as conexões de leitura livres"""
+        self.flush()
+        while True:
+            try:
+                self._readers.get_nowait().close()
+            except queue.Empty:
+                break
+
+    def run(self, fn: Callable, wait: bool = True):
+        """
+        Executa fn(conn) na thread escritora, dentro da transação do próximo lote.
+        Com wait=True bloqueia até o commit e devolve o resultado de fn.
+        """
+        task = _WriteTask(fn)
+        self._queue.put(task)
+        if not wait:
+            return None
+        task.done.wait()
+        if task.error is not None:
+            raise task.error
+        return task.result
+
+    def execute(self, sql: str, params=(), wait: bool = True):
+        """INSERT/UPDATE agrupado com as demais escritas; devolve o lastrowid"""
+        return self.run(lambda conn: conn.execute(sql, params).lastrowid, wait)
+
+    def executemany(self, sql: str, rows, wait: bool = True):
+        return self.run(lambda conn: conn.executemany(sql, rows).rowcount, wait)
+
+    def flush(self):
+        """Espera todas as escritas já enfileiradas serem gravadas"""
+        self.run(lambda conn: None)
+
+    def _write_loop(self):
+        conn = self._writer
+        while True:
+            tasks = [self._queue.get()]
+            while len(tasks) < self.batch_max:
+                try:
+                    tasks.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            try:
+                conn.execute("BEGIN IMMEDIATE")
+                for task in tasks:
+                    conn.execute("SAVEPOINT escrita")
+                    try:
+                        task.result = task.fn(conn)
+                        conn.execute("RELEASE escrita")
+                    except Exception as e:
+                        conn.execute("ROLLBACK TO escrita")
+                        conn.execute("RELEASE escrita")
+                        task.error = e
+                conn.execute("COMMIT")
+                self.stats["commits"] += 1
+                self.stats["writes"] += len(tasks)
+            except sqlite3.Error as e:
+                if conn.in_transaction:
+                    conn.execute("ROLLBACK")
+                for task in tasks:
+                    task.error = task.error or e
+            finally:
+                for task in tasks:
+                    task.done.set()
@@ -2,16 +2,31 @@ import ollama
 from typing import List, Dict, Optional, Tuple
 import json
 import time
-import sqlite3
 from flask import Flask, request, jsonify
 from flask_cors import CORS
 import re
 from datetime import datetime
-import hashlib
+import queue
+import threading
+import numpy as np
+
+from chat_storage import ChatStorage, new_ulid
+
+try:
+    import faiss  # opcional: índice aproximado para conversas grandes
+except ImportError:
+    faiss = None
 
 # Configurações globais
 DEFAULT_DB_PATH = "chatbot_db.sqlite"
 EMBEDDING_MODEL = "nomic-embed-text"  # Modelo para embeddings (rode `ollama pull nomic-embed-text` antes)
+ENRICH_MODEL = "qwen2.5:0.5b"  # Modelo pequeno para títulos e outros enriquecimentos pós-turno
+ENRICH_WORKERS = 1             # Threads do pool de enriquecimento
+ENRICH_BATCH_SIZE = 8          # Conversas tituladas numa única chamada ao modelo
+ENRICH_BATCH_WAIT = 0.5        # Segundos esperando mais conversas para formar o lote
+ENRICH_IDLE_WAIT = 5.0         # Máximo de segundos cedendo a vez para respostas em andamento
+EMBED_BATCH_SIZE = 64          # Textos por chamada à API de embeddings em lote
+FAISS_MIN_VECTORS = 5000       # A partir deste tamanho a conversa ganha um índice FAISS (se instalado)
 
 app = Flask(__name__)
 CORS(app)  # Permite chamadas de outros computadores na rede
@@ -19,148 +34,187 @@ CORS(app)  # Permite chamadas de outros computadores na rede
 class ChatbotDatabase:
     def __init__(self, db_path: str = DEFAULT_DB_PATH):
         self.db_path = db_path
+        self._vectors = {}  # conversation_id -> {'ids', 'contents', 'roles', 'matrix', 'index', 'known'}
+        self._vector_versions = {}  # conversation_id -> embeddings gravados (invalida cargas em andamento)
+        self._vectors_lock = threading.Lock()
         self._init_db()
     
     def _init_db(self):
-        """Inicializa o banco de dados com as tabelas necessárias"""
-        with sqlite3.connect(self.db_path) as conn:
-            cursor = conn.cursor()
-            
-            # Tabela de conversas
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS conversations (
-                    id TEXT PRIMARY KEY,
-                    title TEXT,
-                    created_at REAL,
-                    updated_at REAL,
-                    system_prompt TEXT
-                )
-            """)
-            
-            # Tabela de mensagens
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS messages (
-                    id TEXT PRIMARY KEY,
-                    conversation_id TEXT,
-                    role TEXT,
-                    content TEXT,
-                    timestamp REAL,
-                    embedding_id TEXT,
-                    FOREIGN KEY (conversation_id) REFERENCES conversations (id)
-                )
-            """)
-            
-            # Tabela de embeddings (para RAG)
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS embeddings (
-                    id TEXT PRIMARY KEY,
-                    text TEXT,
-                    embedding BLOB,
-                    metadata TEXT
-                )
-            """)
-            
-            conn.commit()
+        """Abre o armazenamento (WAL, conexões por thread, escritas agrupadas) e aplica as migrações"""
+        self.storage = ChatStorage(self.db_path)
     
     def save_conversation(self, conversation_id: str, title: str, system_prompt: str = None):
         """Salva ou atualiza uma conversa no banco de dados"""
-        with sqlite3.connect(self.db_path) as conn:
-            cursor = conn.cursor()
-            
-            # Verifica se a conversa já existe
-            cursor.execute("SELECT 1 FROM conversations WHERE id = ?", (conversation_id,))
-            exists = cursor.fetchone()
-            
-            now = time.time()
-            
-            if exists:
-                # Atualiza a conversa existente
-                cursor.execute("""
-                    UPDATE conversations 
-                    SET title = ?, updated_at = ?, system_prompt = ?
-                    WHERE id = ?
-                """, (title, now, system_prompt, conversation_id))
-            else:
-                # Cria uma nova conversa
-                cursor.execute("""
-                    INSERT INTO conversations (id, title, created_at, updated_at, system_prompt)
-                    VALUES (?, ?, ?, ?, ?)
-                """, (conversation_id, title, now, now, system_prompt))
-            
-            conn.commit()
+        now = time.time()
+        self.storage.execute("""
+            INSERT INTO conversations (id, title, created_at, updated_at, system_prompt)
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT(id) DO UPDATE SET
+                title = excluded.title, updated_at = excluded.updated_at, system_prompt = excluded.system_prompt
+        """, (conversation_id, title, now, now, system_prompt))
     
-    def save_message(self, message: Dict):
-        """Salva uma mensagem no banco de dados"""
-        with sqlite3.connect(self.db_path) as conn:
-            cursor = conn.cursor()
-            
-            cursor.execute("""
-                INSERT INTO messages (id, conversation_id, role, content, timestamp, embedding_id)
-                VALUES (?, ?, ?, ?, ?, ?)
-            """, (
-                message['id'],
-                message['conversation_id'],
-                message['role'],
-                message['content'],
-                message['timestamp'],
-                message.get('embedding_id')
-            ))
-            
-            conn.commit()
+    def update_conversation_title(self, conversation_id: str, title: str):
+        """Atualiza apenas o título (não mexe no system_prompt nem em updated_at)"""
+        self.storage.execute("UPDATE conversations SET title = ? WHERE id = ?", (title, conversation_id),
+                             wait=False)
+    
+    def save_message(self, message: Dict) -> int:
+        """Salva uma mensagem no banco de dados e retorna o id (inteiro) gerado"""
+        return self.storage.execute("""
+            INSERT INTO messages (conversation_id, role, content, timestamp, embedding_id)
+            VALUES (?, ?, ?, ?, ?)
+        """, (
+            message['conversation_id'],
+            message['role'],
+            message['content'],
+            message['timestamp'],
+            message.get('embedding_id')
+        ))
     
     def get_conversation_messages(self, conversation_id: str, limit: int = 10) -> List[Dict]:
-        """Recupera as mensagens de uma conversa"""
-        with sqlite3.connect(self.db_path) as conn:
-            conn.row_factory = sqlite3.Row
-            cursor = conn.cursor()
-            
-            cursor.execute("""
-                SELECT * FROM messages 
-                WHERE conversation_id = ?
-                ORDER BY timestamp DESC
-                LIMIT ?
-            """, (conversation_id, limit))
-            
-            return [dict(row) for row in cursor.fetchall()]
+        """Últimas mensagens da conversa (o índice (conversation_id, timestamp) resolve filtro e ordem)"""
+        return self.storage.read("""
+            SELECT * FROM messages 
+            WHERE conversation_id = ?
+            ORDER BY timestamp DESC
+            LIMIT ?
+        """, (conversation_id, limit))
     
-    def search_similar_messages(self, query: str, conversation_id: str, limit: int = 3) -> List[Dict]:
-        """Busca mensagens similares usando RAG (implementação simplificada)"""
-        # Gera embedding da query
-        query_embedding = self._generate_embedding(query)
+    def search_similar_messages(self, query: str, conversation_id: str, limit: int = 3,
+                                query_embedding: Optional[np.ndarray] = None) -> List[Dict]:
+        """Busca as mensagens da conversa mais parecidas com a query (cosseno sobre os embeddings)"""
+        if query_embedding is None:
+            query_embedding = self._generate_embedding(query)
+        query_vector = self._normalize(np.asarray(query_embedding, dtype=np.float32)[None, :])[0]
         
-        # Em uma implementação real, usaríamos um banco de vetores como FAISS ou Qdrant
-        # Aqui vamos fazer uma busca por similaridade de texto simplificada
+        with self._vectors_lock:
+            cached = self._vectors.get(conversation_id)
+        if cached is None:
+            cached = self._load_vectors(conversation_id)
         
-        with sqlite3.connect(self.db_path) as conn:
-            conn.row_factory = sqlite3.Row
-            cursor = conn.cursor()
-            
-            cursor.execute("""
-                SELECT content FROM messages 
-                WHERE conversation_id = ? 
-                AND role IN ('user', 'assistant')
-                ORDER BY timestamp DESC
-                LIMIT 20
-            """, (conversation_id,))
-            
-            messages = [dict(row) for row in cursor.fetchall()]
-            
-            # Classifica por similaridade (simplificado)
-            messages.sort(
-                key=lambda x: self._simple_similarity(query, x['content']),
-                reverse=True
-            )
+        # save_embeddings acrescenta ao cache em outra thread: o índice HNSW não aceita
+        # busca durante um add, e as listas e a matriz têm de ser lidas no mesmo estado
+        with self._vectors_lock:
+            if not cached['ids']:
+                return []
+            k = min(limit, len(cached['ids']))
+            if cached['index'] is not None:
+                scores, positions = cached['index'].search(query_vector[None, :], k)
+                ranked = list(zip(positions[0], scores[0]))
+            else:
+                scores = cached['matrix'] @ query_vector
+                positions = np.argpartition(-scores, k - 1)[:k]
+                ranked = sorted(((int(i), float(scores[i])) for i in positions), key=lambda r: -r[1])
             
-            return messages[:limit]
+            return [{'id': cached['ids'][i], 'role': cached['roles'][i], 'content': cached['contents'][i],
+                     'score': float(score)} for i, score in ranked if i >= 0]
+    
+    def embed_texts(self, texts: List[str]) -> np.ndarray:
+        """Gera embeddings de vários textos em lote (uma chamada a cada EMBED_BATCH_SIZE textos)"""
+        vectors = []
+        for start in range(0, len(texts), EMBED_BATCH_SIZE):
+            batch = [self._preprocess_text(t) for t in texts[start:start + EMBED_BATCH_SIZE]]
+            try:
+                response = ollama.embed(model=EMBEDDING_MODEL, input=batch)
+                vectors.extend(response['embeddings'])
+            except AttributeError:
+                # Cliente ollama antigo, sem a API em lote
+                vectors.extend(ollama.embeddings(model=EMBEDDING_MODEL, prompt=t)['embedding'] for t in batch)
+        return np.asarray(vectors, dtype=np.float32)
+    
+    def save_embeddings(self, conversation_id: str, items: List[Tuple[int, str, str, np.ndarray]]):
+        """
+        Grava os embeddings (float32 compactado) de mensagens já salvas e atualiza o cache.
+        
+        items: lista de (message_id, role, content, vetor)
+        """
+        if not items:
+            return
+        def write(conn):
+            conn.executemany("""
+                INSERT OR REPLACE INTO embeddings (id, text, embedding, metadata) VALUES (?, ?, ?, ?)
+            """, [(str(message_id), content, np.asarray(vector, dtype=np.float32).tobytes(),
+                   json.dumps({'conversation_id': conversation_id, 'role': role}))
+                  for message_id, role, content, vector in items])
+            conn.executemany("UPDATE messages SET embedding_id = ? WHERE id = ?",
+                             [(str(message_id), message_id) for message_id, _, _, _ in items])
+        self.storage.run(write)
+        
+        # Após o commit: uma carga que leu antes dele vê a versão mudar e relê
+        with self._vectors_lock:
+            self._vector_versions[conversation_id] = self._vector_versions.get(conversation_id, 0) + 1
+            cached = self._vectors.get(conversation_id)
+            if cached is not None:
+                self._append_vectors(cached, items)
+    
+    def index_missing_embeddings(self, conversation_ids: List[str]):
+        """Calcula em lote os embeddings das mensagens que ainda não têm (pós-turno ou backfill)"""
+        placeholders = ",".join("?" * len(conversation_ids))
+        with self.storage.connection() as conn:
+            rows = conn.execute(f"""
+                SELECT id, conversation_id, role, content FROM messages
+                WHERE conversation_id IN ({placeholders})
+                AND role IN ('user', 'assistant') AND embedding_id IS NULL
+                ORDER BY timestamp
+            """, conversation_ids).fetchall()
+        if not rows:
+            return
+        vectors = self.embed_texts([row[3] for row in rows])
+        for conversation_id in conversation_ids:
+            self.save_embeddings(conversation_id, [(row[0], row[2], row[3], vector)
+                                                   for row, vector in zip(rows, vectors)
+                                                   if row[1] == conversation_id])
     
-    def _generate_embedding(self, text: str) -> List[float]:
-        """Gera embeddings para o texto usando Ollama"""
-        # Pré-processa o texto
-        text = self._preprocess_text(text)
+    def _load_vectors(self, conversation_id: str) -> Dict:
+        """
+        Carrega a matriz de embeddings da conversa (uma vez; depois só recebe acréscimos).
         
-        # Gera o embedding
-        response = ollama.embeddings(model=EMBEDDING_MODEL, prompt=text)
-        return response['embedding']
+        Se um save_embeddings concluir durante a leitura, ela pode ter perdido o que ele
+        gravou e o cache ficaria sem esses vetores para sempre: nesse caso relê.
+        """
+        while True:
+            with self._vectors_lock:
+                version = self._vector_versions.get(conversation_id, 0)
+            with self.storage.connection() as conn:
+                rows = conn.execute("""
+                    SELECT m.id, m.role, m.content, e.embedding FROM messages m
+                    JOIN embeddings e ON e.id = m.embedding_id
+                    WHERE m.conversation_id = ?
+                    ORDER BY m.timestamp
+                """, (conversation_id,)).fetchall()
+            cached = {'ids': [], 'roles': [], 'contents': [], 'matrix': None, 'index': None, 'known': set()}
+            self._append_vectors(cached, [(r[0], r[1], r[2], np.frombuffer(r[3], dtype=np.float32)) for r in rows])
+            with self._vectors_lock:
+                if self._vector_versions.get(conversation_id, 0) == version:
+                    return self._vectors.setdefault(conversation_id, cached)
+    
+    def _append_vectors(self, cached: Dict, items: List[Tuple[int, str, str, np.ndarray]]):
+        # A carga pode já ter lido mensagens que o save_embeddings concorrente acrescenta
+        items = [item for item in items if item[0] not in cached['known']]
+        if not items:
+            return
+        cached['known'].update(item[0] for item in items)
+        new = self._normalize(np.stack([np.asarray(item[3], dtype=np.float32) for item in items]))
+        cached['ids'].extend(item[0] for item in items)
+        cached['roles'].extend(item[1] for item in items)
+        cached['contents'].extend(item[2] for item in items)
+        cached['matrix'] = new if cached['matrix'] is None else np.vstack([cached['matrix'], new])
+        
+        if cached['index'] is not None:
+            cached['index'].add(new)
+        elif faiss is not None and len(cached['ids']) >= FAISS_MIN_VECTORS:
+            # Produto interno sobre vetores normalizados = cosseno
+            cached['index'] = faiss.IndexHNSWFlat(new.shape[1], 32, faiss.METRIC_INNER_PRODUCT)
+            cached['index'].add(cached['matrix'])
+    
+    @staticmethod
+    def _normalize(vectors: np.ndarray) -> np.ndarray:
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.maximum(norms, 1e-9)
+    
+    def _generate_embedding(self, text: str) -> np.ndarray:
+        """Gera o embedding de um texto usando Ollama"""
+        return self.embed_texts([text])[0]
     
     def _simple_similarity(self, text1: str, text2: str) -> float:
         """Calcula similaridade simplificada entre dois textos"""
@@ -184,9 +238,114 @@ class ChatbotDatabase:
         text = ' '.join(text.split())
         return text
 
+class BackgroundEnricher:
+    """
+    Pool de baixa prioridade para tarefas pós-turno (títulos das conversas, por enquanto).
+    
+    As tarefas entram numa fila e são processadas em lotes por um modelo pequeno;
+    enquanto houver respostas sendo geradas, os workers cedem a vez (até ENRICH_IDLE_WAIT).
+    A resposta ao usuário nunca espera por elas.
+    """
+    def __init__(self, db: ChatbotDatabase, model: str = ENRICH_MODEL, workers: int = ENRICH_WORKERS,
+                 batch_size: int = ENRICH_BATCH_SIZE, batch_wait: float = ENRICH_BATCH_WAIT):
+        self.db = db
+        self.model = model
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self.queue = queue.Queue()
+        self.pending = set()          # (tipo, conversation_id) já na fila
+        self.in_flight = 0            # respostas ao usuário em andamento
+        self.lock = threading.Lock()
+        self.idle = threading.Condition(self.lock)
+        self.handlers = {'title': self._title_batch, 'embed': self._embed_batch}
+        
+        for _ in range(workers):
+            threading.Thread(target=self._worker, daemon=True).start()
+    
+    def submit(self, kind: str, conversation_id: str, text: str):
+        """Agenda uma tarefa; pedidos repetidos para a mesma conversa ainda na fila são ignorados"""
+        with self.lock:
+            if (kind, conversation_id) in self.pending:
+                return
+            self.pending.add((kind, conversation_id))
+        self.queue.put((kind, conversation_id, text))
+    
+    def turn_started(self):
+        with self.lock:
+            self.in_flight += 1
+    
+    def turn_finished(self):
+        with self.lock:
+            self.in_flight -= 1
+            if self.in_flight == 0:
+                self.idle.notify_all()
+    
+    def _worker(self):
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.time() + self.batch_wait
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get(timeout=max(0, deadline - time.time())))
+                except queue.Empty:
+                    break
+            
+            # Fora da fila a tarefa deixa de estar pendente: um submit durante o
+            # processamento (ex.: mensagens novas para embed) entra no próximo lote
+            with self.lock:
+                self.pending.difference_update((task[0], task[1]) for task in batch)
+            
+            # Baixa prioridade: espera as respostas em andamento terminarem
+            with self.lock:
+                self.idle.wait_for(lambda: self.in_flight == 0, timeout=ENRICH_IDLE_WAIT)
+            
+            for kind in {task[0] for task in batch}:
+                tasks = [task for task in batch if task[0] == kind]
+                try:
+                    self.handlers[kind](tasks)
+                except Exception as e:
+                    print(f"[ERRO] Enriquecimento '{kind}': {e}")
+    
+    def _title_batch(self, tasks: List[Tuple[str, str, str]]):
+        """Gera os títulos de várias conversas numa única chamada ao modelo pequeno"""
+        numbered = "\n".join(f"{i}. {text[:200]}" for i, (_, _, text) in enumerate(tasks, 1))
+        titles = {}
+        try:
+            response = ollama.chat(
+                model=self.model,
+                messages=[{
+                    'role': 'system',
+                    'content': 'Para cada mensagem numerada, gere um título muito curto (3-5 palavras). '
+                               'Responda uma linha por mensagem no formato "N. título".'
+                }, {
+                    'role': 'user',
+                    'content': numbered
+                }],
+                options={
+                    'temperature': 0.3,
+                    'num_predict': 20 * len(tasks)
+                }
+            )
+            for line in response['message']['content'].splitlines():
+                match = re.match(r'\s*(\d+)[.)-]\s*(.+)', line)
+                if match:
+                    titles[int(match.group(1))] = match.group(2).strip().strip('"\'')
+        except Exception as e:
+            print(f"[ERRO] Gerar títulos: {e}")
+        
+        for i, (_, conversation_id, _) in enumerate(tasks, 1):
+            # Fallback para um título padrão
+            title = titles.get(i) or f"Conversa {datetime.now().strftime('%Y-%m-%d')}"
+            self.db.update_conversation_title(conversation_id, title)
+
+    def _embed_batch(self, tasks: List[Tuple[str, str, str]]):
+        """Embeddings das mensagens novas de várias conversas, na API em lote"""
+        self.db.index_missing_embeddings([conversation_id for _, conversation_id, _ in tasks])
+
 class AdvancedChatbot:
     def __init__(self, db_path: str = DEFAULT_DB_PATH):
         self.db = ChatbotDatabase(db_path)
+        self.enricher = BackgroundEnricher(self.db)
         self.active_conversation = None
         self.system_prompt = None
         
@@ -204,7 +363,7 @@ class AdvancedChatbot:
     
     def start_new_conversation(self, title: str = "Nova Conversa", system_prompt: str = None):
         """Inicia uma nova conversa"""
-        conversation_id = hashlib.sha256(f"{title}{time.time()}".encode()).hexdigest()
+        conversation_id = new_ulid()
         self.active_conversation = conversation_id
         self.system_prompt = system_prompt
         
@@ -215,23 +374,22 @@ class AdvancedChatbot:
         
         return conversation_id
     
-    def _add_message(self, role: str, content: str, embedding_id: str = None) -> str:
-        """Adiciona uma mensagem ao banco de dados"""
+    def _add_message(self, role: str, content: str, embedding: Optional[np.ndarray] = None) -> int:
+        """Adiciona uma mensagem ao banco de dados (com o embedding, se já calculado)"""
         if not self.active_conversation:
             raise ValueError("Nenhuma conversa ativa")
             
-        message_id = hashlib.sha256(f"{role}{content}{time.time()}".encode()).hexdigest()
-        
         message = {
-            'id': message_id,
             'conversation_id': self.active_conversation,
             'role': role,
             'content': content,
             'timestamp': time.time(),
-            'embedding_id': embedding_id
+            'embedding_id': None
         }
         
-        self.db.save_message(message)
+        message_id = self.db.save_message(message)
+        if embedding is not None:
+            self.db.save_embeddings(self.active_conversation, [(message_id, role, content, embedding)])
         return message_id
     
     def generate_response(self, user_message: str, config_overrides: Dict = None) -> Dict:
@@ -241,13 +399,15 @@ class AdvancedChatbot:
         
         # Pré-processa a mensagem do usuário
         processed_message = self.db._preprocess_text(user_message)
-        self._add_message('user', processed_message)
         
-        # Busca contexto relevante (RAG)
+        # Busca contexto relevante (RAG) em toda a conversa; o embedding da pergunta é gravado junto com ela
+        query_embedding = self.db._generate_embedding(processed_message)
         relevant_context = self.db.search_similar_messages(
             processed_message, 
-            self.active_conversation
+            self.active_conversation,
+            query_embedding=query_embedding
         )
+        self._add_message('user', processed_message, embedding=query_embedding)
         
         # Prepara as configurações
         current_configs = self.default_configs.copy()
@@ -274,6 +434,7 @@ class AdvancedChatbot:
         # Adiciona a mensagem atual do usuário
         messages.append({'role': 'user', 'content': processed_message})
         
+        self.enricher.turn_started()
         try:
             # Chama o modelo Ollama
             response = ollama.chat(
@@ -290,9 +451,10 @@ class AdvancedChatbot:
             assistant_reply = response['message']['content']
             self._add_message('assistant', assistant_reply)
             
-            # Atualiza o título da conversa se for a primeira resposta
+            # Título (na primeira resposta) e embedding da resposta gerados em segundo plano
             if len(history_messages) <= 1:
                 self._update_conversation_title(user_message)
+            self.enricher.submit('embed', self.active_conversation, '')
             
             return {
                 'response': assistant_reply,
@@ -311,36 +473,15 @@ class AdvancedChatbot:
                 'error': str(e),
                 'response': None
             }
+        
+        finally:
+            self.enricher.turn_finished()
     
     def _update_conversation_title(self, first_message: str):
-        """Atualiza o título da conversa baseado na primeira mensagem"""
+        """Agenda o título da conversa (gerado em segundo plano a partir da primeira mensagem)"""
         if not self.active_conversation:
             return
-            
-        # Gera um título resumido usando o modelo
-        try:
-            response = ollama.chat(
-                model=self.default_configs['model'],
-                messages=[{
-                    'role': 'system',
-                    'content': 'Gere um título muito curto (3-5 palavras) para esta conversa'
-                }, {
-                    'role': 'user',
-                    'content': first_message[:200]  # Limita o tamanho
-                }],
-                options={
-                    'temperature': 0.3,
-                    'num_predict': 20
-                }
-            )
-            
-            title = response['message']['content'].strip('"\'')
-            self.db.save_conversation(self.active_conversation, title, self.system_prompt)
-        
-        except:
-            # Fallback para um título padrão
-            title = f"Conversa {datetime.now().strftime('%Y-%m-%d')}"
-            self.db.save_conversation(self.active_conversation, title, self.system_prompt)
+        self.enricher.submit('title', self.active_conversation, first_message)
 
 # Inicializa o chatbot
 chatbot = AdvancedChatbot()
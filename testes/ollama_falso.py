@@ -0,0 +1,96 @@
+# ollama_falso.py
+# Servidor que imita a API do Ollama para testar o pool de backends sem GPU.
+# Uso: python testes/ollama_falso.py 11501 --latencia 0.5 --falhar 0.1
+# e em config.OLLAMA_BACKENDS: ["http://localhost:11501", "http://localhost:11502"]
+
+import argparse
+import json
+import random
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+MODELOS = ["llama3:latest", "qwen2.5:0.5b"]
+carregados = set()
+args = None
+
+
+class OllamaFalso(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # necessário para Transfer-Encoding: chunked
+
+    def _responder(self, dados, status=200):
+        corpo = json.dumps(dados).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(corpo)))
+        self.end_headers()
+        self.wfile.write(corpo)
+
+    def do_GET(self):
+        if self.path == "/api/tags":
+            self._responder({"models": [{"name": m, "model": m, "size": 4 * 1024 ** 3, "digest": m,
+                                         "details": {"parameter_size": "8B" if "llama" in m else "0.5B",
+                                                     "quantization_level": "Q4_0"}} for m in MODELOS]})
+        elif self.path == "/api/ps":
+            self._responder({"models": [{"name": m, "model": m, "size": 4 * 1024 ** 3,
+                                         "size_vram": 4 * 1024 ** 3} for m in carregados]})
+        else:
+            self._responder({"error": "not found"}, 404)
+
+    def do_POST(self):
+        tamanho = int(self.headers.get("Content-Length", 0))
+        payload = json.loads(self.rfile.read(tamanho) or b"{}")
+        if random.random() < args.falhar:
+            self._responder({"error": "falha simulada"}, 500)
+            return
+        if self.path == "/api/show":
+            self._responder({"model_info": {"llama.context_length": 8192}})
+        elif self.path == "/api/generate":
+            modelo = payload.get("model")
+            if payload.get("keep_alive") == 0:
+                carregados.discard(modelo)
+                self._responder({"model": modelo, "response": "", "done": True})
+                return
+            carregados.add(modelo)
+            num_predict = payload.get("options", {}).get("num_predict", 20)
+            palavras = f"[porta {args.porta}] resposta para: {payload.get('prompt', '')[-40:]}".split()
+            palavras = palavras[:num_predict]
+            final = {"model": modelo, "response": "", "done": True,
+                     "prompt_eval_count": len(payload.get("prompt", "").split()),
+                     "eval_count": len(palavras), "eval_duration": int(args.latencia * 1e9)}
+            if not payload.get("stream", True):
+                time.sleep(args.latencia)
+                self._responder(dict(final, response=" ".join(palavras)))
+                return
+            # Streaming NDJSON: um pedaço por palavra, como o Ollama
+            self.send_response(200)
+            self.send_header("Content-Type", "application/x-ndjson")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            try:
+                for i, palavra in enumerate(palavras):
+                    time.sleep(args.latencia / max(len(palavras), 1))
+                    pedaco = {"model": modelo, "response": palavra if i == 0 else " " + palavra, "done": False}
+                    self._escrever_pedaco(json.dumps(pedaco).encode() + b"\n")
+                self._escrever_pedaco(json.dumps(final).encode() + b"\n")
+                self._escrever_pedaco(b"")
+            except (BrokenPipeError, ConnectionResetError):
+                print(f"[porta {args.porta}] cliente desconectou, geração abortada")
+        else:
+            self._responder({"error": "not found"}, 404)
+
+    def _escrever_pedaco(self, dados):
+        self.wfile.write(f"{len(dados):x}\r\n".encode() + dados + b"\r\n")
+        self.wfile.flush()
+
+    def log_message(self, formato, *valores):
+        pass
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("porta", type=int)
+    parser.add_argument("--latencia", type=float, default=0.3)
+    parser.add_argument("--falhar", type=float, default=0.0, help="probabilidade de responder 500")
+    args = parser.parse_args()
+    print(f"Ollama falso em http://localhost:{args.porta}")
+    ThreadingHTTPServer(("0.0.0.0", args.porta), OllamaFalso).serve_forever()
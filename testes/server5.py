@@ -4,13 +4,13 @@ import ollama
 from typing import List, Dict
 from flask import Flask, request, jsonify, Response
 from flask_cors import CORS
-import sqlite3
 import time
 import re
-import hashlib
 import json
 import logging
 
+from chat_storage import ChatStorage, new_ulid
+
 # Configurações
 EMBEDDING_MODEL = "nomic-embed-text"  # Atualize se usar outro modelo
 DEFAULT_DB_PATH = "chatbot_db.sqlite"
@@ -58,80 +58,51 @@ class ChatbotDatabase:
         self._init_db()
         
     def _init_db(self):
-        """Inicializa o banco de dados simplificado"""
-        with sqlite3.connect(self.db_path) as conn:
-            cursor = conn.cursor()
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS conversations (
-                    id TEXT PRIMARY KEY,
-                    title TEXT,
-                    created_at REAL
-                )
-            """)
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS messages (
-                    id TEXT PRIMARY KEY,
-                    conversation_id TEXT,
-                    role TEXT,
-                    content TEXT,
-                    timestamp REAL,
-                    FOREIGN KEY (conversation_id) REFERENCES conversations (id)
-                )
-            """)
-            conn.commit()
+        """Abre o armazenamento compartilhado (WAL, escritas agrupadas) e aplica as migrações"""
+        self.storage = ChatStorage(self.db_path)
 
     def save_conversation(self, conversation_id: str, title: str):
         """Versão simplificada sem embeddings"""
-        with sqlite3.connect(self.db_path) as conn:
-            conn.execute(
-                "INSERT OR REPLACE INTO conversations VALUES (?, ?, ?)",
-                (conversation_id, title, time.time())
-            )
-            conn.commit()
+        now = time.time()
+        self.storage.execute("""
+            INSERT INTO conversations (id, title, created_at, updated_at) VALUES (?, ?, ?, ?)
+            ON CONFLICT(id) DO UPDATE SET title = excluded.title, updated_at = excluded.updated_at
+        """, (conversation_id, title, now, now))
 
-    def save_message(self, message: Dict):
-        """Versão simplificada sem embeddings"""
-        with sqlite3.connect(self.db_path) as conn:
-            conn.execute(
-                "INSERT INTO messages VALUES (?, ?, ?, ?, ?)",
-                (
-                    message['id'],
-                    message['conversation_id'],
-                    message['role'],
-                    message['content'],
-                    message['timestamp']
-                )
+    def save_message(self, message: Dict) -> int:
+        """Versão simplificada sem embeddings; retorna o id (inteiro) da mensagem"""
+        return self.storage.execute(
+            "INSERT INTO messages (conversation_id, role, content, timestamp) VALUES (?, ?, ?, ?)",
+            (
+                message['conversation_id'],
+                message['role'],
+                message['content'],
+                message['timestamp']
             )
-            conn.commit()
+        )
 
     def get_conversation_messages(self, conversation_id: str, limit: int = 10) -> List[Dict]:
         """Busca simplificada sem RAG"""
-        with sqlite3.connect(self.db_path) as conn:
-            conn.row_factory = sqlite3.Row
-            cursor = conn.cursor()
-            cursor.execute("""
-                SELECT * FROM messages 
-                WHERE conversation_id = ?
-                ORDER BY timestamp DESC
-                LIMIT ?
-            """, (conversation_id, limit))
-            return [dict(row) for row in cursor.fetchall()]
+        return self.storage.read("""
+            SELECT * FROM messages 
+            WHERE conversation_id = ?
+            ORDER BY timestamp DESC
+            LIMIT ?
+        """, (conversation_id, limit))
 
 class Chatbot:
-    def __init__(self):
-        self.db = ChatbotDatabase()
+    def __init__(self, db: ChatbotDatabase = None):
+        self.db = db or ChatbotDatabase()
     
     def start_conversation(self, title: str = "Nova Conversa") -> str:
         """Versão simplificada sem system prompt"""
-        conversation_id = hashlib.sha256(f"{title}{time.time()}".encode()).hexdigest()
+        conversation_id = new_ulid()
         self.db.save_conversation(conversation_id, title)
         return conversation_id
     
-    def add_message(self, conversation_id: str, role: str, content: str):
+    def add_message(self, conversation_id: str, role: str, content: str) -> int:
         """Adiciona mensagem sem embeddings"""
-        message_id = hashlib.sha256(f"{role}{content}{time.time()}".encode()).hexdigest()
-        self.db.save_message({
-            'id': message_id,
+        return self.db.save_message({
             'conversation_id': conversation_id,
             'role': role,
             'content': content,
@@ -186,6 +157,10 @@ class Chatbot:
         except Exception as e:
             return {'error': str(e)}
 
+# Uma única instância: o armazenamento mantém conexões e a thread escritora abertas
+db = ChatbotDatabase()
+chatbot = Chatbot(db)
+
 # Rotas da API
 @app.route('/')
 def home():
@@ -197,7 +172,6 @@ def health_check():
 
 @app.route('/api/start', methods=['POST'])
 def start_conversation():
-    chatbot = Chatbot()
     data = request.json
     conversation_id = chatbot.start_conversation(data.get('title', 'Nova Conversa'))
     return jsonify({
@@ -217,7 +191,6 @@ def handle_chat():
         
         # Salva mensagem do usuário
         user_message = {
-            'id': hashlib.sha256(f"user{data['message']}{time.time()}".encode()).hexdigest(),
             'conversation_id': data['conversation_id'],
             'role': 'user',
             'content': data['message'],
@@ -245,7 +218,6 @@ def handle_chat():
         
         # Salva resposta do assistente
         assistant_message = {
-            'id': hashlib.sha256(f"assistant{response['response']}{time.time()}".encode()).hexdigest(),
             'conversation_id': data['conversation_id'],
             'role': 'assistant',
             'content': response['response'],
@@ -0,0 +1,50 @@
+"""
+Verifica a recuperação dos logs de sessão depois de um salvamento interrompido:
+grava um turno, simula a queda acrescentando metade do próximo salvamento e
+grava mais dois turnos num armazém novo (como depois de reiniciar o servidor).
+Nenhuma mensagem gravada por completo pode se perder.
+
+Uso (na raiz do projeto):
+    python testes/verificar_armazem_sessoes.py
+"""
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from core.armazem_sessoes import ArmazemSessoes, zstandard
+
+
+def turno(armazem, sessao, n):
+    novas = [{"role": "user", "content": f"q{n}"}, {"role": "assistant", "content": f"r{n}"}]
+    sessao["historico"].extend(novas)
+    armazem.acrescentar(sessao["id"], novas)
+    return armazem.gravar(sessao)
+
+
+def verificar(compressao):
+    with tempfile.TemporaryDirectory() as diretorio:
+        armazem = ArmazemSessoes(diretorio, compressao=compressao, intervalo=3600)
+        sessao = {"id": "queda", "modelo": "llama3", "personalidade": None, "historico": []}
+        caminho = os.path.join(diretorio, turno(armazem, sessao, 1))
+
+        # Queda no meio do salvamento seguinte: só metade dos bytes chegou ao disco
+        with open(caminho, "rb") as f:
+            completo = f.read()
+        with open(caminho, "ab") as f:
+            f.write(completo[:len(completo) // 2])
+
+        armazem = ArmazemSessoes(diretorio, compressao=compressao, intervalo=3600)
+        turno(armazem, sessao, 2)
+        turno(armazem, sessao, 3)
+
+        conteudos = [m["content"] for m in ArmazemSessoes(diretorio, compressao).carregar("queda")["historico"]]
+        esperado = ["q1", "r1", "q2", "r2", "q3", "r3"]
+        assert conteudos == esperado, f"{compressao or 'sem compressão'}: {conteudos} != {esperado}"
+        print(f"ok ({compressao or 'sem compressão'}): {conteudos}")
+
+
+if __name__ == "__main__":
+    verificar(None)
+    if zstandard is not None:
+        verificar("zstd")
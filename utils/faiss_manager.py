@@ -4,16 +4,20 @@ import numpy as np
 import os
 import pickle
 
+from utils.json_files import carregar_estado, salvar_estado
+from utils.metricas import ETAPAS
+from utils.rastreamento import rastreador
+
 
 class FaissMemory:
     def __init__(self, model_name="all-MiniLM-L6-v2", index_path="dados/faiss_index.index",
-                 meta_path="dados/faiss_metadata.pkl"):
+                 meta_path="dados/faiss_metadata.msgpack"):
         """
         Inicializa o gerenciador de memória Faiss.
 
         :param model_name: Nome do modelo SentenceTransformer a ser utilizado.
         :param index_path: Caminho para o arquivo do índice Faiss.
-        :param meta_path: Caminho para o arquivo de metadados.
+        :param meta_path: Caminho para o arquivo de metadados (msgpack; o .pkl antigo ainda é lido).
         """
         self.encoder = SentenceTransformer(model_name)
         self.index_path = index_path
@@ -25,15 +29,15 @@ class FaissMemory:
 
     def _load_if_exists(self):
         """Carrega o índice e metadados se os arquivos existirem."""
-        if os.path.exists(self.index_path) and os.path.exists(self.meta_path):
+        if os.path.exists(self.index_path) and (os.path.exists(self.meta_path) or os.path.exists(self._meta_legado())):
             self.load()
         else:
             self._init_new_index()
 
     def _init_new_index(self):
         """Inicializa um novo índice Faiss se não houver um existente."""
-        # Verifique se a dimensão (384) está correta para o modelo escolhido
-        self.index = faiss.IndexFlatL2(self.encoder.get_max_seq_length())  # Utilize a dimensão do modelo
+        # Dimensão dos embeddings (384 no MiniLM); get_max_seq_length é o limite de tokens, não a dimensão
+        self.index = faiss.IndexFlatL2(self.encoder.get_sentence_embedding_dimension())
         self.metadata = []
 
     def add_memory(self, texto, info_extra=None):
@@ -43,37 +47,67 @@ class FaissMemory:
         :param texto: Texto a ser encodeado e adicionado.
         :param info_extra: Dicionário com informações extras (opcional).
         """
-        vetor = self.encoder.encode([texto])[0]
-        self.index.add(np.array([vetor]))
-        self.metadata.append(info_extra if info_extra else {"texto": texto})
-        self.save()
+        with rastreador.span("faiss.adicionar"):
+            vetor = self.encoder.encode([texto])[0]
+            self.index.add(np.array([vetor]))
+            self.metadata.append(info_extra if info_extra else {"texto": texto})
+            self.save()
+
+    def codificar(self, texto):
+        """
+        Gera o embedding de um texto.
 
-    def buscar_similar(self, texto, k=3):
+        :param texto: Texto a ser encodeado.
+        :return: Vetor numpy do embedding.
+        """
+        with ETAPAS.cronometrar("codificar"), rastreador.span("faiss.codificar"):
+            return self.encoder.encode([texto])[0]
+
+    def codificar_varios(self, textos):
+        """
+        Gera os embeddings de vários textos numa única chamada ao modelo.
+
+        :param textos: Lista de textos.
+        :return: Matriz numpy (um vetor por linha).
+        """
+        return self.encoder.encode(textos)
+
+    def buscar_similar(self, texto, k=3, vetor=None):
         """
         Busca por textos similares no índice.
 
         :param texto: Texto de consulta.
         :param k: Número de resultados a retornar. Default=3.
+        :param vetor: Embedding já calculado do texto (opcional, evita recodificar).
         :return: Lista de metadados dos textos mais similares.
         """
-        vetor = self.encoder.encode([texto])[0]
+        if vetor is None:
+            vetor = self.codificar(texto)
         if self.index.ntotal == 0:
             return []
-        distancias, indices = self.index.search(np.array([vetor]), k)
+        with ETAPAS.cronometrar("busca_faiss"), rastreador.span("faiss.buscar", k=k, total=self.index.ntotal):
+            distancias, indices = self.index.search(np.array([vetor]), k)
         resultados = [self.metadata[idx] for idx in indices[0] if idx < len(self.metadata)]
         return resultados
 
     def save(self):
         """Salva o índice Faiss e os metadados."""
-        faiss.write_index(self.index, self.index_path)
-        with open(self.meta_path, "wb") as f:
-            pickle.dump(self.metadata, f)
+        with ETAPAS.cronometrar("persistencia"), rastreador.span("faiss.salvar"):
+            faiss.write_index(self.index, self.index_path)
+            salvar_estado(self.meta_path, self.metadata)
 
     def load(self):
         """Carrega o índice Faiss e os metadados."""
         self.index = faiss.read_index(self.index_path)
-        with open(self.meta_path, "rb") as f:
-            self.metadata = pickle.load(f)
+        if os.path.exists(self.meta_path):
+            self.metadata = carregar_estado(self.meta_path)
+        else:
+            # Metadados de versões anteriores (pickle); o próximo save já grava no formato novo
+            with open(self._meta_legado(), "rb") as f:
+                self.metadata = pickle.load(f)
+
+    def _meta_legado(self):
+        return os.path.splitext(self.meta_path)[0] + ".pkl"
 
     def reset(self):
         pass
\ No newline at end of file
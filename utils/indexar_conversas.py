@@ -0,0 +1,30 @@
+"""
+Backfill do índice de busca: indexa as sessões já salvas em dados/conversas_salvas.
+
+Uso (na raiz do projeto):
+    python -m utils.indexar_conversas [diretorio_conversas] [arquivo_indice]
+
+Sessões que já estão no índice são puladas, então pode ser executado de novo
+sempre que houver arquivos novos.
+"""
+import os
+import sys
+import time
+
+from core.busca_conversas import IndiceConversas
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+CONVERSAS_DIR = os.path.join(BASE_DIR, "..", "dados", "conversas_salvas")
+BUSCA_DB = os.path.join(BASE_DIR, "..", "dados", "busca_conversas.sqlite")
+
+
+def main(argv):
+    diretorio = argv[1] if len(argv) > 1 else CONVERSAS_DIR
+    caminho = argv[2] if len(argv) > 2 else BUSCA_DB
+    inicio = time.time()
+    total = IndiceConversas(caminho).importar_diretorio(diretorio)
+    print(f"{total['sessoes']} sessões e {total['mensagens']} mensagens indexadas em {time.time() - inicio:.1f}s")
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -1,9 +1,179 @@
+"""
+Serialização compartilhada: JSON rápido, gravação atômica, binário compacto e NDJSON.
+
+Usa orjson ou msgspec quando instalados e cai para o json da biblioteca padrão.
+O binário (msgpack) é para estado interno que ninguém edita à mão; sem msgpack
+nem msgspec, grava JSON compacto no lugar (carregar_estado aceita os dois).
+"""
 import json
+import os
+import threading
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+if orjson is not None:
+    BIBLIOTECA_JSON = "orjson"
+elif msgspec is not None:
+    BIBLIOTECA_JSON = "msgspec"
+else:
+    BIBLIOTECA_JSON = "json"
+
+
+def _padrao(obj):
+    """
+    Arrays e escalares numpy viram listas e números, sets viram listas. Qualquer outro
+    tipo é erro (TypeError), como no json padrão: virar str em silêncio esconderia o
+    objeto errado que foi parar nos dados.
+    """
+    if numpy is not None and isinstance(obj, (numpy.ndarray, numpy.generic)):
+        return obj.tolist()
+    if isinstance(obj, (set, frozenset)):
+        return list(obj)
+    raise TypeError(f"Tipo não serializável: {type(obj).__name__}")
+
+
+def dumps(dados, indent=False):
+    """Serializa para JSON em bytes UTF-8 (sem escapar acentos)."""
+    try:
+        if orjson is not None:
+            opcoes = orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS
+            return orjson.dumps(dados, default=_padrao, option=opcoes | (orjson.OPT_INDENT_2 if indent else 0))
+        if msgspec is not None and not indent:
+            return msgspec.json.encode(dados, enc_hook=_padrao)
+    except (TypeError, ValueError, OverflowError):
+        pass  # inteiros gigantes, chaves exóticas...: o json padrão resolve
+    return json.dumps(dados, ensure_ascii=False, default=_padrao,
+                      indent=2 if indent else None, separators=None if indent else (",", ":")).encode("utf-8")
+
+
+def loads(conteudo):
+    """Lê JSON de bytes ou str."""
+    if orjson is not None:
+        return orjson.loads(conteudo)
+    if msgspec is not None:
+        return msgspec.json.decode(conteudo)
+    return json.loads(conteudo)
+
+
+def linha_ndjson(dados):
+    """Um registro NDJSON (JSON compacto + quebra de linha), em bytes."""
+    return dumps(dados) + b"\n"
+
+
+def _temporario(path):
+    """Arquivo temporário ao lado do destino (mesmo sistema de arquivos, para o rename ser atômico)."""
+    return f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+
+
+def escrever_atomico(path, conteudo):
+    """
+    Grava bytes num arquivo temporário no mesmo diretório e troca pelo destino
+    com os.replace: quem lê vê o arquivo antigo ou o novo, nunca um pela metade.
+    """
+    temporario = _temporario(path)
+    try:
+        with open(temporario, "wb") as f:
+            f.write(conteudo)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporario, path)
+    except BaseException:
+        try:
+            os.unlink(temporario)
+        except OSError:
+            pass
+        raise
+
+
+def salvar_json(path, dados, indent=True):
+    """Salva JSON de forma atômica. indent=False para arquivos que só a máquina lê."""
+    escrever_atomico(path, dumps(dados, indent=indent))
 
-def salvar_json(path, dados):
-    with open(path, "w", encoding="utf-8") as f:
-        json.dump(dados, f, indent=2, ensure_ascii=False)
 
 def carregar_json(path):
-    with open(path, "r", encoding="utf-8") as f:
-        return json.load(f)
+    with open(path, "rb") as f:
+        return loads(f.read())
+
+
+def salvar_estado(path, dados):
+    """Estado interno em msgpack (ou JSON compacto se não houver biblioteca msgpack), gravado atomicamente."""
+    if msgpack is not None:
+        conteudo = msgpack.packb(dados, use_bin_type=True, default=_padrao)
+    elif msgspec is not None:
+        conteudo = msgspec.msgpack.encode(dados, enc_hook=_padrao)
+    else:
+        conteudo = dumps(dados)
+    escrever_atomico(path, conteudo)
+
+
+def carregar_estado(path):
+    with open(path, "rb") as f:
+        conteudo = f.read()
+    if conteudo[:1] in (b"[", b"{"):
+        return loads(conteudo)  # gravado como JSON (msgpack nunca começa com esses bytes para listas/dicts)
+    if msgpack is not None:
+        return msgpack.unpackb(conteudo, raw=False, strict_map_key=False)
+    if msgspec is not None:
+        return msgspec.msgpack.decode(conteudo)
+    raise RuntimeError(f"{path} está em msgpack; instale msgpack ou msgspec para ler")
+
+
+class EscritorNDJSON:
+    def __init__(self, path, atomico=True, buffer=1 << 20):
+        """
+        Exportação em streaming: um registro por linha, sem montar a lista inteira na memória.
+
+            with EscritorNDJSON("saida.ndjson") as saida:
+                for registro in registros:
+                    saida.escrever(registro)
+
+        :param atomico: Grava num temporário e só substitui o destino se terminar sem erro.
+        :param buffer: Tamanho do buffer de escrita, em bytes.
+        """
+        self.path = path
+        self.atomico = atomico
+        self.buffer = buffer
+        self.registros = 0
+        self._arquivo = None
+        self._temporario = None
+
+    def __enter__(self):
+        if self.atomico:
+            self._temporario = _temporario(self.path)
+            self._arquivo = open(self._temporario, "wb", buffering=self.buffer)
+        else:
+            self._arquivo = open(self.path, "ab", buffering=self.buffer)
+        return self
+
+    def escrever(self, dados):
+        self._arquivo.write(linha_ndjson(dados))
+        self.registros += 1
+
+    def __exit__(self, tipo, erro, rastreamento):
+        self._arquivo.flush()
+        os.fsync(self._arquivo.fileno())
+        self._arquivo.close()
+        if self._temporario is not None:
+            if tipo is None:
+                os.replace(self._temporario, self.path)
+            else:
+                os.unlink(self._temporario)
+        return False
@@ -0,0 +1,170 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+# Limites dos baldes em segundos: de frações de milissegundo (codificação, FAISS) a minutos (geração longa)
+BALDES_PADRAO = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+
+def _escapar(valor):
+    return str(valor).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _rotulos_texto(nomes, valores, extra=""):
+    pares = [f'{n}="{_escapar(v)}"' for n, v in zip(nomes, valores)]
+    if extra:
+        pares.append(extra)
+    return "{" + ",".join(pares) + "}" if pares else ""
+
+
+class Contador:
+    tipo = "counter"
+
+    def __init__(self, nome, ajuda, rotulos=()):
+        self.nome = nome
+        self.ajuda = ajuda
+        self.rotulos = tuple(rotulos)
+        self.series = {}
+        self._lock = threading.Lock()
+
+    def incrementar(self, valor=1, *rotulos):
+        with self._lock:
+            self.series[rotulos] = self.series.get(rotulos, 0) + valor
+
+    def valores(self):
+        with self._lock:
+            return dict(self.series)
+
+    def exposicao(self):
+        for rotulos, valor in sorted(self.valores().items()):
+            yield f"{self.nome}{_rotulos_texto(self.rotulos, rotulos)} {valor}"
+
+
+class Histograma:
+    tipo = "histogram"
+
+    def __init__(self, nome, ajuda, rotulos=(), baldes=BALDES_PADRAO):
+        self.nome = nome
+        self.ajuda = ajuda
+        self.rotulos = tuple(rotulos)
+        self.baldes = tuple(baldes)
+        self.series = {}           # rotulos -> [contagens por balde (+Inf no fim), soma, total, mínimo, máximo]
+        self._lock = threading.Lock()
+
+    def observar(self, valor, *rotulos):
+        """Custo: uma busca binária e um lock curto (sem alocação depois da primeira observação)."""
+        indice = bisect.bisect_left(self.baldes, valor)
+        with self._lock:
+            serie = self.series.get(rotulos)
+            if serie is None:
+                serie = self.series[rotulos] = [[0] * (len(self.baldes) + 1), 0.0, 0, valor, valor]
+            serie[0][indice] += 1
+            serie[1] += valor
+            serie[2] += 1
+            if valor < serie[3]:
+                serie[3] = valor
+            elif valor > serie[4]:
+                serie[4] = valor
+
+    @contextmanager
+    def cronometrar(self, *rotulos):
+        inicio = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observar(time.perf_counter() - inicio, *rotulos)
+
+    def _copia(self):
+        with self._lock:
+            return {r: (list(s[0]), s[1], s[2], s[3], s[4]) for r, s in self.series.items()}
+
+    def percentil(self, contagens, total, p, minimo=0.0, maximo=float("inf")):
+        """
+        Percentil estimado por interpolação linear dentro do balde (como o histogram_quantile
+        do Prometheus), limitado ao menor e ao maior valor observados.
+        """
+        if not total:
+            return None
+        alvo = p * total
+        acumulado = 0
+        for i, contagem in enumerate(contagens):
+            if acumulado + contagem >= alvo and contagem:
+                inferior = max(self.baldes[i - 1] if i > 0 else 0.0, minimo)
+                superior = min(self.baldes[i] if i < len(self.baldes) else maximo, maximo)
+                return inferior + (superior - inferior) * (alvo - acumulado) / contagem
+            acumulado += contagem
+        return maximo
+
+    def resumo(self):
+        """{rotulos: {"n", "media_ms", "p50_ms", "p95_ms", "p99_ms", "max_ms"}} para o /admin/estado."""
+        resultado = {}
+        for rotulos, (contagens, soma, total, minimo, maximo) in self._copia().items():
+            resultado["/".join(map(str, rotulos)) or "total"] = {
+                "n": total,
+                "media_ms": round(soma / total * 1000, 2),
+                **{f"p{int(p * 100)}_ms": round(self.percentil(contagens, total, p, minimo, maximo) * 1000, 2)
+                   for p in (0.5, 0.95, 0.99)},
+                "max_ms": round(maximo * 1000, 2),
+            }
+        return resultado
+
+    def exposicao(self):
+        for rotulos, (contagens, soma, total, _, _) in sorted(self._copia().items()):
+            acumulado = 0
+            for limite, contagem in zip(self.baldes + ("+Inf",), contagens):
+                acumulado += contagem
+                le = 'le="%s"' % limite
+                yield f"{self.nome}_bucket{_rotulos_texto(self.rotulos, rotulos, le)} {acumulado}"
+            yield f"{self.nome}_sum{_rotulos_texto(self.rotulos, rotulos)} {soma}"
+            yield f"{self.nome}_count{_rotulos_texto(self.rotulos, rotulos)} {total}"
+
+
+class RegistroMetricas:
+    def __init__(self, prefixo="equalz_"):
+        """
+        Métricas no formato texto do Prometheus, sem dependências.
+
+        :param prefixo: Prefixo aplicado ao nome de todas as métricas.
+        """
+        self.prefixo = prefixo
+        self.metricas = {}
+        self.inicio = time.time()
+
+    def _registrar(self, classe, nome, *args, **kwargs):
+        if nome not in self.metricas:
+            self.metricas[nome] = classe(self.prefixo + nome, *args, **kwargs)
+        return self.metricas[nome]
+
+    def contador(self, nome, ajuda, rotulos=()):
+        return self._registrar(Contador, nome, ajuda, rotulos)
+
+    def histograma(self, nome, ajuda, rotulos=(), baldes=BALDES_PADRAO):
+        return self._registrar(Histograma, nome, ajuda, rotulos, baldes)
+
+    def texto(self):
+        linhas = []
+        for metrica in self.metricas.values():
+            linhas.append(f"# HELP {metrica.nome} {metrica.ajuda}")
+            linhas.append(f"# TYPE {metrica.nome} {metrica.tipo}")
+            linhas.extend(metrica.exposicao())
+        linhas.append(f"# HELP {self.prefixo}uptime_segundos Tempo desde o início do processo")
+        linhas.append(f"# TYPE {self.prefixo}uptime_segundos gauge")
+        linhas.append(f"{self.prefixo}uptime_segundos {time.time() - self.inicio:.1f}")
+        return "\n".join(linhas) + "\n"
+
+
+# Registro único do processo, compartilhado por servidor, cliente Ollama, memória e agendador
+metricas = RegistroMetricas()
+
+ETAPAS = metricas.histograma(
+    "turno_etapa_segundos",
+    "Duração de cada etapa do pipeline de um turno "
+    "(codificar, busca_faiss, montar_prompt, fila, primeiro_token, geracao, persistencia)",
+    ("etapa",))
+TURNOS = metricas.histograma("turno_segundos", "Duração total do turno no /conversar", ("modelo", "persona"))
+TURNOS_TOTAL = metricas.contador("turnos_total", "Turnos por resultado", ("modelo", "persona", "status"))
+TOKENS_ENTRADA = metricas.contador("tokens_entrada_total", "Tokens de prompt avaliados pelo Ollama",
+                                   ("modelo", "persona"))
+TOKENS_SAIDA = metricas.contador("tokens_saida_total", "Tokens gerados pelo Ollama", ("modelo", "persona"))
+CACHE = metricas.contador("cache_respostas_total", "Consultas ao cache de respostas", ("modelo", "persona", "resultado"))
@@ -0,0 +1,310 @@
+"""
+Rastreamento leve dos turnos: spans aninhados por contexto, sem coletor externo.
+
+    with rastreador.rastro("conversar", sessao=...) as raiz:   # um rastro por requisição
+        with rastreador.span("faiss.buscar", k=3):            # filhos herdam o rastro atual
+            ...
+
+Fora de um rastro, span() não registra nada. Os rastros mais lentos ficam em
+memória para o /admin/rastros e, opcionalmente, todos são exportados em JSON
+no formato OTLP (um ExportTraceServiceRequest por linha), que o OpenTelemetry
+Collector e o Jaeger importam. A exportação espera os spans que ainda rodam
+depois da raiz (ex.: a tentativa perdedora do hedge, cancelada em segundo plano).
+"""
+import contextvars
+import heapq
+import itertools
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+from config.config import RASTREAMENTO_ATIVO, RASTREAMENTO_LENTOS, RASTREAMENTO_RECENTES, RASTREAMENTO_EXPORTAR
+from utils.json_files import linha_ndjson
+
+_span_atual = contextvars.ContextVar("span_atual", default=None)
+
+
+def novo_id(tamanho):
+    """Id aleatório em hexadecimal (16 bytes para rastros, 8 para spans, como no W3C Trace Context)."""
+    return os.urandom(tamanho).hex()
+
+
+def origem_rastro(traceparent):
+    """
+    Extrai (trace id, span id do chamador) de um cabeçalho traceparent
+    ("00-<trace>-<span>-<flags>"), ou (None, None) se o cabeçalho for inválido.
+    """
+    partes = (traceparent or "").split("-")
+    if (len(partes) == 4 and len(partes[1]) == 32 and partes[1] != "0" * 32
+            and len(partes[2]) == 16 and partes[2] != "0" * 16):
+        try:
+            int(partes[1], 16)
+            int(partes[2], 16)
+            return partes[1].lower(), partes[2].lower()
+        except ValueError:
+            pass
+    return None, None
+
+
+def _atributo_otlp(chave, valor):
+    if isinstance(valor, bool):
+        return {"key": chave, "value": {"boolValue": valor}}
+    if isinstance(valor, int):
+        return {"key": chave, "value": {"intValue": str(valor)}}
+    if isinstance(valor, float):
+        return {"key": chave, "value": {"doubleValue": valor}}
+    return {"key": chave, "value": {"stringValue": str(valor)}}
+
+
+class Span:
+    __slots__ = ("rastro", "nome", "span_id", "pai_id", "inicio_ns", "fim_ns", "atributos", "eventos", "erro")
+
+    def __init__(self, rastro, nome, pai_id, atributos, inicio_ns=None):
+        self.rastro = rastro
+        self.nome = nome
+        self.span_id = novo_id(8)
+        self.pai_id = pai_id
+        self.inicio_ns = inicio_ns or time.time_ns()
+        self.fim_ns = None
+        self.atributos = {k: v for k, v in atributos.items() if v is not None}
+        self.eventos = []
+        self.erro = None
+
+    def definir(self, **atributos):
+        """Acrescenta atributos ao span (valores None são ignorados)."""
+        self.atributos.update({k: v for k, v in atributos.items() if v is not None})
+
+    def evento(self, nome, **atributos):
+        """Marca um instante dentro do span (ex.: primeiro token recebido)."""
+        self.eventos.append((nome, time.time_ns(), atributos))
+
+    @property
+    def duracao_ms(self):
+        fim = self.fim_ns or time.time_ns()
+        return (fim - self.inicio_ns) / 1e6
+
+    def resumo(self, origem_ns):
+        return {
+            "nome": self.nome,
+            "span_id": self.span_id,
+            "pai_id": self.pai_id,
+            "inicio_ms": round((self.inicio_ns - origem_ns) / 1e6, 3),
+            "duracao_ms": round(self.duracao_ms, 3),
+            "atributos": self.atributos,
+            "eventos": [{"nome": nome, "em_ms": round((instante - origem_ns) / 1e6, 3), **atributos}
+                        for nome, instante, atributos in self.eventos],
+            **({"erro": self.erro} if self.erro else {}),
+        }
+
+    def otlp(self):
+        span = {
+            "traceId": self.rastro.trace_id,
+            "spanId": self.span_id,
+            "name": self.nome,
+            "kind": 2 if self is self.rastro.raiz else 1,  # SERVER na raiz, INTERNAL nos filhos
+            "startTimeUnixNano": str(self.inicio_ns),
+            "endTimeUnixNano": str(self.fim_ns or self.inicio_ns),
+            "attributes": [_atributo_otlp(k, v) for k, v in self.atributos.items()],
+            "events": [{"name": nome, "timeUnixNano": str(instante),
+                        "attributes": [_atributo_otlp(k, v) for k, v in atributos.items()]}
+                       for nome, instante, atributos in self.eventos],
+            "status": {"code": 2, "message": self.erro} if self.erro else {},
+        }
+        if self.pai_id:
+            span["parentSpanId"] = self.pai_id
+        return span
+
+
+class Rastro:
+    def __init__(self, trace_id=None):
+        """Spans de uma requisição, vindos de todas as threads que trabalharam nela."""
+        self.trace_id = trace_id or novo_id(16)
+        self.raiz = None
+        self.spans = []
+        self._abertos = 0
+        self._concluido = False
+        self._ao_concluir = None
+        self._lock = threading.Lock()
+
+    def abrir(self):
+        """Conta um span em andamento."""
+        with self._lock:
+            self._abertos += 1
+
+    def adicionar(self, span, aberto=False):
+        """
+        :param aberto: O span foi contado por abrir() e terminou agora; se era o último
+            em andamento de um rastro já concluído, dispara a conclusão pendente.
+        """
+        with self._lock:
+            self.spans.append(span)
+            if aberto:
+                self._abertos -= 1
+            pendente = aberto and self._concluido and self._abertos == 0 and self._ao_concluir
+        if pendente:
+            pendente(self)
+
+    def concluir(self, ao_concluir):
+        """Encerra o rastro: ao_concluir roda agora ou quando o último span em andamento terminar."""
+        with self._lock:
+            self._concluido = True
+            self._ao_concluir = ao_concluir
+            pronto = self._abertos == 0
+        if pronto:
+            ao_concluir(self)
+
+    @property
+    def duracao_ms(self):
+        return self.raiz.duracao_ms if self.raiz else 0.0
+
+    def resumo(self):
+        with self._lock:
+            spans = sorted(self.spans, key=lambda s: s.inicio_ns)
+        origem = self.raiz.inicio_ns
+        return {
+            "trace_id": self.trace_id,
+            "nome": self.raiz.nome,
+            "inicio": self.raiz.inicio_ns / 1e9,
+            "duracao_ms": round(self.duracao_ms, 3),
+            "atributos": self.raiz.atributos,
+            "spans": [s.resumo(origem) for s in spans],
+        }
+
+    def otlp(self, servico):
+        with self._lock:
+            spans = [s.otlp() for s in self.spans]
+        return {"resourceSpans": [{
+            "resource": {"attributes": [_atributo_otlp("service.name", servico)]},
+            "scopeSpans": [{"scope": {"name": "equalzbrainz.rastreamento"}, "spans": spans}],
+        }]}
+
+
+class Rastreador:
+    def __init__(self, ativo=RASTREAMENTO_ATIVO, lentos=RASTREAMENTO_LENTOS, recentes=RASTREAMENTO_RECENTES,
+                 exportar=RASTREAMENTO_EXPORTAR, servico="equalzbrainz"):
+        """
+        :param lentos: Quantos dos rastros mais lentos manter em memória.
+        :param recentes: Quantos rastros recentes manter para consulta pelo trace id.
+        :param exportar: Arquivo onde anexar cada rastro em JSON OTLP (None = não exporta).
+        :param servico: service.name dos rastros exportados.
+        """
+        self.ativo = ativo
+        self.lentos = lentos
+        self.exportar = exportar
+        self.servico = servico
+        self._lentos = []                      # heap mínimo de (duração, seq, rastro): o topo é o mais rápido
+        self._recentes = deque(maxlen=recentes)
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+        self._lock_exportacao = threading.Lock()
+        self.estatisticas = {"rastros": 0, "exportados": 0, "falhas_exportacao": 0}
+
+    @contextmanager
+    def rastro(self, nome, trace_id=None, pai_id=None, **atributos):
+        """
+        Abre o span raiz de uma requisição; ao fechar, o rastro entra no registro dos lentos.
+
+        :param trace_id: Continua um rastro do chamador (traceparent); None cria um novo.
+        :param pai_id: Span do chamador, pai da raiz no rastro continuado.
+        """
+        if not self.ativo:
+            yield None
+            return
+        rastro = Rastro(trace_id)
+        rastro.raiz = Span(rastro, nome, pai_id, atributos)
+        try:
+            with self._abrir(rastro.raiz):
+                yield rastro.raiz
+        finally:
+            self._concluir(rastro)
+
+    @contextmanager
+    def span(self, nome, **atributos):
+        """Span filho do span atual; sem rastro ativo, não faz nada (e devolve None)."""
+        pai = _span_atual.get()
+        if pai is None:
+            yield None
+            return
+        with self._abrir(Span(pai.rastro, nome, pai.span_id, atributos)) as span:
+            yield span
+
+    def registrar(self, nome, duracao_s, **atributos):
+        """Registra um span já concluído que terminou agora (ex.: espera medida por outro componente)."""
+        pai = _span_atual.get()
+        if pai is None:
+            return
+        fim = time.time_ns()
+        span = Span(pai.rastro, nome, pai.span_id, atributos, inicio_ns=fim - int(duracao_s * 1e9))
+        span.fim_ns = fim
+        pai.rastro.adicionar(span)
+
+    def evento(self, nome, **atributos):
+        """Evento no span atual, se houver."""
+        span = _span_atual.get()
+        if span is not None:
+            span.evento(nome, **atributos)
+
+    def atual(self):
+        return _span_atual.get()
+
+    @contextmanager
+    def _abrir(self, span):
+        token = _span_atual.set(span)
+        span.rastro.abrir()
+        try:
+            yield span
+        except Exception as e:
+            span.erro = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            span.fim_ns = time.time_ns()
+            _span_atual.reset(token)
+            span.rastro.adicionar(span, aberto=True)
+
+    def _concluir(self, rastro):
+        duracao = rastro.duracao_ms
+        with self._lock:
+            self.estatisticas["rastros"] += 1
+            self._recentes.append(rastro)
+            item = (duracao, next(self._seq), rastro)
+            if len(self._lentos) < self.lentos:
+                heapq.heappush(self._lentos, item)
+            elif self._lentos and duracao > self._lentos[0][0]:
+                heapq.heapreplace(self._lentos, item)
+        if self.exportar:
+            # Spans de tentativas ainda em andamento (hedge perdedor) entram no export quando terminarem
+            rastro.concluir(self._exportar)
+
+    def _exportar(self, rastro):
+        try:
+            linha = linha_ndjson(rastro.otlp(self.servico))
+            with self._lock_exportacao, open(self.exportar, "ab") as f:
+                f.write(linha)
+            self.estatisticas["exportados"] += 1
+        except Exception as e:
+            self.estatisticas["falhas_exportacao"] += 1
+            print(f"[ERRO] Exportar rastro {rastro.trace_id}: {e}")
+
+    def mais_lentos(self, limite=None):
+        """Resumos dos rastros mais lentos, do mais lento para o mais rápido."""
+        with self._lock:
+            rastros = [r for _, _, r in sorted(self._lentos, reverse=True)]
+        return [r.resumo() for r in rastros[:limite]]
+
+    def buscar(self, trace_id):
+        """Resumo de um rastro recente ou lento pelo trace id (o do cabeçalho X-Trace-Id)."""
+        with self._lock:
+            candidatos = list(self._recentes) + [r for _, _, r in self._lentos]
+        for rastro in candidatos:
+            if rastro.trace_id == trace_id:
+                return rastro.resumo()
+        return None
+
+    def estado(self):
+        return dict(self.estatisticas, ativo=self.ativo, lentos=len(self._lentos), exportar=self.exportar)
+
+
+# Rastreador único do processo
+rastreador = Rastreador()
@@ -0,0 +1,117 @@
+import re
+import threading
+from functools import lru_cache
+
+from config.config import TOKENIZADOR, CALIBRACAO_TOKENS_ALFA
+
+_PADRAO_TOKEN = re.compile(r"\w+|[^\w\s]")
+_tokenizador = None
+_pronto = TOKENIZADOR is None  # contagem definitiva: tokenizador carregado, indisponível ou não configurado
+_lock = threading.Lock()
+
+
+def carregar_tokenizador():
+    """
+    Carrega (uma vez) o tokenizador HuggingFace configurado. Pode baixar o modelo,
+    então o servidor chama em segundo plano; até terminar, vale a estimativa.
+    """
+    global _tokenizador, _pronto
+    with _lock:
+        if _pronto:
+            return _tokenizador
+        try:
+            from transformers import AutoTokenizer
+            _tokenizador = AutoTokenizer.from_pretrained(TOKENIZADOR)
+        except Exception as e:
+            print(f"[ERRO] Carregar tokenizador {TOKENIZADOR}, usando estimativa: {e}")
+        _pronto = True
+        return _tokenizador
+
+
+def iniciar_carregamento(ao_concluir=None):
+    """
+    Carrega o tokenizador numa thread, sem atrasar a inicialização.
+
+    :param ao_concluir: Chamada depois da carga, se o tokenizador ficou disponível
+        (para recontar o que foi contado pela estimativa enquanto isso).
+    """
+    def _carregar():
+        if carregar_tokenizador() is not None and ao_concluir:
+            ao_concluir()
+
+    if not _pronto:
+        threading.Thread(target=_carregar, daemon=True).start()
+
+
+def estimar_tokens(texto):
+    """Estimativa de tokens: palavras e sinais de pontuação, com palavras longas contando mais."""
+    return sum(1 + len(p) // 8 for p in _PADRAO_TOKEN.findall(texto))
+
+
+@lru_cache(maxsize=8192)
+def _contar_exato(texto):
+    return len(_tokenizador.encode(texto, add_special_tokens=False))
+
+
+def contar_tokens(texto):
+    """
+    Conta tokens com o tokenizador configurado ou, sem ele, pela estimativa.
+    Só a contagem com o tokenizador já carregado vai para o cache.
+    """
+    if not texto:
+        return 0
+    if _pronto and _tokenizador is not None:
+        return _contar_exato(texto)
+    return estimar_tokens(texto)
+
+
+def tokens_mensagem(mensagem):
+    """Tokens de uma mensagem do histórico, guardados em mensagem['tokens'] quando a contagem é definitiva."""
+    if "tokens" in mensagem:
+        return mensagem["tokens"]
+    tokens = contar_tokens(mensagem["content"])
+    if _pronto:
+        mensagem["tokens"] = tokens
+    return tokens
+
+
+class CalibracaoTokens:
+    def __init__(self, alfa=CALIBRACAO_TOKENS_ALFA):
+        """
+        Nenhum tokenizador local é o do modelo servido, então as contagens daqui são
+        aproximações. A calibração aprende, por modelo, a razão entre os tokens que o
+        Ollama avaliou (prompt_eval_count) e a nossa contagem do mesmo prompt; o
+        MontadorContexto divide o orçamento por esse fator.
+
+        :param alfa: Peso de cada amostra nova na média móvel exponencial.
+        """
+        self.alfa = alfa
+        self.fatores = {}
+        self._lock = threading.Lock()
+
+    def registrar(self, modelo, contados, avaliados):
+        """
+        :param contados: Tokens do prompt pela nossa contagem (relatório do montador).
+        :param avaliados: prompt_eval_count do Ollama para o mesmo prompt.
+        """
+        if not modelo or not contados or not avaliados:
+            return
+        razao = avaliados / contados
+        # Com o prefixo no cache KV o Ollama só conta o que avaliou: amostras assim subestimam o prompt
+        if razao < 0.5:
+            return
+        with self._lock:
+            anterior = self.fatores.get(modelo)
+            self.fatores[modelo] = razao if anterior is None else anterior + self.alfa * (razao - anterior)
+
+    def fator(self, modelo):
+        """Tokens do modelo por token contado aqui (1.0 até haver amostras; nunca amplia o orçamento)."""
+        with self._lock:
+            return max(1.0, self.fatores.get(modelo, 1.0))
+
+    def estado(self):
+        with self._lock:
+            return {modelo: round(fator, 3) for modelo, fator in self.fatores.items()}
+
+
+calibracao_tokens = CalibracaoTokens()